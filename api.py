@@ -0,0 +1,281 @@
+"""HTTP API for calculating spectra without the Dash UI.
+
+create_api() returns a Flask Blueprint, mounted on the Dash app's Flask
+server by webapp.create_app(), with the following endpoints:
+
+* GET /api/models
+    The registered models, with their parameter names, defaults and limits.
+* GET or POST /api/spectrum/<model name>
+    The spectrum for one set of parameters, given as query arguments (GET)
+    or a JSON object (POST). Missing parameters take their defaults. With
+    format=json (the default) the response is
+    {"model": str, "parameters": {str: float}, "x": [float], "y": [float]};
+    with format=npy it is a float64 array of shape (2, points), rows x and y,
+    in NumPy .npy format (numpy.load(io.BytesIO(response.content))).
+* POST /api/batch/<model name>
+    Many spectra in one request, for models with a batch_model. The JSON
+    body is {"parameters": [{str: float}, ...], "points": int (optional,
+    default 800), "x_min": float, "x_max": float (optional; default: the
+    range covering every parameter set)}. The response is streamed in .npy
+    format: a float64 array of shape (1 + sets, points) whose first row is
+    the shared x grid and whose following rows are the spectra, in request
+    order. Requests are limited to MAX_BATCH_BYTES, MAX_BATCH_SETS sets,
+    MAX_BATCH_POINTS points and MAX_BATCH_VALUES values in total.
+* GET /api/heatmap/<model name>?rows=<entry>&slider=<entry>
+    The spectra over a grid of two of the model's sweeps (see heatmap.py),
+    with the other parameters given as query arguments (defaults if
+    missing). The response is an .npz archive (numpy.load) with arrays
+    rows, slider, x (the swept values and frequencies), cube (uint8, indexed
+    [slider, row, frequency]) and range (the intensities of levels 0 and
+    255).
+
+Single spectra are fetched through BaseDashModel.spectrum(), so the API and the
+Dash callbacks share one cache per model. Invalid requests get a 4xx status
+and {"error": str}.
+"""
+import io
+import json
+import math
+
+import numpy as np
+from flask import Blueprint, Response, jsonify, request
+
+from metrics import METRICS
+
+# Limits for /api/batch requests
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+MAX_BATCH_SETS = 10000
+MAX_BATCH_POINTS = 100000
+MAX_BATCH_VALUES = 5 * 10 ** 7
+# Approximate number of values calculated (and held in memory) at a time
+# while streaming a batch response.
+BATCH_CHUNK_VALUES = 2 ** 18
+
+
+def error_response(message, status=400):
+    """:return: (flask.Response) {"error": message} with the given status."""
+    response = jsonify({'error': message})
+    response.status_code = status
+    return response
+
+
+def request_params():
+    """:return: ({str: object}) the parameters of the current request: the
+    JSON body of a POST, or the query arguments (other than 'format')."""
+    if request.method == 'POST':
+        params = request.get_json(force=True, silent=True)
+        if not isinstance(params, dict):
+            raise ValueError('POST body must be a JSON object')
+        return dict(params)
+    params = request.args.to_dict()
+    params.pop('format', None)
+    return params
+
+
+def npy_response(array):
+    """:return: (flask.Response) array in .npy format."""
+    buffer = io.BytesIO()
+    np.save(buffer, array)
+    return Response(buffer.getvalue(), mimetype='application/octet-stream')
+
+
+def npy_header(shape):
+    """:return: (bytes) the .npy header for a C-order float64 array."""
+    buffer = io.BytesIO()
+    np.lib.format.write_array_header_1_0(
+        buffer, {'descr': '<f8', 'fortran_order': False, 'shape': shape})
+    return buffer.getvalue()
+
+
+def read_body(limit):
+    """Read the request body, however it is sent: chunked requests have no
+    Content-Length to check beforehand.
+
+    :param limit: (int) the most bytes accepted.
+    :return: (bytes or None) the body, or None if it is larger than limit.
+    """
+    chunks = []
+    size = 0
+    while size <= limit:
+        chunk = request.stream.read(limit + 1 - size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    return None if size > limit else b''.join(chunks)
+
+
+def parse_batch(model, data):
+    """Check the body of a batch request for model.
+
+    :param data: (bytes) the request body.
+    :return: (numpy.ndarray, [numpy.ndarray...]) the x grid, and one array
+    per model parameter (in entry_names order).
+    :raises ValueError: if the request is malformed or too large.
+    """
+    try:
+        body = json.loads(data)
+    except ValueError:
+        body = None
+    if not isinstance(body, dict) or not isinstance(
+            body.get('parameters'), list):
+        raise ValueError('body must be a JSON object with a "parameters" list')
+    param_sets = body['parameters']
+    if not param_sets:
+        raise ValueError('"parameters" is empty')
+    if len(param_sets) > MAX_BATCH_SETS:
+        raise ValueError('at most {} parameter sets per request'.format(
+            MAX_BATCH_SETS))
+    try:
+        points = int(body.get('points', 800))
+    except (TypeError, ValueError):
+        raise ValueError('points must be an integer')
+    if not 2 <= points <= MAX_BATCH_POINTS:
+        raise ValueError('points must be between 2 and {}'.format(
+            MAX_BATCH_POINTS))
+    if points * len(param_sets) > MAX_BATCH_VALUES:
+        raise ValueError('at most {} values per request'.format(
+            MAX_BATCH_VALUES))
+
+    rows = []
+    for i, params in enumerate(param_sets):
+        if not isinstance(params, dict):
+            raise ValueError('parameter set {} is not an object'.format(i))
+        try:
+            rows.append(model.validate(params))
+        except ValueError as e:
+            raise ValueError('parameter set {}: {}'.format(i, e))
+    columns = list(np.array(rows).T)
+
+    names = model.entry_names
+    if 'x_min' in body and 'x_max' in body:
+        limits = body['x_min'], body['x_max']
+    elif 'va' in names and 'vb' in names:
+        # imported here so that the model module still loads on first use
+        from dnmrplot import batch_limits
+        limits = batch_limits(columns[names.index('va')],
+                              columns[names.index('vb')])
+        limits = body.get('x_min', limits[0]), body.get('x_max', limits[1])
+    else:
+        raise ValueError('x_min and x_max are required for {}'.format(
+            model.name))
+    try:
+        l_limit, r_limit = (float(limit) for limit in limits)
+    except (TypeError, ValueError):
+        raise ValueError('x_min and x_max must be numbers')
+    if not (math.isfinite(l_limit) and math.isfinite(r_limit)):
+        raise ValueError('x_min and x_max must be finite')
+    return np.linspace(l_limit, r_limit, points), columns
+
+
+def stream_batch(batch_model, x, columns):
+    """Generate the .npy bytes for a batch response, calculating the spectra
+    a few rows at a time.
+
+    :return: a generator of bytes.
+    """
+    sets = len(columns[0])
+    yield npy_header((1 + sets, len(x)))
+    yield x.astype('<f8').tobytes()
+    rows_per_chunk = max(1, BATCH_CHUNK_VALUES // len(x))
+    for start in range(0, sets, rows_per_chunk):
+        chunk = [column[start:start + rows_per_chunk] for column in columns]
+        yield batch_model(x, *chunk).astype('<f8').tobytes()
+
+
+def create_api(model_dict):
+    """Create the API Blueprint for a set of models.
+
+    :param model_dict: ({str: BaseDashModel}) the app's models, by name.
+    :return: (flask.Blueprint)
+    """
+    api = Blueprint('api', __name__, url_prefix='/api')
+
+    @api.route('/models')
+    def list_models():
+        """:return: JSON {name: {"parameters": [str], "entries": {}}}"""
+        return jsonify({
+            name: {'parameters': model.entry_names,
+                   'entries': model.entry_dict}
+            for name, model in model_dict.items()})
+
+    @api.route('/spectrum/<name>', methods=['GET', 'POST'])
+    def spectrum(name):
+        """:return: the spectrum as JSON or .npy (see module docstring)."""
+        model = model_dict.get(name)
+        if model is None:
+            return error_response('Unknown model: {}'.format(name), 404)
+        response_format = request.args.get('format', 'json')
+        if response_format not in ('json', 'npy'):
+            return error_response('format must be json or npy')
+        try:
+            with METRICS.time(name, 'parse'):
+                values = model.validate(request_params())
+        except ValueError as e:
+            METRICS.increment('errors', name)
+            return error_response(str(e))
+
+        x, y = model.spectrum(*values)
+        if response_format == 'npy':
+            return npy_response(np.stack([x, y]))
+        return jsonify({
+            'model': name,
+            'parameters': dict(zip(model.entry_names, values)),
+            'x': x.tolist(),
+            'y': y.tolist()})
+
+    @api.route('/heatmap/<name>')
+    def parameter_map(name):
+        """:return: a parameter-space cube as .npz (see module
+        docstring)."""
+        model = model_dict.get(name)
+        if model is None:
+            return error_response('Unknown model: {}'.format(name), 404)
+        if not model.can_map:
+            return error_response(
+                '{} does not support parameter maps'.format(name))
+        params = request.args.to_dict()
+        row_param, slider_param = params.pop('rows', None), params.pop(
+            'slider', None)
+        if (row_param not in model.sweeps or slider_param not in model.sweeps
+                or row_param == slider_param):
+            return error_response('rows and slider must be two of: {}'.format(
+                ', '.join(model.sweeps)))
+        try:
+            values = model.validate(params)
+        except ValueError as e:
+            return error_response(str(e))
+
+        rows, slider, x, levels, low, high = model.quantized_cube(
+            values, row_param, slider_param)
+        buffer = io.BytesIO()
+        np.savez(buffer, rows=rows, slider=slider, x=x, cube=levels,
+                 range=np.array([low, high]))
+        return Response(buffer.getvalue(),
+                        mimetype='application/octet-stream')
+
+    @api.route('/batch/<name>', methods=['POST'])
+    def batch(name):
+        """:return: the spectra as a streamed .npy array (see module
+        docstring)."""
+        model = model_dict.get(name)
+        if model is None:
+            return error_response('Unknown model: {}'.format(name), 404)
+        if model.batch_model is None:
+            return error_response(
+                '{} does not support batch requests'.format(name))
+        if (request.content_length or 0) > MAX_BATCH_BYTES:
+            data = None
+        else:
+            data = read_body(MAX_BATCH_BYTES)
+        if data is None:
+            return error_response('request body is larger than {} bytes'
+                                  .format(MAX_BATCH_BYTES), 413)
+        try:
+            x, columns = parse_batch(model, data)
+        except ValueError as e:
+            return error_response(str(e))
+        return Response(stream_batch(model.batch_model, x, columns),
+                        mimetype='application/octet-stream')
+
+    return api
@@ -0,0 +1,71 @@
+"""Benchmark multithreaded evaluation of large single spectra.
+
+Times the chunked evaluation (dnmrplot.evaluate_chunked) of the
+dnmrplot_2spin and dnmrplot_AB lineshapes over 10^6-10^7 point spectra with
+an increasing number of threads, and reports the speedup over the same
+chunked evaluation on one thread. The time of the unchunked call is shown
+for reference.
+
+Usage: python benchmark_threads.py [--points N] [--chunk-size N]
+       [--threads 1 2 4 ...] [--repeat N]
+"""
+import argparse
+import os
+import timeit
+
+import numpy as np
+
+from dnmrplot import (CHUNK_SIZE, evaluate_chunked, lineshape_2spin,
+                      lineshape_AB)
+
+MODELS = {
+    'dnmrplot_2spin': (lineshape_2spin, (165, 135, 65.9, 0.5, 0.5, 50)),
+    'dnmrplot_AB': (lineshape_AB, (165, 135, 12, 12, 0.5))
+}
+
+
+def default_thread_counts():
+    """:return: ([int]) 1, 2, 4... up to the number of CPUs."""
+    counts = [1]
+    while counts[-1] * 2 <= (os.cpu_count() or 1):
+        counts.append(counts[-1] * 2)
+    return counts
+
+
+def best_time(func, args, kwargs, repeat):
+    """:return: (float) the fastest of `repeat` calls, in seconds."""
+    return min(timeit.repeat(lambda: func(*args, **kwargs),
+                             number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, default=10 ** 6)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=default_thread_counts())
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print('{} points, chunk size {}, {} CPUs'.format(
+        args.points, args.chunk_size, os.cpu_count()))
+    for name, (factory, params) in MODELS.items():
+        lineshape = factory(*params)
+        # the same range as the dnmrplot functions: vb - 50 to va + 50
+        x = np.linspace(params[1] - 50, params[0] + 50, args.points)
+        unchunked = best_time(lineshape, (x,), {}, args.repeat)
+        baseline = best_time(evaluate_chunked, (lineshape, x),
+                             {'threads': 1, 'chunk_size': args.chunk_size},
+                             args.repeat)
+        print('\n{}: unchunked {:.4f} s, chunked on 1 thread {:.4f} s'.format(
+            name, unchunked, baseline))
+        print('{:>8} {:>10} {:>8}'.format('threads', 'time (s)', 'speedup'))
+        for threads in args.threads:
+            t = best_time(evaluate_chunked, (lineshape, x),
+                          {'threads': threads, 'chunk_size': args.chunk_size},
+                          args.repeat)
+            print('{:>8} {:>10.4f} {:>8.2f}'.format(threads, t, baseline / t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""A small thread-safe least-recently-used cache.
+
+Provides the following class:
+*LRUCache: a bounded {key: value} store that evicts the least recently used
+entry, and counts hits and misses.
+"""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A bounded mapping that discards the least recently used entry when
+    full. Safe to share between threads.
+
+    Has the following attributes:
+    * maxsize: (int) the maximum number of entries.
+    * hits, misses: (int) the number of get_or_compute() calls that found /
+    did not find their key.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """:return: the value for key (marking it as recently used), or
+        default."""
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, value):
+        """Store value under key, evicting the oldest entry if full."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """Return the value for key, calling compute() and storing its result
+        if key is not cached. compute is called without the lock held, so two
+        threads may compute the same missing key at the same time.
+
+        :param key: a hashable key.
+        :param compute: a function of no arguments.
+        :return: the cached or computed value.
+        """
+        sentinel = object()
+        value = self.get(key, sentinel)
+        with self._lock:
+            if value is not sentinel:
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,123 @@
+"""Check the cold-start import cost of the app's modules against a budget.
+
+Each module is imported in a fresh interpreter with `python -X importtime`,
+and its cumulative import time (the best of several runs) is compared with
+BUDGETS. The compute layer must also not import the UI libraries listed in
+FORBIDDEN. Finally the cold start of a server worker (import, create_app()
+and warm_up()) is compared with STARTUP_BUDGET.
+
+Usage: python check_import_time.py [--runs N] [--scale F]
+Exits with status 1 if any module is over budget or imports a forbidden
+package.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Cumulative import time budgets, in seconds.
+BUDGETS = {
+    'dnmrmath': 0.25,
+    'dnmrplot': 0.25,
+    'model_definitions': 0.02,
+    'webapp': 1.5,
+}
+
+# Budget for import + create_app() + warm_up(), in seconds.
+STARTUP_BUDGET = 2.0
+
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import webapp
+webapp.warm_up(webapp.create_app())
+print(time.perf_counter() - start)
+"""
+
+# Top-level packages that a module must not import.
+FORBIDDEN = {
+    'dnmrmath': ('dash', 'dash_core_components', 'dash_html_components',
+                 'plotly', 'flask'),
+    'dnmrplot': ('dash', 'dash_core_components', 'dash_html_components',
+                 'plotly', 'flask'),
+    'model_definitions': ('dash', 'dash_core_components',
+                          'dash_html_components', 'plotly', 'flask', 'numpy'),
+}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_profile(module):
+    """Import module in a new interpreter.
+
+    :return: ({str: float}) cumulative import time in seconds, for every
+    module imported.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-W', 'ignore', '-c',
+         'import ' + module],
+        cwd=HERE, stderr=subprocess.PIPE, universal_newlines=True,
+        check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def startup_time():
+    """:return: (float) seconds for a new interpreter to create and warm up
+    the app."""
+    result = subprocess.run(
+        [sys.executable, '-W', 'ignore', '-c', STARTUP_SCRIPT],
+        cwd=HERE, stdout=subprocess.PIPE, universal_newlines=True,
+        check=True)
+    return float(result.stdout.split()[-1])
+
+
+def check(runs, scale):
+    """:return: ([str]) a description of each failure."""
+    failures = []
+    for module, budget in BUDGETS.items():
+        profiles = [import_profile(module) for _ in range(runs)]
+        elapsed = min(profile[module] for profile in profiles)
+        budget *= scale
+        status = 'ok' if elapsed <= budget else 'OVER BUDGET'
+        print('{:<20} {:>8.3f} s  (budget {:.3f} s)  {}'.format(
+            module, elapsed, budget, status))
+        if elapsed > budget:
+            failures.append('{} took {:.3f} s to import'.format(
+                module, elapsed))
+        imported = {name.split('.')[0] for name in profiles[0]}
+        for package in FORBIDDEN.get(module, ()):
+            if package in imported:
+                failures.append('{} imports {}'.format(module, package))
+
+    elapsed = min(startup_time() for _ in range(runs))
+    budget = STARTUP_BUDGET * scale
+    status = 'ok' if elapsed <= budget else 'OVER BUDGET'
+    print('{:<20} {:>8.3f} s  (budget {:.3f} s)  {}'.format(
+        'app startup', elapsed, budget, status))
+    if elapsed > budget:
+        failures.append('app startup took {:.3f} s'.format(elapsed))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='imports per module; the fastest is used')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply all budgets (e.g. for slow machines)')
+    args = parser.parse_args()
+
+    failures = check(args.runs, args.scale)
+    for failure in failures:
+        print('FAIL:', failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+"""Command-line batch simulator: parameter table in, spectra out.
+
+Reads a table of parameter sets (CSV, or Parquet if pyarrow is installed)
+whose column names are a model's entry names (e.g. va, vb, ka, wa, wb, pa
+for dnmr-two-singlets; missing columns take the model defaults), and
+writes one spectrum per row, all on one shared frequency grid:
+
+* .npy output: a float64 array of shape (1 + rows, points); row 0 is the
+  frequency grid and row i + 1 the spectrum for table row i (the same layout
+  as the /api/batch response). Written through a memory map.
+* .parquet output (requires pyarrow): the parameter columns plus an
+  'intensity' list column; the grid is stored in the file metadata under
+  'pydnmr_x' as JSON {"x_min", "x_max", "points"}.
+
+The table is read and evaluated in chunks of rows, with the model's
+vectorized batch function, on a pool of worker processes, and results are
+written as they arrive, so memory use does not grow with the table size.
+
+Usage: python dnmrbatch.py PARAMS OUTPUT [--model NAME] [--points N]
+       [--x-min F --x-max F] [--chunk-rows N] [--workers N]
+"""
+import argparse
+import csv
+import importlib
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from model_definitions import MODELS
+
+
+def read_csv_chunks(path, chunk_rows):
+    """Generate the rows of a CSV file in chunks.
+
+    :return: a generator of {column name: numpy.ndarray} dicts.
+    """
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = [name.strip() for name in next(reader)]
+        rows = []
+        for row in reader:
+            if not row:
+                continue
+            rows.append(row)
+            if len(rows) == chunk_rows:
+                yield _columns(header, rows)
+                rows = []
+        if rows:
+            yield _columns(header, rows)
+
+
+def _columns(header, rows):
+    """Convert a list of CSV rows to {column name: float array}."""
+    try:
+        table = np.array(rows, dtype=float)
+    except ValueError as e:
+        raise ValueError('non-numeric or missing value in table: {}'.format(e))
+    return {name: table[:, i] for i, name in enumerate(header)}
+
+
+def read_parquet_chunks(path, chunk_rows):
+    """Generate the rows of a Parquet file in chunks (requires pyarrow).
+
+    :return: a generator of {column name: numpy.ndarray} dicts.
+    """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+        yield {name: np.asarray(batch.column(i), dtype=float)
+               for i, name in enumerate(batch.schema.names)}
+
+
+def read_chunks(path, chunk_rows):
+    """Generate a parameter table in chunks, choosing the reader by file
+    extension."""
+    if path.endswith('.parquet'):
+        return read_parquet_chunks(path, chunk_rows)
+    return read_csv_chunks(path, chunk_rows)
+
+
+def model_columns(kwargs, table, first_row):
+    """Select and check the model's parameters from a chunk of the table.
+
+    :param kwargs: the model's registry entry (see model_definitions).
+    :param table: ({str: numpy.ndarray}) a chunk of the parameter table.
+    :param first_row: (int) the table row number of the chunk's first row,
+    for error messages.
+    :return: ([numpy.ndarray...]) one array per parameter, in entry_names
+    order.
+    :raises ValueError: for unknown columns or values out of range.
+    """
+    names = kwargs['entry_names']
+    unknown = set(table) - set(names)
+    if unknown:
+        raise ValueError('Unknown column(s) for {}: {}'.format(
+            kwargs['name'], ', '.join(sorted(unknown))))
+    rows = len(next(iter(table.values())))
+    columns = []
+    for name in names:
+        entry = kwargs['entry_dict'][name]
+        column = table.get(name)
+        if column is None:
+            column = np.full(rows, float(entry['value']))
+        bad = ~np.isfinite(column)
+        if 'min' in entry:
+            bad |= column < entry['min']
+        if 'max' in entry:
+            bad |= column > entry['max']
+        if bad.any():
+            row = first_row + int(np.argmax(bad))
+            raise ValueError('row {}: {} = {} is invalid or out of range'
+                             .format(row, name, column[bad][0]))
+        columns.append(column)
+    return columns
+
+
+def table_extent(path, kwargs, chunk_rows):
+    """Read through the table once, checking it, counting its rows and
+    finding the frequency range that covers every row.
+
+    :return: (int, float, float) the number of rows and the left and right
+    limits (with the usual 50 Hz margins).
+    """
+    from dnmrplot import batch_limits
+
+    names = kwargs['entry_names']
+    rows = 0
+    l_limit, r_limit = np.inf, -np.inf
+    for table in read_chunks(path, chunk_rows):
+        columns = model_columns(kwargs, table, rows)
+        rows += len(columns[0])
+        if 'va' in names and 'vb' in names:
+            left, right = batch_limits(columns[names.index('va')],
+                                       columns[names.index('vb')])
+            l_limit, r_limit = min(l_limit, left), max(r_limit, right)
+    return rows, l_limit, r_limit
+
+
+def resolve(reference):
+    """Import a 'module:attribute' reference."""
+    module_name, attribute = reference.split(':')
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def evaluate_chunk(batch_model, grid, columns):
+    """Calculate the spectra for a chunk of rows (runs in a worker process).
+
+    :param batch_model: (str) 'module:attribute' of the batch function.
+    :param grid: (float, float, int) the frequency range and points.
+    :param columns: ([numpy.ndarray...]) the parameters.
+    :return: (numpy.ndarray) a (rows, points) array.
+    """
+    x = np.linspace(*grid)
+    return resolve(batch_model)(x, *columns)
+
+
+def bounded_map(executor, fn, iterable, window):
+    """Like executor.map, but with at most `window` tasks submitted and not
+    yet collected, so that the input is only read as fast as results are
+    used. Results are yielded in input order."""
+    pending = deque()
+    for args in iterable:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class NpyWriter:
+    """Write spectra to a .npy file (row 0: the x grid) through a memory
+    map."""
+    def __init__(self, path, x, rows, kwargs):
+        self.array = np.lib.format.open_memmap(
+            path, mode='w+', dtype='<f8', shape=(1 + rows, len(x)))
+        self.array[0] = x
+        self.row = 1
+
+    def write(self, columns, y):
+        self.array[self.row:self.row + len(y)] = y
+        self.row += len(y)
+
+    def close(self):
+        self.array.flush()
+        del self.array
+
+
+class ParquetWriter:
+    """Write spectra to a Parquet file: parameter columns plus an
+    'intensity' list column (requires pyarrow)."""
+    def __init__(self, path, x, rows, kwargs):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.names = kwargs['entry_names']
+        fields = [pa.field(name, pa.float64()) for name in self.names]
+        fields.append(pa.field('intensity', pa.list_(pa.float64())))
+        grid = {'x_min': float(x[0]), 'x_max': float(x[-1]),
+                'points': len(x)}
+        self.schema = pa.schema(
+            fields, metadata={'pydnmr_x': json.dumps(grid)})
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, columns, y):
+        pa = self.pa
+        points = y.shape[1]
+        offsets = np.arange(0, y.size + 1, points, dtype=np.int32)
+        intensity = pa.ListArray.from_arrays(offsets, y.ravel())
+        arrays = [pa.array(column) for column in columns] + [intensity]
+        self.writer.write_table(pa.Table.from_arrays(arrays,
+                                                     schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def run(args):
+    """Simulate every row of args.params into args.output."""
+    kwargs = MODELS[args.model]
+    if not kwargs.get('batch_model'):
+        raise ValueError('{} has no batch_model'.format(args.model))
+    rows, l_limit, r_limit = table_extent(args.params, kwargs,
+                                          args.chunk_rows)
+    if args.x_min is not None:
+        l_limit = args.x_min
+    if args.x_max is not None:
+        r_limit = args.x_max
+    if not (np.isfinite(l_limit) and np.isfinite(r_limit)):
+        raise ValueError('--x-min and --x-max are required for {}'.format(
+            args.model))
+    grid = (l_limit, r_limit, args.points)
+    x = np.linspace(*grid)
+
+    writer_class = (ParquetWriter if args.output.endswith('.parquet')
+                    else NpyWriter)
+    writer = writer_class(args.output, x, rows, kwargs)
+
+    # parameters of the chunks submitted but not yet written
+    pending_columns = deque()
+
+    def tasks():
+        first_row = 0
+        for table in read_chunks(args.params, args.chunk_rows):
+            columns = model_columns(kwargs, table, first_row)
+            first_row += len(columns[0])
+            pending_columns.append(columns)
+            yield kwargs['batch_model'], grid, columns
+
+    start = time.perf_counter()
+    done = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            for y in bounded_map(executor, evaluate_chunk, tasks(),
+                                 window=2 * args.workers):
+                writer.write(pending_columns.popleft(), y)
+                done += len(y)
+                elapsed = time.perf_counter() - start
+                print('\r{}/{} spectra ({:.0f}/s)'.format(
+                    done, rows, done / elapsed if elapsed else 0),
+                    end='', file=sys.stderr, flush=True)
+    finally:
+        writer.close()
+    print(file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('params', help='parameter table (.csv or .parquet)')
+    parser.add_argument('output', help='output file (.npy or .parquet)')
+    parser.add_argument('--model', default=next(iter(MODELS)),
+                        choices=list(MODELS))
+    parser.add_argument('--points', type=int, default=800)
+    parser.add_argument('--x-min', type=float)
+    parser.add_argument('--x-max', type=float)
+    parser.add_argument('--chunk-rows', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    try:
+        run(args)
+    except (ValueError, ImportError) as e:
+        parser.exit(1, 'error: {}\n'.format(e))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,17 +8,109 @@ the last term is minus-over-plus, not plus-over-minus.)
 """
 
 
+from abc import ABC, abstractmethod
+
 import numpy as np
 
+# Default maximum error (relative to peak height) tolerated when d2s_func
+# substitutes a slow- or fast-exchange limit for the exact lineshape.
+REGIME_TOL = 1e-5
+
+
+LINESHAPE_FORMAT = 1
+
+
+class Lineshape(ABC):
+    """
+    Base class for a lineshape that has been 'compiled' for one set of
+    parameters: the frequency-independent terms are calculated when the
+    object is instantiated, and calling the object with frequencies v returns
+    the intensities at v.
+
+    Lineshapes are plain objects, so they can be pickled (e.g. sent to
+    multiprocessing workers) or cached. Their serialized form (see to_dict)
+    is the parameters plus the precomputed coefficients, tagged with
+    LINESHAPE_FORMAT; lineshape_from_dict rebuilds the object from it without
+    recalculating anything. Pickling uses the same form.
+
+    Subclasses list their parameter names in `parameters`, and the attribute
+    names of their precomputed coefficients in `coefficients`.
+    """
+
+    parameters = ()
+    coefficients = ()
+    _types = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Lineshape._types[cls.__name__] = cls
+
+    @abstractmethod
+    def __call__(self, v):
+        """
+        :param v: frequency (float or numpy array)
+        :return: the intensity at v
+        """
+
+    def to_dict(self):
+        """
+        :return: {'format': int, 'type': str, 'parameters': {str: float},
+        'coefficients': {str: float}}. All values are JSON-serializable.
+        """
+        return {
+            'format': LINESHAPE_FORMAT,
+            'type': type(self).__name__,
+            'parameters': {name: float(getattr(self, name))
+                           for name in self.parameters},
+            'coefficients': {name: float(getattr(self, name))
+                             for name in self.coefficients}
+        }
+
+    def __reduce__(self):
+        return lineshape_from_dict, (self.to_dict(),)
+
+    def __repr__(self):
+        args = ', '.join('{}={!r}'.format(name, getattr(self, name))
+                         for name in self.parameters)
+        return '{}({})'.format(type(self).__name__, args)
 
-class TwoSinglets:
+
+def lineshape_from_dict(data):
+    """
+    Rebuild a Lineshape from the output of its .to_dict(), without
+    recalculating its coefficients.
+    :param data: {'format': int, 'type': str, 'parameters': {},
+    'coefficients': {}}
+    :return: (Lineshape)
+    """
+    if data.get('format') != LINESHAPE_FORMAT:
+        raise ValueError('Unsupported lineshape format: {!r}'.format(
+            data.get('format')))
+    try:
+        cls = Lineshape._types[data['type']]
+    except KeyError:
+        raise ValueError('Unknown lineshape type: {!r}'.format(data['type']))
+    lineshape = cls.__new__(cls)
+    for name in cls.parameters:
+        setattr(lineshape, name, data['parameters'][name])
+    for name in cls.coefficients:
+        setattr(lineshape, name, data['coefficients'][name])
+    return lineshape
+
+
+class TwoSinglets(Lineshape):
     """
     Attempt at using a class instead of separate functions to represent two
     uncoupled spin-1/2 nuclei undergoing exchange.
+    This is the lineshape returned by d2s_func near coalescence, which
+    passes the population of a as a fraction (see from_fraction); it is
+    serialized as the fraction pa.
     """
 
     pi = np.pi
     pi_squared = pi ** 2
+    parameters = ('va', 'vb', 'k', 'wa', 'wb', 'pa')
+    coefficients = ('l_limit', 'r_limit', 'tau', 'Dv', 'P', 'p', 'Q', 'R', 'r')
 
     def __init__(self, va=1, vb=0, k=0.01, wa=0.5, wb=0.5, percent_a=50):
         """
@@ -28,16 +120,31 @@ class TwoSinglets:
         :param k: Rate of nuclear exchange
         :param wa: With at half height for va signal at the slow exchange limit
         :param wb: With at half height for vb signal at the slow exchange limit
-        :param percent_a: Fractional population of state 'a'
+        :param percent_a: Percent population of state 'a'
+        """
+        self._compile(va, vb, k, wa, wb, percent_a / 100)
+
+    @classmethod
+    def from_fraction(cls, va, vb, k, wa, wb, pa):
+        """
+        :param pa: Fractional population of state 'a'; the other arguments
+        are as for TwoSinglets().
+        :return: (TwoSinglets)
         """
+        lineshape = cls.__new__(cls)
+        lineshape._compile(va, vb, k, wa, wb, pa)
+        return lineshape
+
+    def _compile(self, va, vb, k, wa, wb, pa):
         # Idea is to complete the frequency-independent calculations when the
         #  class is instantiated, and thus calculations may be faster.
+        self.va, self.vb, self.k = va, vb, k
+        self.wa, self.wb, self.pa = wa, wb, pa
         self.l_limit = vb - 50
         self.r_limit = va + 50
 
         T2a = 1 / (self.pi * wa)
         T2b = 1 / (self.pi * wb)
-        pa = percent_a / 100
         pb = 1 - pa
         self.tau = pb / k
         dv = va - vb
@@ -50,6 +157,9 @@ class TwoSinglets:
             + self.pi * dv * (pa - pb)
         self.r = 2 * self.pi * (1 + self.tau * ((1 / T2a) + (1 / T2b)))
 
+    def __call__(self, v):
+        return self.intensity(v)
+
     def intensity(self, v):
         """
         Yield a function for the lineshape for TwoSinglets
@@ -121,7 +231,125 @@ def two_spin(v, va, vb, ka, wa, wb, pa):
     return I
 
 
-def d2s_func(va, vb, ka, wa, wb, pa):
+def exchange_regime(va, vb, ka, wa, wb, pa, tol=REGIME_TOL):
+    """
+    Classify a two-site (uncoupled) exchange system as being at the slow
+    exchange limit, the fast exchange limit, or in the intermediate
+    (coalescence) region.
+    The exchange is compared against the complex frequency separation of the
+    two sites, |d| = pi * sqrt(4 * (va - vb) ** 2 + (wa - wb) ** 2). At the
+    slow limit the small parameter is e = (ka + kb) / |d|; at the fast limit
+    it is e = |d| / (ka + kb). In both limits the maximum deviation of the
+    asymptotic lineshape from the exact one, relative to the tallest peak,
+    is < 2e (checked numerically across ~10^4 random parameter sets spanning
+    12 decades of k), so a limit is only reported when 2e <= tol.
+    :param va: The frequency of nucleus 'a' at the slow exchange limit.
+    :param vb: The frequency of nucleus 'b' at the slow exchange limit.
+    :param ka: The rate constant for state a--> state b
+    :param wa: The width at half height of the signal for nucleus a (at the
+    slow exchange limit).
+    :param wb: The width at half height of the signal for nucleus b (at the
+    slow exchange limit).
+    :param pa: The fraction of the population in state a.
+    :param tol: the maximum error (relative to peak height) accepted from an
+    asymptotic lineshape. tol=0 always returns 'intermediate'.
+    :return: (str) 'slow', 'fast' or 'intermediate'
+    """
+    pb = 1 - pa
+    if tol <= 0 or pb <= 0:
+        return 'intermediate'
+    k_sum = ka / pb  # ka + kb
+    d = np.pi * np.hypot(2 * (va - vb), wa - wb)
+    if k_sum * 2 <= tol * d:
+        return 'slow'
+    if d * 2 <= tol * k_sum:
+        return 'fast'
+    return 'intermediate'
+
+
+class TwoSingletsSlowLimit(Lineshape):
+    """
+    The two-singlet lineshape at the slow exchange limit: two Lorentzians at
+    va and vb, each broadened by its rate of leaving the site (k/pi), weighted
+    by population.
+    """
+
+    parameters = ('va', 'vb', 'ka', 'wa', 'wb', 'pa')
+    coefficients = ('ca', 'cb', 'wa_squared', 'wb_squared')
+
+    def __init__(self, va, vb, ka, wa, wb, pa):
+        """
+        Arguments are the same as for d2s_func. ka may be 0.
+        """
+        self.va, self.vb, self.ka = va, vb, ka
+        self.wa, self.wb, self.pa = wa, wb, pa
+        pb = 1 - pa
+        kb = ka * pa / pb
+        _wa = wa + ka / np.pi
+        _wb = wb + kb / np.pi
+        # Each line is p * w / (pi * (4 * (v - v0) ** 2 + w ** 2)), i.e. half a
+        # unit-area Lorentzian, which is the scale of the exact expression.
+        self.ca = pa * _wa / np.pi
+        self.cb = pb * _wb / np.pi
+        self.wa_squared = _wa ** 2
+        self.wb_squared = _wb ** 2
+
+    def __call__(self, v):
+        return (self.ca / (4 * (v - self.va) ** 2 + self.wa_squared)
+                + self.cb / (4 * (v - self.vb) ** 2 + self.wb_squared))
+
+
+class TwoSingletsFastLimit(Lineshape):
+    """
+    The two-singlet lineshape at the fast exchange limit: one Lorentzian at
+    the population-weighted average frequency, with the population-weighted
+    width plus the exchange broadening 4 * pi * pa * pb * (va - vb) ** 2 /
+    (ka + kb).
+    """
+
+    parameters = ('va', 'vb', 'ka', 'wa', 'wb', 'pa')
+    coefficients = ('v0', 'c', 'w_squared')
+
+    def __init__(self, va, vb, ka, wa, wb, pa):
+        """
+        Arguments are the same as for d2s_func.
+        """
+        self.va, self.vb, self.ka = va, vb, ka
+        self.wa, self.wb, self.pa = wa, wb, pa
+        pb = 1 - pa
+        tau = pb / ka  # 1 / (ka + kb)
+        self.v0 = pa * va + pb * vb
+        w = pa * wa + pb * wb + 4 * np.pi * pa * pb * ((va - vb) ** 2) * tau
+        self.c = w / np.pi
+        self.w_squared = w ** 2
+
+    def __call__(self, v):
+        return self.c / (4 * (v - self.v0) ** 2 + self.w_squared)
+
+
+def d2s_slow_limit(va, vb, ka, wa, wb, pa):
+    """
+    Create a function for the two-singlet lineshape at the slow exchange
+    limit (see TwoSingletsSlowLimit).
+    Arguments are the same as for d2s_func. ka may be 0.
+    :return: a function that takes v (x coord or numpy linspace) as an argument
+    and returns intensity (y), on the same scale as d2s_func.
+    """
+    return TwoSingletsSlowLimit(va, vb, ka, wa, wb, pa)
+
+
+def d2s_fast_limit(va, vb, ka, wa, wb, pa):
+    """
+    Create a function for the two-singlet lineshape at the fast exchange
+    limit (see TwoSingletsFastLimit).
+    Arguments are the same as for d2s_func.
+    :return: a function that takes v (x coord or numpy linspace) as an argument
+    and returns intensity (y), on the same scale as d2s_func.
+    """
+    return TwoSingletsFastLimit(va, vb, ka, wa, wb, pa)
+
+
+def d2s_func(va, vb, ka, wa, wb, pa, tol=REGIME_TOL):
     """
     Create a function that requires only frequency as an argurment, and used to
     calculate intensities across array of frequencies in the DNMR
@@ -130,8 +358,8 @@ def d2s_func(va, vb, ka, wa, wb, pa):
     that are independant of frequency only once, and then use them in a new
     function that depends only on v. This would avoid unneccessarily
     repeating some of the same operations.
-    This function-within-a-function should be refactored to
-    function-within-class!
+    The function returned is a Lineshape object (TwoSinglets, or one of the
+    exchange-limit classes), so it can be pickled or serialized.
     :param va: The frequency of nucleus 'a' at the slow exchange limit. va > vb
     :param vb: The frequency of nucleus 'b' at the slow exchange limit. vb < va
     :param ka: The rate constant for state a--> state b
@@ -142,47 +370,215 @@ def d2s_func(va, vb, ka, wa, wb, pa):
     :param pa: The fraction of the population in state a.
     :param pa: fraction of population in state a
     wa, wb: peak widths at half height (slow exchange), used to calculate T2s
+    :param tol: the error (relative to peak height) allowed for substituting
+    the slow- or fast-exchange limit lineshape (see exchange_regime). Use
+    tol=0 to always use the exact expression.
     returns: a function that takes v (x coord or numpy linspace) as an argument
     and returns intensity (y).
     """
+    # Far from coalescence the exact expression is mostly cancelling terms
+    # (and overflows for tiny ka), so use the limiting closed forms there.
+    regime = exchange_regime(va, vb, ka, wa, wb, pa, tol)
+    if regime == 'slow':
+        return d2s_slow_limit(va, vb, ka, wa, wb, pa)
+    if regime == 'fast':
+        return d2s_fast_limit(va, vb, ka, wa, wb, pa)
+
+    return TwoSinglets.from_fraction(va, vb, ka, wa, wb, pa)
+
+
+def _batch_args(*params):
+    """Broadcast parameters to 1-D float arrays of a common length."""
+    return [np.atleast_1d(np.asarray(p, dtype=float))
+            for p in np.broadcast_arrays(*params)]
+
+
+def d2s_batch(v, va, vb, ka, wa, wb, pa, tol=REGIME_TOL):
+    """
+    Vectorized d2s_func: calculate the spectra for many parameter sets over
+    the same frequencies in one set of array operations. Each parameter set
+    uses the same exchange-regime choice as d2s_func.
+    :param v: 1-D numpy array of n frequencies, or an (m, n) array holding a
+    separate grid for each parameter set.
+    :param va, vb, ka, wa, wb, pa: 1-D arrays (or scalars) of the parameters,
+    as for d2s_func, broadcast to a common length m.
+    :param tol: see d2s_func.
+    :return: (m, n) numpy array; row i is d2s_func(va[i], ...)(v) (or
+    (v[i])).
+    """
+    v = np.asarray(v, dtype=float)
+    va, vb, ka, wa, wb, pa = _batch_args(va, vb, ka, wa, wb, pa)
+    pb = 1 - pa
+    # same criteria as exchange_regime
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k_sum = ka / pb
+        d = np.pi * np.hypot(2 * (va - vb), wa - wb)
+        usable = (pb > 0) if tol > 0 else np.zeros(len(pa), dtype=bool)
+        slow = usable & (k_sum * 2 <= tol * d)
+        fast = usable & ~slow & (d * 2 <= tol * k_sum)
+    exact = ~(slow | fast)
+
+    y = np.empty((len(va), v.shape[-1]))
+    for rows, lineshape in ((slow, TwoSingletsSlowLimit),
+                            (fast, TwoSingletsFastLimit),
+                            (exact, None)):
+        if not rows.any():
+            continue
+        # column vectors, so that the expressions broadcast against v
+        args = [p[rows, np.newaxis] for p in (va, vb, ka, wa, wb, pa)]
+        v_rows = v if v.ndim == 1 else v[rows]
+        if lineshape is None:
+            y[rows] = two_spin(v_rows, *args)
+        else:
+            y[rows] = lineshape(*args)(v_rows)
+    return y
+
+
+class TwoSingletsEvaluator:
+    """
+    Stateful version of d2s_func for repeated evaluation over the same
+    frequency grid, where usually only one parameter changes per call (e.g.
+    ka being dragged in the web app, or varied by a fitting routine).
 
-    # TODO: factor pis out; redo comments to explain excision of v-independent
-    # terms
+    The exact expression is regrouped so that each array term depends on as
+    few parameters as possible, and each group is only recomputed when one
+    of its parameters changes:
+    * grid (v, va, vb): _Dv = Dv - v, and 4 * pi^2 * _Dv^2
+    * widths (+ wa, wb): the tau coefficients of P and R
+    * populations (+ pa): the constant terms of Q and R
+    Only the final combination with tau (i.e. ka) is redone on every call,
+    into preallocated buffers. Repeating the previous call returns a cached
+    result.
+    """
 
     pi = np.pi
     pi_squared = pi ** 2
-    T2a = 1 / (pi * wa)
-    T2b = 1 / (pi * wb)
-    pb = 1 - pa
-    tau = pb / ka
-    dv = va - vb
-    Dv = (va + vb) / 2
-    P = tau * (1 / (T2a * T2b) + pi_squared * (dv ** 2)) + (pa / T2a + pb / T2b)
-    p = 1 + tau * ((pb / T2a) + (pa / T2b))
-    Q = tau * (- pi * dv * (pa - pb))
-    R = pi * dv * tau * ((1 / T2b) - (1 / T2a)) + pi * dv * (pa - pb)
-    r = 2 * pi * (1 + tau * ((1 / T2a) + (1 / T2b)))
 
-    def maker(v):
+    def __init__(self, tol=REGIME_TOL):
         """
-        Scheduled for refactoring.
-        :param v: frequency
-        :return: function that calculates the intensity at v
+        :param tol: passed to exchange_regime, to decide when to use the slow-
+        or fast-exchange limit lineshapes.
         """
-        # TODO: fix docstring, explain _P _Q etc correlate to P, Q etc in lit.
-        # FIXED: previous version of this function used
-        # nonlocal Dv, P, Q, R
-        # but apparently when function called repeatedly these values would
-        # become corrupted (turning into arrays?!)
-        # Solution: add underscores to create copies of any variables in
-        # outer scope whose values are changed in the inner scope.
+        self.tol = tol
+        self._v = None
+        self._key = {}
+        self._y = None
+
+    def _changed(self, level, *params):
+        """Return True (and remember params) if params differ from those last
+        used for the named cache level."""
+        if self._key.get(level) == params:
+            return False
+        self._key[level] = params
+        return True
 
-        _Dv = Dv - v
-        _P = P - tau * 4 * pi_squared * (_Dv ** 2)
-        _Q = Q + tau * 2 * pi * _Dv
-        _R = R + _Dv * r
-        return(_P * p + _Q * _R) / (_P ** 2 + _R ** 2)
-    return maker
+    def _set_grid(self, v):
+        """Adopt v as the frequency grid, invalidating all caches if it is
+        different from the current grid."""
+        if v is self._v:
+            return
+        if (self._v is not None and v.shape == self._v.shape
+                and np.array_equal(v, self._v)):
+            return
+        self._v = np.array(v, dtype=float)
+        self._key = {}
+        self._y = None
+        shape = self._v.shape
+        self._P = np.empty(shape)
+        self._Q = np.empty(shape)
+        self._R = np.empty(shape)
+        self._N = np.empty(shape)
+
+    def __call__(self, v, va, vb, ka, wa, wb, pa):
+        """
+        Calculate the intensities across the frequencies v.
+        Parameters are the same as for d2s_func.
+        :param v: numpy array of frequencies.
+        :return: numpy array of intensities. A new array is returned, except
+        when the arguments are identical to the previous call, in which case
+        the previous array is returned.
+        """
+        self._set_grid(v)
+        params = (va, vb, ka, wa, wb, pa)
+        if self._y is not None and self._key.get('all') == params:
+            return self._y
+        regime = exchange_regime(va, vb, ka, wa, wb, pa, self.tol)
+        if regime == 'slow':
+            y = self._slow(va, vb, ka, wa, wb, pa)
+        elif regime == 'fast':
+            y = self._fast(va, vb, ka, wa, wb, pa)
+        else:
+            y = self._exact(va, vb, ka, wa, wb, pa)
+        self._key['all'] = params
+        self._y = y
+        return y
+
+    def _exact(self, va, vb, ka, wa, wb, pa):
+        """The d2s_func expression, with
+        P = tau * Pu + B, Q = tau * Qu, R = Ru + tau * Rt
+        where Pu, Qu, Ru and Rt are cached arrays."""
+        pi = self.pi
+        v = self._v
+        T2a = 1 / (pi * wa)
+        T2b = 1 / (pi * wb)
+        pb = 1 - pa
+        tau = pb / ka
+        dv = va - vb
+
+        if self._changed('grid', va, vb):
+            self._Dv = (va + vb) / 2 - v
+            self._Dv_squared = 4 * self.pi_squared * (self._Dv ** 2)
+            self._key.pop('widths', None)
+            self._key.pop('populations', None)
+        if self._changed('widths', wa, wb):
+            self._Pu = ((1 / (T2a * T2b) + self.pi_squared * (dv ** 2))
+                        - self._Dv_squared)
+            self._Rt = 2 * pi * ((1 / T2a) + (1 / T2b)) * self._Dv
+            self._Rt += pi * dv * ((1 / T2b) - (1 / T2a))
+        if self._changed('populations', pa):
+            self._Qu = 2 * pi * self._Dv - pi * dv * (pa - pb)
+            self._Ru = 2 * pi * self._Dv + pi * dv * (pa - pb)
+
+        P, Q, R, N = self._P, self._Q, self._R, self._N
+        np.multiply(self._Pu, tau, out=P)
+        P += pa / T2a + pb / T2b
+        np.multiply(self._Qu, tau, out=Q)
+        np.multiply(self._Rt, tau, out=R)
+        R += self._Ru
+        p = 1 + tau * ((pb / T2a) + (pa / T2b))
+
+        np.multiply(P, p, out=N)
+        Q *= R
+        N += Q
+        P *= P
+        R *= R
+        P += R
+        return N / P
+
+    def _slow(self, va, vb, ka, wa, wb, pa):
+        """d2s_slow_limit, with 4 * (v - va) ** 2 and 4 * (v - vb) ** 2
+        cached."""
+        if self._changed('slow grid', va, vb):
+            self._da_squared = 4 * (self._v - va) ** 2
+            self._db_squared = 4 * (self._v - vb) ** 2
+        pb = 1 - pa
+        _wa = wa + ka / self.pi
+        _wb = wb + (ka * pa / pb) / self.pi
+        P, R = self._P, self._R
+        np.add(self._da_squared, _wa ** 2, out=P)
+        np.divide(pa * _wa / self.pi, P, out=P)
+        np.add(self._db_squared, _wb ** 2, out=R)
+        np.divide(pb * _wb / self.pi, R, out=R)
+        return P + R
+
+    def _fast(self, va, vb, ka, wa, wb, pa):
+        """d2s_fast_limit, with 4 * (v - v0) ** 2 cached."""
+        pb = 1 - pa
+        if self._changed('fast grid', va, vb, pa):
+            self._d0_squared = 4 * (self._v - (pa * va + pb * vb)) ** 2
+        tau = pb / ka
+        w = pa * wa + pb * wb + 4 * self.pi * pa * pb * ((va - vb) ** 2) * tau
+        return (w / self.pi) / (self._d0_squared + w ** 2)
 
 
 # noinspection PyPep8Naming
@@ -232,4 +628,77 @@ def dnmr_AB(v, v1, v2, J, k, w):
     d2 = a_minus ** 2 + b_minus ** 2
 
     I = (n1 / d1) + (n2 / d2)
-    return I
\ No newline at end of file
+    return I
+
+
+class ABQuartet(Lineshape):
+    """
+    The dnmr_AB lineshape, with the frequency-independent terms calculated
+    once on instantiation.
+    """
+
+    pi = np.pi
+    parameters = ('v1', 'v2', 'J', 'k', 'w')
+    coefficients = ('vo', 'a_const', 'b_slope', 'b_const', 's')
+
+    def __init__(self, v1, v2, J, k, w):
+        """
+        Arguments are the same as for dnmr_AB.
+        """
+        pi = self.pi
+        self.v1, self.v2, self.J, self.k, self.w = v1, v2, J, k, w
+        self.vo = (v1 + v2) / 2
+        tau = 1 / k
+        tau2 = 1 / (pi * w)
+        # a2 + a3 + a4 of dnmr_AB
+        self.a_const = (- ((1 / tau) + (1 / tau2)) ** 2
+                        - pi ** 2 * (v1 - v2) ** 2
+                        - pi ** 2 * J ** 2 + (1 / tau ** 2))
+        self.b_slope = 4 * pi * ((1 / tau) + (1 / tau2))
+        self.b_const = 2 * pi * J / tau
+        self.s = (2 / tau) + (1 / tau2)
+
+    def __call__(self, v):
+        pi = self.pi
+        J = self.J
+        x_plus = self.vo - v + J / 2
+        x_minus = self.vo - v - J / 2
+        a_plus = 4 * pi ** 2 * x_plus ** 2 + self.a_const
+        a_minus = 4 * pi ** 2 * x_minus ** 2 + self.a_const
+        b_plus = self.b_slope * x_plus - self.b_const
+        b_minus = self.b_slope * x_minus + self.b_const
+        r_plus = 2 * pi * (self.vo - v + J)
+        r_minus = 2 * pi * (self.vo - v - J)
+
+        n1 = r_plus * b_plus - self.s * a_plus
+        d1 = a_plus ** 2 + b_plus ** 2
+        n2 = r_minus * b_minus - self.s * a_minus
+        d2 = a_minus ** 2 + b_minus ** 2
+
+        return (n1 / d1) + (n2 / d2)
+
+
+def dab_func(v1, v2, J, k, w):
+    """
+    Create a function of frequency only for the DNMR spectrum of two coupled
+    spin-1/2 nuclei (see dnmr_AB for the arguments).
+    :return: (ABQuartet) a picklable Lineshape that takes v (x coord or numpy
+    linspace) as an argument and returns intensity (y).
+    """
+    return ABQuartet(v1, v2, J, k, w)
+
+
+def dab_batch(v, v1, v2, J, k, w):
+    """
+    Vectorized dab_func: calculate the spectra for many parameter sets over
+    the same frequencies in one set of array operations.
+    :param v: 1-D numpy array of n frequencies, or an (m, n) array holding a
+    separate grid for each parameter set.
+    :param v1, v2, J, k, w: 1-D arrays (or scalars) of the parameters, as for
+    dnmr_AB, broadcast to a common length m.
+    :return: (m, n) numpy array; row i is dab_func(v1[i], ...)(v) (or
+    (v[i])).
+    """
+    v = np.asarray(v, dtype=float)
+    args = [p[:, np.newaxis] for p in _batch_args(v1, v2, J, k, w)]
+    return ABQuartet(*args)(v)
@@ -3,14 +3,54 @@ dnmrplot provides interfaces with the dnmrmath model that return simulation
 data in a format suitable for plotting.
 """
 
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
-from dnmrmath import dnmr_AB, d2s_func  # , TwoSinglets
+from dnmrmath import (d2s_batch, d2s_func, dab_batch, dab_func,
+                      TwoSingletsEvaluator)
 
 # TODO: dnmrplot prefix is redundant. Consider refactor.
 
+# Default number of points per chunk for evaluate_chunked. The lineshapes
+# create ~10 temporaries per chunk, so 2**14 float64 points keeps a chunk's
+# working set (~1.3 MB) within a typical per-core L2 cache.
+CHUNK_SIZE = 2 ** 14
+
 
-def dnmrplot_2spin(va, vb, k, wa, wb, percent_a):
+def evaluate_chunked(lineshape, x, threads=1, chunk_size=CHUNK_SIZE):
+    """
+    Evaluate lineshape(x) in chunks of x, writing into one preallocated
+    array, so that the temporary arrays are chunk-sized rather than x-sized.
+    With threads > 1 the chunks are evaluated on a thread pool (numpy
+    releases the GIL during the array arithmetic).
+    :param lineshape: a function of frequency (e.g. a dnmrmath.Lineshape).
+    :param x: (numpy.ndarray) the 1-D array of frequencies.
+    :param threads: (int) the number of worker threads.
+    :param chunk_size: (int) the number of points per chunk.
+    :return: (numpy.ndarray) the intensities at x.
+    """
+    y = np.empty_like(x, dtype=float)
+    starts = range(0, len(x), chunk_size)
+
+    def evaluate(start):
+        stop = start + chunk_size
+        y[start:stop] = lineshape(x[start:stop])
+
+    if threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # list() re-raises any exception from the workers
+            list(executor.map(evaluate, starts))
+    else:
+        for start in starts:
+            evaluate(start)
+    return y
+
+
+def dnmrplot_2spin(va, vb, k, wa, wb, percent_a, points=800, threads=1,
+                   chunk_size=CHUNK_SIZE):
     """
     Creates the spectrum data using the function nmrmath.d2s_func.
     :param va: The frequency of nucleus 'a' at the slow exchange limit
@@ -21,9 +61,13 @@ def dnmrplot_2spin(va, vb, k, wa, wb, percent_a):
     :param wb: The width at half heigh of the signal for nucleus b (at the slow
     exchange limit).
     :param percent_a: The fraction of the population in state a (vs. state b)
+    :param points: The number of data points.
+    :param threads: The number of threads to evaluate the spectrum with (see
+    evaluate_chunked). Only worthwhile for ~10^6 points or more.
+    :param chunk_size: The number of points per chunk if threads > 1.
     :return: a tuple of numpy arrays for frequencies (x coordinate) and
-    corresponding intensities (y coordinate). Hard-coded for 800 data points
-    and a frequency range from vb-50 to va+50.
+    corresponding intensities (y coordinate), for a frequency range from
+    vb-50 to va+50.
     """
 
     if vb > va:
@@ -32,25 +76,104 @@ def dnmrplot_2spin(va, vb, k, wa, wb, percent_a):
         percent_a = 100 - percent_a
     l_limit = vb - 50
     r_limit = va + 50
-    x = np.linspace(l_limit, r_limit, 800)
+    x = np.linspace(l_limit, r_limit, points)
 
     dfunc = d2s_func(va, vb, k, wa, wb, percent_a / 100)
-    y = dfunc(x)
+    if threads > 1:
+        y = evaluate_chunked(dfunc, x, threads, chunk_size)
+    else:
+        y = dfunc(x)
 
     return x, y
 
 
-def dnmrplot_AB(va, vb, j_ab, k_ab, wa):
+class DnmrPlot2Spin:
+    """
+    A drop-in replacement for dnmrplot_2spin for repeated calls (the web app,
+    fitting). Each thread keeps a few dnmrmath.TwoSingletsEvaluators, keyed
+    on the parameters other than k and percent_a, so that calls changing
+    only those reuse the frequency grid and the parameter-independent parts
+    of the calculation. An evaluator is only made when its key is seen a
+    second time; until then a call is the same calculation as
+    dnmrplot_2spin. Threads share no state, so an instance can be shared
+    between threads without serializing them.
+    """
+
+    # Evaluators kept per thread: at most cache_size, with at most
+    # cache_points points between them (but always the latest one).
+    cache_size = 16
+    cache_points = 2 ** 20
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def __reduce__(self):
+        # The caches are per-thread; a copy starts empty.
+        return DnmrPlot2Spin, ()
+
+    def __call__(self, va, vb, k, wa, wb, percent_a, points=800, threads=1,
+                 chunk_size=CHUNK_SIZE):
+        """
+        Same arguments and return value as dnmrplot_2spin. The x array is
+        shared between calls with the same va, vb, wa, wb and points, and is
+        read-only. With threads > 1 the call is passed on to dnmrplot_2spin,
+        whose chunked evaluation the evaluators' whole-grid buffers cannot
+        share.
+        """
+        if threads > 1:
+            return dnmrplot_2spin(va, vb, k, wa, wb, percent_a, points,
+                                  threads, chunk_size)
+        if vb > va:
+            va, vb = vb, va
+            wa, wb = wb, wa
+            percent_a = 100 - percent_a
+        key = (va, vb, wa, wb, points)
+        cache = self._cache()
+        entry = cache.get(key)
+        if entry is None:
+            x = np.linspace(vb - 50, va + 50, points)
+            x.flags.writeable = False
+            self._store(cache, key, [x, None])
+            return x, d2s_func(va, vb, k, wa, wb, percent_a / 100)(x)
+        cache.move_to_end(key)
+        x, evaluator = entry
+        if evaluator is None:
+            evaluator = entry[1] = TwoSingletsEvaluator()
+        return x, evaluator(x, va, vb, k, wa, wb, percent_a / 100)
+
+    def _cache(self):
+        """:return: (OrderedDict) this thread's {key: [x, evaluator]},
+        least recently used first."""
+        try:
+            return self._local.cache
+        except AttributeError:
+            self._local.cache = OrderedDict()
+            return self._local.cache
+
+    def _store(self, cache, key, entry):
+        cache[key] = entry
+        while len(cache) > 1 and (
+                len(cache) > self.cache_size
+                or sum(cached[-1] for cached in cache) > self.cache_points):
+            cache.popitem(last=False)
+
+
+def dnmrplot_AB(va, vb, j_ab, k_ab, wa, points=800, threads=1,
+                chunk_size=CHUNK_SIZE):
     """
-    Creates the spectrum data using the function nmrmath.dnmr_AB.
+    Creates the spectrum data using the function nmrmath.dab_func.
     :param va: The frequency of nucleus 'a' at the slow exchange limit
     :param vb: The frequency of nucleus 'b' at the slow exchange limit
     :param j_ab: The coupling constant between nuclei a and b
     :param k_ab: The rate of two-site exchange of nuclei a and b
     :param wa: The line width at the slow exchange limit
+    :param points: The number of data points.
+    :param threads: The number of threads to evaluate the spectrum with (see
+    evaluate_chunked). Only worthwhile for ~10^6 points or more.
+    :param chunk_size: The number of points per chunk if threads > 1.
     :return: a tuple of numpy arrays for frequencies (x coordinate) and
-    corresponding intensities (y coordinate). Hard-coded for 800 data points
-    and a frequency range from vb-50 to va+50.
+    corresponding intensities (y coordinate), for a frequency range from
+    vb-50 to va+50.
     """
 
     if vb > va:
@@ -58,6 +181,183 @@ def dnmrplot_AB(va, vb, j_ab, k_ab, wa):
 
     l_limit = vb - 50
     r_limit = va + 50
-    x = np.linspace(l_limit, r_limit, 800)
-    y = dnmr_AB(x, va, vb, j_ab, k_ab, wa)
+    x = np.linspace(l_limit, r_limit, points)
+    dfunc = dab_func(va, vb, j_ab, k_ab, wa)
+    if threads > 1:
+        y = evaluate_chunked(dfunc, x, threads, chunk_size)
+    else:
+        y = dfunc(x)
     return x, y
+
+
+def lineshape_2spin(va, vb, k, wa, wb, percent_a):
+    """
+    The compiled lineshape that dnmrplot_2spin evaluates, for evaluating the
+    same spectrum over other frequencies (e.g. a zoomed-in window).
+    Arguments are the same as for dnmrplot_2spin.
+    :return: (dnmrmath.Lineshape) a function of frequency.
+    """
+    if vb > va:
+        va, vb = vb, va
+        wa, wb = wb, wa
+        percent_a = 100 - percent_a
+    return d2s_func(va, vb, k, wa, wb, percent_a / 100)
+
+
+def lineshape_AB(va, vb, j_ab, k_ab, wa):
+    """
+    The compiled lineshape that dnmrplot_AB evaluates. Arguments are the
+    same as for dnmrplot_AB.
+    :return: (dnmrmath.Lineshape) a function of frequency.
+    """
+    if vb > va:
+        va, vb = vb, va  # dnmr_AB requires va > vb
+    return dab_func(va, vb, j_ab, k_ab, wa)
+
+
+def linspace_chunks(start, stop, points, chunk_size=CHUNK_SIZE):
+    """
+    Generate np.linspace(start, stop, points) in consecutive pieces of
+    chunk_size points, without creating the whole array.
+    :return: a generator of numpy arrays.
+    """
+    step = (stop - start) / (points - 1) if points > 1 else 0.0
+    for first in range(0, points, chunk_size):
+        last = min(first + chunk_size, points)
+        # same arithmetic as np.linspace, so the values are identical
+        x = np.arange(first, last, dtype=float) * step
+        x += start
+        if last == points and points > 1:
+            x[-1] = stop
+        yield x
+
+
+def iter_spectrum(lineshape, l_limit, r_limit, points, chunk_size=CHUNK_SIZE):
+    """
+    Generate a spectrum in pieces, so that memory use depends on chunk_size
+    and not on the total number of points.
+    :param lineshape: a function of frequency (e.g. a dnmrmath.Lineshape).
+    :param l_limit: the first frequency.
+    :param r_limit: the last frequency.
+    :param points: the total number of points.
+    :param chunk_size: the number of points per piece.
+    :return: a generator of (x_chunk, y_chunk) tuples of numpy arrays.
+    """
+    for x in linspace_chunks(l_limit, r_limit, points, chunk_size):
+        yield x, lineshape(x)
+
+
+def dnmrplot_2spin_chunks(va, vb, k, wa, wb, percent_a, points=800,
+                          chunk_size=CHUNK_SIZE):
+    """
+    Streaming version of dnmrplot_2spin, for spectra too large to hold in
+    memory. Arguments are the same as for dnmrplot_2spin.
+    :return: a generator of (x_chunk, y_chunk) tuples; concatenated, they are
+    equal to the arrays returned by dnmrplot_2spin.
+    """
+    dfunc = lineshape_2spin(va, vb, k, wa, wb, percent_a)
+    return iter_spectrum(dfunc, min(va, vb) - 50, max(va, vb) + 50, points,
+                         chunk_size)
+
+
+def dnmrplot_AB_chunks(va, vb, j_ab, k_ab, wa, points=800,
+                       chunk_size=CHUNK_SIZE):
+    """
+    Streaming version of dnmrplot_AB, for spectra too large to hold in
+    memory. Arguments are the same as for dnmrplot_AB.
+    :return: a generator of (x_chunk, y_chunk) tuples; concatenated, they are
+    equal to the arrays returned by dnmrplot_AB.
+    """
+    dfunc = lineshape_AB(va, vb, j_ab, k_ab, wa)
+    return iter_spectrum(dfunc, min(va, vb) - 50, max(va, vb) + 50, points,
+                         chunk_size)
+
+
+def batch_limits(va, vb):
+    """
+    The frequency range covering every spectrum in a batch, with the same
+    50 Hz margins as dnmrplot_2spin and dnmrplot_AB.
+    :param va, vb: arrays of the va and vb parameters of the batch.
+    :return: (float, float) the left and right limits.
+    """
+    return (float(np.minimum(va, vb).min()) - 50,
+            float(np.maximum(va, vb).max()) + 50)
+
+
+def dnmrplot_grids(va, vb, *params, points=800):
+    """
+    The frequency grid that dnmrplot_2spin / dnmrplot_AB would use for each
+    of a batch of parameter sets.
+    :param va, vb: arrays of the va and vb parameters of the batch.
+    :param params: the remaining parameters (ignored), so that the function
+    can be called with every parameter column of either model.
+    :param points: The number of data points per grid.
+    :return: (m, points) numpy array; row i is the grid for set i.
+    """
+    va, vb = np.broadcast_arrays(np.atleast_1d(va), np.atleast_1d(vb))
+    return np.linspace(np.minimum(va, vb) - 50, np.maximum(va, vb) + 50,
+                       points, axis=1)
+
+
+def dnmrplot_2spin_batch(x, va, vb, k, wa, wb, percent_a):
+    """
+    Vectorized dnmrplot_2spin for many parameter sets over a shared frequency
+    grid, using dnmrmath.d2s_batch.
+    :param x: 1-D numpy array of n frequencies (see batch_limits), or an
+    (m, n) array of one grid per parameter set (see dnmrplot_grids).
+    :param va, vb, k, wa, wb, percent_a: 1-D arrays (or scalars) of the
+    parameters, as for dnmrplot_2spin, broadcast to a common length m.
+    :return: (m, n) numpy array of intensities.
+    """
+    va, vb, k, wa, wb, percent_a = np.broadcast_arrays(
+        va, vb, k, wa, wb, percent_a)
+    swap = vb > va
+    va, vb = np.where(swap, vb, va), np.where(swap, va, vb)
+    wa, wb = np.where(swap, wb, wa), np.where(swap, wa, wb)
+    percent_a = np.where(swap, 100 - percent_a, percent_a)
+    return d2s_batch(x, va, vb, k, wa, wb, percent_a / 100)
+
+
+def dnmrplot_AB_batch(x, va, vb, j_ab, k_ab, wa):
+    """
+    Vectorized dnmrplot_AB for many parameter sets over a shared frequency
+    grid, using dnmrmath.dab_batch.
+    :param x: 1-D numpy array of n frequencies (see batch_limits), or an
+    (m, n) array of one grid per parameter set (see dnmrplot_grids).
+    :param va, vb, j_ab, k_ab, wa: 1-D arrays (or scalars) of the parameters,
+    as for dnmrplot_AB, broadcast to a common length m.
+    :return: (m, n) numpy array of intensities.
+    """
+    va, vb = np.broadcast_arrays(va, vb)
+    # dnmr_AB requires va > vb
+    return dab_batch(x, np.maximum(va, vb), np.minimum(va, vb), j_ab, k_ab, wa)
+
+
+def downsample_minmax(x, y, buckets):
+    """
+    Reduce a spectrum to the points needed to draw it at a given width,
+    keeping its shape: the data is split into `buckets` runs of consecutive
+    points (one per pixel, say), and only the lowest and highest point of
+    each run is kept, so that no peak is clipped.
+    :param x, y: 1-D numpy arrays of the spectrum.
+    :param buckets: (int) the number of runs.
+    :return: (numpy.ndarray, numpy.ndarray) x and y of the kept points, in
+    their original order (at most 2 * buckets + 2); x and y themselves if
+    they are no longer than that.
+    """
+    n = len(y)
+    if n <= 2 * buckets + 2:
+        return x, y
+    size = -(-n // buckets)  # ceil(n / buckets)
+    rows = -(-n // size)
+    # pad the last run with its final value, so y reshapes to (rows, size)
+    padded = np.empty(rows * size)
+    padded[:n] = y
+    padded[n:] = y[-1]
+    padded = padded.reshape(rows, size)
+    starts = np.arange(rows) * size
+    keep = np.concatenate([[0, n - 1],
+                           starts + padded.argmin(axis=1),
+                           starts + padded.argmax(axis=1)])
+    keep = np.unique(np.minimum(keep, n - 1))
+    return x[keep], y[keep]
@@ -0,0 +1,455 @@
+"""Measured spectra: reading uploaded files, and overlaying them on the
+simulations.
+
+Provides the following:
+*read_spectrum(): parse a spectrum file (CSV/text, JCAMP-DX, .npy or raw
+float64 pairs) from a binary stream, a block of lines at a time, with at
+most MAX_POINTS points.
+*resample(): put a spectrum on a uniform grid, averaging (dense data) or
+interpolating (sparse data).
+*Spectrum: a parsed spectrum, sorted by frequency.
+*decode_upload(): parse the contents of a dcc.Upload (a base64 data URL).
+*UploadPanel: the upload widget, and the callback that parses an upload and
+hands a display-sized copy to the browser (a dcc.Store), where each model's
+graph overlays it (see BaseDashModel.register_callback).
+
+The server keeps nothing: the full upload stays in the browser (the
+dcc.Upload's contents), which sends it again with each fit request (see
+fitjobs.py), so any worker process can serve any request.
+
+Supported formats, detected from the content (then the file name):
+* .npy: a float array of shape (2, n) or (n, 2) (x, y), e.g. from
+  /api/spectrum?format=npy.
+* JCAMP-DX (a file starting with '##'): ##XYDATA=(X++(Y..Y)) in AFFN or
+  ASDF (SQZ/DIF/DUP) compression, or ##XYPOINTS=(XY..XY).
+* CSV or whitespace-separated text: the first two columns are x and y;
+  header and comment lines are skipped.
+* anything else (e.g. .bin): raw little-endian float64 (x, y) pairs.
+"""
+import base64
+import io
+import re
+
+import numpy as np
+import dash_core_components as dcc
+import dash_html_components as html
+from dash.dependencies import Input, Output, State
+
+# Upper limits on a spectrum's points, and on an upload's size in bytes
+MAX_POINTS = 2 ** 21
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+# Bytes (binary formats) or lines (text formats) parsed at a time
+BLOCK_BYTES = 2 ** 20
+BLOCK_LINES = 2 ** 14
+# Points of the copy sent to the browser
+DISPLAY_POINTS = 2000
+
+
+class Spectrum:
+    """A measured spectrum.
+
+    Has the following attributes:
+    * name: (str) the file name.
+    * x, y: (numpy.ndarray) the frequencies (ascending) and intensities.
+    """
+    def __init__(self, name, x, y):
+        order = np.argsort(x, kind='stable')
+        self.name = name
+        self.x = np.ascontiguousarray(x[order], dtype=float)
+        self.y = np.ascontiguousarray(y[order], dtype=float)
+
+    def __len__(self):
+        return len(self.x)
+
+
+class _Collector:
+    """Accumulates parsed blocks, enforcing MAX_POINTS."""
+    def __init__(self, max_points):
+        self.max_points = max_points
+        self.blocks = []
+        self.points = 0
+
+    def add(self, block):
+        self.points += len(block)
+        if self.points > self.max_points:
+            raise ValueError('more than {} points'.format(self.max_points))
+        self.blocks.append(np.asarray(block, dtype=float))
+
+    def array(self):
+        if not self.blocks:
+            return np.empty(0)
+        return np.concatenate(self.blocks)
+
+
+def read_spectrum(stream, name='', max_points=MAX_POINTS):
+    """Parse a spectrum file, choosing the format from its first bytes (and
+    then the file name).
+
+    :param stream: a binary file-like object, read from its current position
+    to the end.
+    :param name: (str) the file name.
+    :param max_points: (int) the most points accepted.
+    :return: (Spectrum)
+    :raises ValueError: if the file cannot be parsed, or is too large.
+    """
+    stream = io.BufferedReader(stream) if not hasattr(stream, 'peek') \
+        else stream
+    start = stream.peek(16)[:16]
+    extension = name.lower().rsplit('.', 1)[-1] if '.' in name else ''
+    if start.startswith(b'\x93NUMPY'):
+        x, y = _read_npy(stream, max_points)
+    elif start.lstrip().startswith(b'##'):
+        x, y = _read_jcamp(_lines(stream), max_points)
+    elif extension in ('bin', 'raw', 'f64', 'dat') and not _is_text(start):
+        x, y = _read_raw(stream, max_points)
+    else:
+        x, y = _read_text(_lines(stream), max_points)
+    if len(x) < 2:
+        raise ValueError('{}: no data found'.format(name or 'file'))
+    if not (np.isfinite(x).all() and np.isfinite(y).all()):
+        raise ValueError('{}: non-finite values'.format(name or 'file'))
+    return Spectrum(name, x, y)
+
+
+def decode_upload(contents, filename=''):
+    """Parse an uploaded spectrum.
+
+    :param contents: (str) a dcc.Upload's contents: a data URL holding the
+    file in base64.
+    :param filename: (str) the file name.
+    :return: (Spectrum)
+    :raises ValueError: if the upload is larger than MAX_UPLOAD_BYTES, or
+    cannot be parsed.
+    """
+    start = contents.find(',') + 1
+    if not start:
+        raise ValueError('not a data URL')
+    # checked before decoding: base64 takes 4 characters per 3 bytes
+    if len(contents) - start > 4 * -(-MAX_UPLOAD_BYTES // 3):
+        raise ValueError('larger than {} MB'.format(
+            MAX_UPLOAD_BYTES // 2 ** 20))
+    data = base64.b64decode(contents[start:])
+    return read_spectrum(io.BytesIO(data), filename)
+
+
+def _is_text(data):
+    return all(32 <= c < 127 or c in b'\t\r\n' for c in data)
+
+
+def _lines(stream):
+    """Generate the decoded lines of a binary stream."""
+    return io.TextIOWrapper(stream, encoding='latin-1', newline=None)
+
+
+def _read_npy(stream, max_points):
+    """Read an (x, y) .npy array a block at a time."""
+    version = np.lib.format.read_magic(stream)
+    read_header = {(1, 0): np.lib.format.read_array_header_1_0,
+                   (2, 0): np.lib.format.read_array_header_2_0}.get(version)
+    if read_header is None:
+        raise ValueError('unsupported .npy version {}'.format(version))
+    shape, fortran_order, dtype = read_header(stream)
+    if len(shape) != 2 or 2 not in shape or dtype.kind not in 'fiu':
+        raise ValueError('.npy data must have shape (2, n) or (n, 2)')
+    if shape[0] * shape[1] // 2 > max_points:
+        raise ValueError('more than {} points'.format(max_points))
+    count = shape[0] * shape[1]
+    values = np.empty(count, dtype=float)
+    per_block = max(1, BLOCK_BYTES // dtype.itemsize)
+    for first in range(0, count, per_block):
+        n = min(per_block, count - first)
+        block = stream.read(n * dtype.itemsize)
+        if len(block) != n * dtype.itemsize:
+            raise ValueError('.npy data is truncated')
+        values[first:first + n] = np.frombuffer(block, dtype=dtype)
+    array = values.reshape(shape, order='F' if fortran_order else 'C')
+    if shape[0] != 2:
+        array = array.T
+    return array[0], array[1]
+
+
+def _read_raw(stream, max_points):
+    """Read little-endian float64 (x, y) pairs a block at a time."""
+    collector = _Collector(2 * max_points)
+    remainder = b''
+    block_bytes = BLOCK_BYTES - BLOCK_BYTES % 16
+    while True:
+        block = stream.read(block_bytes)
+        if not block:
+            break
+        block = remainder + block
+        usable = len(block) - len(block) % 16
+        collector.add(np.frombuffer(block[:usable], dtype='<f8'))
+        remainder = block[usable:]
+    if remainder:
+        raise ValueError('raw data is not a whole number of float64 pairs')
+    values = collector.array()
+    return values[0::2], values[1::2]
+
+
+def _read_text(lines, max_points):
+    """Read the first two columns of CSV or whitespace-separated text, a
+    block of lines at a time."""
+    xs, ys = _Collector(max_points), _Collector(max_points)
+    delimiter = False  # not yet known
+    block = []
+
+    def flush():
+        if block:
+            data = np.loadtxt(block, delimiter=delimiter, usecols=(0, 1),
+                              ndmin=2)
+            xs.add(data[:, 0])
+            ys.add(data[:, 1])
+            block.clear()
+
+    for line in lines:
+        line = line.strip()
+        if not line or not (line[0].isdigit() or line[0] in '+-.'):
+            continue  # header, comment or blank line
+        if delimiter is False:
+            delimiter = next((d for d in ',;\t' if d in line), None)
+        block.append(line)
+        if len(block) == BLOCK_LINES:
+            try:
+                flush()
+            except ValueError as e:
+                raise ValueError('could not read the data: {}'.format(e))
+    try:
+        flush()
+    except ValueError as e:
+        raise ValueError('could not read the data: {}'.format(e))
+    return xs.array(), ys.array()
+
+
+# JCAMP-DX ASDF compression characters
+_SQZ = dict(zip('@ABCDEFGHIabcdefghi',
+                [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, -1, -2, -3, -4, -5, -6, -7,
+                 -8, -9]))
+_DIF = dict(zip('%JKLMNOPQRjklmnopqr',
+                [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, -1, -2, -3, -4, -5, -6, -7,
+                 -8, -9]))
+_DUP = dict(zip('STUVWXYZs', range(1, 10)))
+_TOKEN = re.compile(r'[@A-Ia-i%J-Rj-rS-Zs][0-9]*\.?[0-9]*'
+                    r'|[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?')
+
+
+def _decode_asdf(line):
+    """Decode one line of JCAMP-DX data (AFFN or ASDF).
+
+    :return: ([float...], bool) the values, and True if the line ended with
+    a DIF value (so the next line starts with a repeated check value).
+    """
+    values = []
+    last_dif = None  # the last DIF step, for DUP
+    ended_dif = False
+    for token in _TOKEN.findall(line):
+        head, rest = token[0], token[1:]
+        if head in _SQZ:
+            digit = _SQZ[head]
+            value = float(str(abs(digit)) + rest) * (1 if digit >= 0 else -1)
+            values.append(value)
+            last_dif, ended_dif = None, False
+        elif head in _DIF:
+            digit = _DIF[head]
+            step = float(str(abs(digit)) + rest) * (1 if digit >= 0 else -1)
+            values.append(values[-1] + step)
+            last_dif, ended_dif = step, True
+        elif head in _DUP:
+            for _ in range(int(str(_DUP[head]) + rest) - 1):
+                values.append(values[-1] + last_dif if last_dif is not None
+                              else values[-1])
+        else:
+            values.append(float(token))
+            last_dif, ended_dif = None, False
+    return values, ended_dif
+
+
+def _read_jcamp(lines, max_points):
+    """Read the first spectrum of a JCAMP-DX file."""
+    labels = {}
+    xs, ys = _Collector(max_points), _Collector(max_points)
+    form = None
+    block = []
+    check = False  # the next data line repeats the last ordinate
+
+    for line in lines:
+        line = line.split('$$', 1)[0].strip()
+        if line.startswith('##'):
+            if form is not None:
+                break  # end of the data table
+            label, _, value = line[2:].partition('=')
+            label = re.sub(r'[\s\-/_]', '', label).upper()
+            labels[label] = value.strip()
+            if label == 'XYDATA':
+                if value.replace(' ', '').upper() != '(X++(Y..Y))':
+                    raise ValueError('unsupported ##XYDATA form: {}'.format(
+                        value.strip()))
+                form = 'XYDATA'
+            elif label in ('XYPOINTS', 'PEAKTABLE'):
+                form = 'XYPOINTS'
+            continue
+        if form is None or not line:
+            continue
+        if form == 'XYPOINTS':
+            values = [float(v) for v in re.split(r'[\s,;]+', line) if v]
+            xs.add(values[0::2])
+            ys.add(values[1::2])
+            continue
+        values, ended_dif = _decode_asdf(line)
+        ordinates = values[1:]
+        if check and ordinates:
+            ordinates = ordinates[1:]
+        check = ended_dif
+        block.extend(ordinates)
+        if len(block) >= BLOCK_LINES:
+            ys.add(block)
+            block = []
+    if form is None:
+        raise ValueError('no ##XYDATA or ##XYPOINTS table found')
+
+    x_factor = float(labels.get('XFACTOR', 1))
+    y_factor = float(labels.get('YFACTOR', 1))
+    if form == 'XYPOINTS':
+        return xs.array() * x_factor, ys.array() * y_factor
+    ys.add(block)
+    y = ys.array() * y_factor
+    try:
+        first_x, last_x = float(labels['FIRSTX']), float(labels['LASTX'])
+    except KeyError:
+        raise ValueError('##FIRSTX and ##LASTX are required')
+    return np.linspace(first_x, last_x, len(y)), y
+
+
+def resample(spectrum, grid):
+    """Put a spectrum on a uniform grid: the mean of the points around each
+    grid point where the data is denser than the grid, and linear
+    interpolation where it is not.
+
+    :param spectrum: (Spectrum)
+    :param grid: (numpy.ndarray) uniformly spaced, ascending frequencies.
+    :return: (numpy.ndarray) the intensities at grid.
+    """
+    x, y = spectrum.x, spectrum.y
+    interpolated = np.interp(grid, x, y)
+    if len(grid) < 2:
+        return interpolated
+    step = grid[1] - grid[0]
+    bins = np.rint((x - grid[0]) / step).astype(np.intp)
+    inside = (bins >= 0) & (bins < len(grid))
+    counts = np.bincount(bins[inside], minlength=len(grid))
+    sums = np.bincount(bins[inside], weights=y[inside], minlength=len(grid))
+    dense = counts > 1
+    interpolated[dense] = sums[dense] / counts[dense]
+    return interpolated
+
+
+def display_data(spectrum, points=DISPLAY_POINTS):
+    """:return: ({str: object}) the browser's copy of a spectrum: name, x,
+    y (resampled to at most `points` points) and the largest |y|."""
+    if len(spectrum) > points:
+        x = np.linspace(spectrum.x[0], spectrum.x[-1], points)
+        y = resample(spectrum, x)
+    else:
+        x, y = spectrum.x, spectrum.y
+    return {'name': spectrum.name, 'x': x.tolist(), 'y': y.tolist(),
+            'max': float(np.abs(y).max()) or 1.0}
+
+
+class UploadPanel:
+    """The upload widget, its status line, and the dcc.Store that holds the
+    display copy of the uploaded spectrum.
+
+    Has the following attributes:
+    * layout: (html.Div)
+    * store_id: (str) the id of the dcc.Store holding the display copy
+    (None until a spectrum is uploaded).
+    * upload_id: (str) the id of the dcc.Upload, whose contents hold the
+    full upload.
+    """
+    store_id = 'experimental'
+    upload_id = 'upload'
+
+    def __init__(self):
+        self.layout = html.Div([
+            dcc.Store(id=self.store_id),
+            dcc.Upload(
+                id=self.upload_id,
+                children=html.Div(['Drop or ', html.A('select'),
+                                   ' a measured spectrum (CSV, JCAMP-DX, '
+                                   '.npy)']),
+                max_size=MAX_UPLOAD_BYTES,
+                style={'borderWidth': '1px', 'borderStyle': 'dashed',
+                       'borderRadius': '5px', 'textAlign': 'center',
+                       'padding': '5px'}),
+            html.Div(id='upload-status')
+        ])
+
+    def register_callbacks(self, app):
+        """Add the callbacks that parse an upload and report on it.
+
+        :param app: (dash.Dash)
+        """
+        @app.callback(Output(self.store_id, 'data'),
+                      [Input(self.upload_id, 'contents')],
+                      [State(self.upload_id, 'filename')])
+        def parse_upload(contents, filename):
+            """:return: the display copy of the spectrum, or {'error'}."""
+            if not contents:
+                return None
+            try:
+                spectrum = decode_upload(contents, filename or '')
+            except ValueError as e:
+                return {'error': '{}: {}'.format(filename, e)}
+            return display_data(spectrum)
+
+        @app.callback(Output('upload-status', 'children'),
+                      [Input(self.store_id, 'data')])
+        def show_status(data):
+            """:return: (str) the uploaded file's name and size, or the
+            error."""
+            if not data:
+                return ''
+            if 'error' in data:
+                return data['error']
+            return '{} ({} points shown, scaled to the simulation)'.format(
+                data['name'], len(data['x']))
+
+
+def merge_figure(figure, data):
+    """Add the measured spectrum to a model's figure, scaled to the height
+    of its first trace. Used by the server when Dash has no clientside
+    callbacks (see OVERLAY_JS for the browser version).
+
+    :param figure: (dict) a BaseDashModel figure.
+    :param data: the display copy from UploadPanel's store (or None).
+    :return: (dict) the figure, with the measured trace appended.
+    """
+    if not figure or not data or 'error' in data:
+        return figure or {}
+    top = max(abs(float(v)) for v in figure['data'][0]['y'])
+    scale = top / data['max']
+    trace = dict(OVERLAY_TRACE, name=data['name'], x=data['x'],
+                 y=[v * scale for v in data['y']])
+    return dict(figure, data=list(figure['data']) + [trace])
+
+
+OVERLAY_TRACE = {'type': 'scatter', 'mode': 'lines', 'opacity': 0.7,
+                 'line': {'color': 'red', 'width': 1}}
+
+# The browser version of merge_figure.
+OVERLAY_JS = """
+function(figure, data) {
+    if (!figure || !data || data.error) {
+        return figure || {};
+    }
+    var y = figure.data[0].y, top = 0;
+    for (var i = 0; i < y.length; i++) {
+        top = Math.max(top, Math.abs(y[i]));
+    }
+    var scale = top / data.max;
+    var trace = {type: 'scatter', mode: 'lines', opacity: 0.7,
+                 line: {color: 'red', width: 1}, name: data.name,
+                 x: data.x, y: data.y.map(function(v) { return v * scale; })};
+    return Object.assign({}, figure, {data: figure.data.concat([trace])});
+}
+"""
@@ -0,0 +1,637 @@
+"""Background fitting jobs: fitting a model to the measured spectrum without
+blocking the request threads.
+
+Provides the following:
+*Job: one submitted fit, with its progress, result and cancellation flag.
+*JobRunner: runs jobs on a small pool of threads, refusing new ones when
+too many are already running or waiting, and reports on and cancels the
+jobs of every process sharing its directory.
+*fit_model(): the job that fits a BaseDashModel's free parameters to a
+measured spectrum (see fitting.py).
+*FitPanel: the "Fit" section of a model's page: choose the free parameters
+and the regions of the spectrum to fit, start and cancel a fit, watch its
+progress, and copy the fitted values into the parameter inputs.
+*parse_ranges(): frequency ranges typed as "120:150, 160:180".
+
+The browser polls a job's progress with a dcc.Interval, which only runs
+while the job is queued or running. The measured spectrum is sent with the
+request that starts a fit (see experimental.py). A job runs in the process
+that started it, which writes its state to a file in a directory shared by
+all the worker processes; any of them can then answer a poll, or cancel the
+job (by creating a second file, which the job checks at each iteration).
+
+Set PYDNMR_FIT_JOBS to the number of fits each process may run at once
+(default 1); up to as many again may wait for a free thread. Set
+PYDNMR_FIT_DIR to the directory for the job files (default: pydnmr-fits in
+the temporary directory; it must be shared if the workers run on several
+hosts).
+
+A fit with "search" checked (a global search with bootstrap confidence
+intervals) runs its fits on a pool of PYDNMR_FIT_PROCESSES processes
+(default SEARCH_PROCESSES), started for the job at a lowered priority. At
+most PYDNMR_FIT_SEARCHES searches (default 1) run at once across all the
+processes sharing PYDNMR_FIT_DIR, each holding a lock on one of that many
+files there; the others wait, queued.
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import dash_core_components as dcc
+import dash_html_components as html
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
+
+from experimental import UploadPanel, decode_upload
+from fitting import (CONFIDENCE, Cancelled, FitProblem, global_fit,
+                     multiresolution_fit, peak_mask, ranges_mask)
+from metrics import METRICS
+
+# How often the browser polls a running job, in milliseconds
+POLL_INTERVAL = 500
+# Finished jobs kept (oldest dropped first)
+KEEP = 100
+# Starting rates, and bootstrap resamples, of a global search
+SEARCH_STARTS = 16
+SEARCH_RESAMPLES = 100
+# Processes started for each search, and searches run at once by all the
+# worker processes together (unless set by PYDNMR_FIT_PROCESSES and
+# PYDNMR_FIT_SEARCHES)
+SEARCH_PROCESSES = 2
+SEARCHES = 1
+# The form of a Job.id (checked before it is used in a file name)
+JOB_ID = re.compile('[0-9a-f]{32}$')
+
+
+class Job:
+    """One background task.
+
+    Has the following attributes:
+    * id: (str) a random, unguessable identifier.
+    * model: (str) the name of the model being fitted.
+    * state: (str) 'queued', 'running', 'done', 'cancelled' or 'failed'.
+    * progress: ({str: object}) the latest report: 'iteration', 'cost',
+    'values' ({name: float}), 'points' (the resolution being fitted) and,
+    for a search, 'tasks' (the number of fits, 'iteration' being the number
+    finished).
+    * result: ({str: object} or None) the finished fit (see
+    fitting.FitResult.to_dict()).
+    * error: (str or None) why the job failed.
+    * directory: (str or None) where the job's state is saved (set by
+    JobRunner.submit()).
+    """
+    def __init__(self, model):
+        self.id = uuid.uuid4().hex
+        self.model = model
+        self.state = 'queued'
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.directory = None
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self):
+        """(bool) True once cancellation has been requested, in this
+        process or (through the job's directory) another."""
+        if (not self._cancel.is_set() and self.directory is not None
+                and os.path.exists(job_path(self.directory, self.id,
+                                            '.cancel'))):
+            self._cancel.set()
+        return self._cancel.is_set()
+
+    def cancel(self):
+        """Request cancellation; a running job stops after its current
+        iteration, and a queued one never starts."""
+        self._cancel.set()
+
+    def report(self, iteration, cost, values, points=None, tasks=None):
+        """Record the progress of a running fit (a fitting callback).
+
+        :return: (bool) False if the job has been cancelled.
+        """
+        self.progress = {'iteration': iteration, 'cost': cost,
+                         'values': values, 'points': points, 'tasks': tasks}
+        self.save()
+        return not self.cancelled
+
+    def save(self):
+        """Write the job's state (to_dict()) to its directory, if it has
+        one, replacing the previous state in one step."""
+        if self.directory is None:
+            return
+        path = job_path(self.directory, self.id, '.json')
+        temporary = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(temporary, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(temporary, path)
+
+    def to_dict(self):
+        """:return: ({str: object}) the job's state, as sent to the
+        browser."""
+        return {'id': self.id, 'model': self.model, 'state': self.state,
+                'progress': self.progress, 'result': self.result,
+                'error': self.error}
+
+
+class JobRunner:
+    """Runs jobs on a bounded pool of threads, saving their state in a
+    directory that other processes' runners can read.
+
+    Has the following attributes:
+    * max_running: (int) jobs run at once.
+    * max_waiting: (int) jobs that may wait for a thread; submitting more
+    raises RuntimeError.
+    * directory: (str) where the jobs' states are saved.
+    """
+    def __init__(self, max_running=1, max_waiting=None, keep=KEEP,
+                 directory=None):
+        self.max_running = max_running
+        self.max_waiting = max_running if max_waiting is None else max_waiting
+        self.keep = keep
+        self.directory = directory or os.path.join(tempfile.gettempdir(),
+                                                   'pydnmr-fits')
+        os.makedirs(self.directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_running,
+                                            thread_name_prefix='fit')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        """:return: (JobRunner) sized by PYDNMR_FIT_JOBS (default 1),
+        saving to PYDNMR_FIT_DIR."""
+        return cls(max(1, int(environ.get('PYDNMR_FIT_JOBS', 1))),
+                   directory=environ.get('PYDNMR_FIT_DIR'))
+
+    def active(self):
+        """:return: (int) the jobs queued or running."""
+        with self._lock:
+            return sum(job.state in ('queued', 'running')
+                       for job in self._jobs.values())
+
+    def submit(self, job, function, *args):
+        """Run function(job, *args) in the background; its return value
+        becomes job.result.
+
+        :param job: (Job)
+        :return: (Job) the job.
+        :raises RuntimeError: if too many jobs are already queued or running.
+        """
+        with self._lock:
+            active = sum(j.state in ('queued', 'running')
+                         for j in self._jobs.values())
+            if active >= self.max_running + self.max_waiting:
+                raise RuntimeError('too many fits are running; try again '
+                                   'later')
+            self._jobs[job.id] = job
+            finished = [id_ for id_, j in self._jobs.items()
+                        if j.state not in ('queued', 'running')]
+            dropped = finished[:max(0, len(self._jobs) - self.keep)]
+            for id_ in dropped:
+                del self._jobs[id_]
+        for id_ in dropped:
+            for suffix in ('.json', '.cancel'):
+                try:
+                    os.remove(job_path(self.directory, id_, suffix))
+                except FileNotFoundError:
+                    pass
+        job.directory = self.directory
+        job.save()
+        self._executor.submit(self._run, job, function, args)
+        return job
+
+    @staticmethod
+    def _run(job, function, args):
+        if job.cancelled:
+            job.state = 'cancelled'
+            job.save()
+            return
+        job.state = 'running'
+        job.save()
+        try:
+            job.result = function(job, *args)
+            job.state = 'done'
+        except Cancelled:
+            job.state = 'cancelled'
+        except Exception as e:
+            job.error = str(e) or type(e).__name__
+            job.state = 'failed'
+            METRICS.increment('errors', job.model)
+        job.save()
+
+    def get(self, job_id):
+        """:return: (Job or None) the job with this id, if this runner
+        started it."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def status(self, job_id):
+        """:return: ({str: object} or None) the last saved state (see
+        Job.to_dict()) of a job started by any runner sharing this
+        directory."""
+        if not JOB_ID.match(job_id or ''):
+            return None
+        try:
+            with open(job_path(self.directory, job_id, '.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def cancel(self, job_id):
+        """Request cancellation of a job started by any runner sharing this
+        directory (see Job.cancel()).
+
+        :return: (bool) False if there is no such job.
+        """
+        if self.status(job_id) is None:
+            return False
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+        open(job_path(self.directory, job_id, '.cancel'), 'w').close()
+        return True
+
+
+def job_path(directory, job_id, suffix):
+    """:return: (str) the file holding a job's state ('.json') or
+    cancellation request ('.cancel')."""
+    return os.path.join(directory, job_id + suffix)
+
+
+def fit_model(job, model, values, free, x, y, regions=None, search=False):
+    """Fit some of a model's parameters to a measured spectrum, coarse to
+    fine (see fitting.multiresolution_fit()), or with a global search and
+    bootstrap confidence intervals (see fitting.global_fit()).
+
+    :param job: (Job) receives the progress reports.
+    :param model: (BaseDashModel) a model with a batch_model.
+    :param values: ([float...]) the starting parameters, in entry_names
+    order.
+    :param free: ([str...]) the entry names to fit.
+    :param x, y: (numpy.ndarray) the measured spectrum.
+    :param regions: the points to fit: None for all, 'auto' for those near
+    the peaks (see fitting.peak_mask()), or [(float, float)...] frequency
+    ranges.
+    :param search: (bool) if True, start from SEARCH_STARTS values of the
+    rate (which must be free) across its sweep range, in search_processes()
+    processes once a search slot is free (see search_slot()), and bootstrap
+    the best fit SEARCH_RESAMPLES times.
+    :return: ({str: object}) the fit (see fitting.FitResult.to_dict()).
+    """
+    if regions == 'auto':
+        mask = peak_mask(x, y)
+    elif regions:
+        mask = ranges_mask(x, regions)
+    else:
+        mask = None
+    kwargs = {'bounds': entry_bounds(model), 'log_params': log_params(model),
+              'mask': mask}
+    with METRICS.time(model.name, 'fit'):
+        if not search:
+            problem = FitProblem(model.batch_model, model.entry_names,
+                                 values, free, x, y, **kwargs)
+            return multiresolution_fit(problem,
+                                       callback=job.report).to_dict()
+        rate = model.animation['parameter'] if model.animation else None
+        if rate not in free:
+            raise ValueError('the search needs {} to be fitted'.format(rate))
+        low, high = (model.sweeps[rate][:2] if model.sweeps
+                     and rate in model.sweeps
+                     else (model.animation['min'], model.animation['max']))
+
+        def progress(done, total, cost, values):
+            return job.report(done, cost, values, tasks=total)
+
+        with search_slot(job):
+            return global_fit(model.batch_model, model.entry_names, values,
+                              free, x, y, rate, (low, high),
+                              starts=SEARCH_STARTS,
+                              resamples=SEARCH_RESAMPLES,
+                              workers=search_processes(), progress=progress,
+                              **kwargs).to_dict()
+
+
+def search_processes(environ=os.environ):
+    """:return: (int) PYDNMR_FIT_PROCESSES, the processes used by a search
+    (default SEARCH_PROCESSES)."""
+    return max(1, int(environ.get('PYDNMR_FIT_PROCESSES',
+                                  SEARCH_PROCESSES)))
+
+
+@contextmanager
+def search_slot(job, environ=os.environ):
+    """Wait for one of the PYDNMR_FIT_SEARCHES (default SEARCHES) search
+    slots shared through the job's directory, and hold it. A slot is an
+    exclusive flock() on a file, so the operating system frees it if the
+    process holding it dies. The job is 'queued' while it waits.
+
+    Without fcntl (Windows), searches are not limited.
+
+    :param job: (Job) a job with a directory.
+    :raises Cancelled: if the job is cancelled while it waits.
+    """
+    if fcntl is None or job.directory is None:
+        yield
+        return
+    slots = max(1, int(environ.get('PYDNMR_FIT_SEARCHES', SEARCHES)))
+    while True:
+        for slot in range(slots):
+            lock = open(os.path.join(job.directory,
+                                     'search-{}.lock'.format(slot)), 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                continue
+            try:
+                if job.state != 'running':
+                    job.state = 'running'
+                    job.save()
+                yield
+            finally:
+                lock.close()
+            return
+        if job.cancelled:
+            raise Cancelled()
+        if job.state != 'queued':
+            job.state = 'queued'
+            job.save()
+        time.sleep(POLL_INTERVAL / 1000)
+
+
+def entry_bounds(model):
+    """:return: ({str: (float or None, float or None)}) the min and max of
+    each of a model's entries."""
+    return {name: (kwargs.get('min'), kwargs.get('max'))
+            for name, kwargs in model.entry_dict.items()}
+
+
+def log_params(model):
+    """:return: ({str}) the entries fitted as logarithms: the rate and
+    those swept on a log scale."""
+    names = {name for name, sweep in (model.sweeps or {}).items()
+             if sweep[2] == 'log'}
+    if model.animation:
+        names.add(model.animation['parameter'])
+    return names
+
+
+class FitPanel:
+    """The Fit section of a model's page.
+
+    Has the following attributes:
+    * model: (BaseDashModel) the model fitted.
+    * runner: (JobRunner) runs the fits.
+    * layout: (html.Details)
+    """
+    def __init__(self, model, runner):
+        self.model = model
+        self.runner = runner
+        self.id = '{}-fit'.format(model.id)
+        self.ids = {part: '{}-{}'.format(self.id, part)
+                    for part in ('free', 'start', 'cancel', 'apply',
+                                 'status', 'job', 'progress', 'poll',
+                                 'cancelled', 'regions', 'ranges',
+                                 'search')}
+        default = (model.animation['parameter'] if model.animation
+                   else model.entry_names[0])
+        self.layout = html.Details(id=self.id, children=[
+            html.Summary('Fit to the measured spectrum'),
+            dcc.Checklist(
+                id=self.ids['free'],
+                options=[{'label': name, 'value': name}
+                         for name in model.entry_names],
+                value=[default],
+                labelStyle={'display': 'inline-block'}),
+            dcc.RadioItems(
+                id=self.ids['regions'],
+                options=[{'label': 'all points', 'value': 'all'},
+                         {'label': 'around the peaks', 'value': 'auto'},
+                         {'label': 'these ranges:', 'value': 'ranges'}],
+                value='auto',
+                labelStyle={'display': 'inline-block'}),
+            # box-selecting on the graph adds the selected range
+            dcc.Input(id=self.ids['ranges'], type='text', value='',
+                      placeholder='e.g. 120:150, 160:180 (or box-select on '
+                                  'the graph)'),
+            dcc.Checklist(
+                id=self.ids['search'],
+                options=[{'label': 'search {} and estimate confidence '
+                                   'intervals (slower)'.format(default),
+                          'value': 'on'}],
+                value=[]),
+            html.Button('Fit', id=self.ids['start']),
+            html.Button('Cancel', id=self.ids['cancel']),
+            html.Button('Use fitted values', id=self.ids['apply']),
+            html.Div(id=self.ids['status']),
+            html.Div(id=self.ids['cancelled'], style={'display': 'none'}),
+            dcc.Store(id=self.ids['job']),
+            dcc.Store(id=self.ids['progress']),
+            dcc.Interval(id=self.ids['poll'], interval=POLL_INTERVAL,
+                         disabled=True)
+        ])
+
+    def register_callbacks(self, app):
+        """Add the callbacks that start, poll, cancel and apply fits.
+
+        :param app: (dash.Dash)
+        """
+        model = self.model
+        ids = self.ids
+        entries = [State('{}-{}'.format(model.id, entry), 'value')
+                   for entry in model.entry_names]
+
+        @app.callback(Output(ids['job'], 'data'),
+                      [Input(ids['start'], 'n_clicks')],
+                      [State(UploadPanel.upload_id, 'contents'),
+                       State(UploadPanel.upload_id, 'filename'),
+                       State(ids['free'], 'value'),
+                       State(ids['regions'], 'value'),
+                       State(ids['ranges'], 'value'),
+                       State(ids['search'], 'value')] + entries)
+        def start_fit(n_clicks, contents, filename, free, regions, ranges,
+                      search, *string_values):
+            """:return: ({'id'} or {'error'}) the job started."""
+            if not n_clicks:
+                raise PreventUpdate
+            if regions == 'ranges':
+                try:
+                    regions = parse_ranges(ranges)
+                except ValueError as e:
+                    return {'error': str(e)}
+            return self.start(contents, filename, free, string_values,
+                              None if regions == 'all' else regions,
+                              bool(search))
+
+        @app.callback(Output(ids['ranges'], 'value'),
+                      [Input('{}-graph'.format(model.id), 'selectedData')],
+                      [State(ids['ranges'], 'value')])
+        def add_range(selected, ranges):
+            """:return: (str) the ranges, plus the one box-selected on the
+            graph."""
+            if not selected or 'range' not in selected:
+                raise PreventUpdate
+            low, high = sorted(selected['range']['x'])
+            added = '{:.6g}:{:.6g}'.format(low, high)
+            return '{}, {}'.format(ranges, added) if ranges else added
+
+        @app.callback(Output(ids['progress'], 'data'),
+                      [Input(ids['poll'], 'n_intervals'),
+                       Input(ids['job'], 'data')])
+        def poll(n_intervals, job_data):
+            """:return: ({str: object}) the job's current state."""
+            if not job_data:
+                raise PreventUpdate
+            if 'error' in job_data:
+                return {'state': 'failed', 'error': job_data['error']}
+            status = self.runner.status(job_data['id'])
+            if status is None:
+                return {'state': 'failed', 'error': 'the fit was not found '
+                                                    'on this server'}
+            return status
+
+        @app.callback(Output(ids['poll'], 'disabled'),
+                      [Input(ids['progress'], 'data')])
+        def stop_polling(progress):
+            """:return: (bool) True unless the job is queued or running."""
+            return not progress or progress['state'] not in ('queued',
+                                                             'running')
+
+        @app.callback(Output(ids['status'], 'children'),
+                      [Input(ids['progress'], 'data')])
+        def show_status(progress):
+            """:return: (str) a line describing the job."""
+            return status_text(progress)
+
+        @app.callback(Output(ids['cancelled'], 'children'),
+                      [Input(ids['cancel'], 'n_clicks')],
+                      [State(ids['job'], 'data')])
+        def cancel_fit(n_clicks, job_data):
+            """Cancel the current job; :return: (str) its id."""
+            if not n_clicks or not job_data or 'id' not in job_data:
+                raise PreventUpdate
+            self.runner.cancel(job_data['id'])
+            return job_data['id']
+
+        for entry in model.entry_names:
+            self._register_apply(app, entry)
+
+    def _register_apply(self, app, entry):
+        @app.callback(Output('{}-{}'.format(self.model.id, entry), 'value'),
+                      [Input(self.ids['apply'], 'n_clicks')],
+                      [State(self.ids['progress'], 'data')])
+        def apply_fit(n_clicks, progress):
+            """:return: (float) the fitted value of the entry."""
+            if (not n_clicks or not progress
+                    or progress['state'] != 'done'):
+                raise PreventUpdate
+            return float('{:.6g}'.format(progress['result']['values'][entry]))
+
+    def start(self, contents, filename, free, string_values, regions=None,
+              search=False):
+        """Start fitting the model to the uploaded spectrum.
+
+        :param contents: (str or None) the dcc.Upload's contents (see
+        experimental.decode_upload()).
+        :param filename: (str or None) the uploaded file's name.
+        :param free: ([str...]) the entry names to fit.
+        :param string_values: the parameter inputs' values.
+        :param regions: the points to fit (see fit_model()).
+        :param search: (bool) run a global search (see fit_model()).
+        :return: ({'id': str} or {'error': str})
+        """
+        if not contents:
+            return {'error': 'upload a measured spectrum to fit first'}
+        try:
+            spectrum = decode_upload(contents, filename or '')
+        except ValueError as e:
+            return {'error': '{}: {}'.format(filename, e)}
+        if not free:
+            return {'error': 'choose at least one parameter to fit'}
+        try:
+            values = [float(value) for value in string_values]
+        except (TypeError, ValueError):
+            return {'error': 'every parameter needs a value'}
+        try:
+            job = self.runner.submit(Job(self.model.name), fit_model,
+                                     self.model, values, free,
+                                     spectrum.x, spectrum.y, regions,
+                                     search)
+        except RuntimeError as e:
+            return {'error': str(e)}
+        return {'id': job.id}
+
+
+def parse_ranges(text):
+    """:param text: (str) comma-separated low:high frequency ranges, e.g.
+    "120:150, 160:180".
+    :return: ([(float, float)...])
+    :raises ValueError: if text is not such a list.
+    """
+    ranges = []
+    for part in (text or '').split(','):
+        if not part.strip():
+            continue
+        try:
+            low, high = (float(value) for value in part.split(':'))
+        except ValueError:
+            raise ValueError('ranges must be written low:high, separated '
+                             'by commas (not {!r})'.format(part.strip()))
+        ranges.append((low, high))
+    if not ranges:
+        raise ValueError('enter the ranges to fit, or box-select them on '
+                         'the graph')
+    return ranges
+
+
+def status_text(progress):
+    """:param progress: ({str: object} or None) a Job.to_dict(), or
+    {'state': 'failed', 'error'}.
+    :return: (str) a line describing the job."""
+    if not progress:
+        return ''
+    state = progress['state']
+    if state == 'failed':
+        return 'Fit failed: {}'.format(progress['error'])
+    if state == 'queued':
+        return 'Fit waiting for a free worker...'
+    if state == 'done':
+        result = progress['result']
+        intervals = result.get('intervals') or {}
+        return 'Fit {} after {} iterations: {} (residual {:.4g})'.format(
+            'converged' if result['converged'] else 'stopped',
+            result['iterations'],
+            ', '.join('{} = {:.4g} ± {:.2g}{}'.format(
+                name, result['values'][name], error,
+                ' ({}% interval {:.4g} to {:.4g})'.format(
+                    CONFIDENCE, intervals[name]['low'],
+                    intervals[name]['high']) if name in intervals else '')
+                for name, error in result['errors'].items()),
+            result['cost'])
+    report = progress.get('progress') or {}
+    if not report:
+        return 'Fit {}...'.format(state)
+    if report.get('tasks'):
+        step = '{} of {} fits done'.format(report['iteration'],
+                                            report['tasks'])
+    else:
+        step = 'iteration {} ({} points)'.format(report['iteration'],
+                                                 report['points'])
+    return 'Fit {}: {}, residual {:.4g}, {}'.format(
+        state, step, report['cost'],
+        ', '.join('{} = {:.4g}'.format(name, value)
+                  for name, value in report['values'].items()))
@@ -0,0 +1,705 @@
+"""Least-squares fitting of a model's parameters to a measured spectrum.
+
+Provides the following:
+*FitProblem: the residuals of a model against measured data, for many
+parameter sets at once (one vectorized batch_model call).
+*levenberg_marquardt(): minimize a FitProblem's sum of squared residuals.
+*multiresolution_fit(): levenberg_marquardt() on binned copies of the data,
+from coarse to fine, finishing at full resolution.
+*resolution_levels(): the binning factors multiresolution_fit() uses.
+*global_fit(): multiresolution fits from many starting values of one
+parameter, and bootstrap resamples of the best fit's residuals, in parallel
+on a process pool; the best fit with confidence intervals.
+*noise_sigma(): a robust estimate of a spectrum's noise level.
+*peak_mask(): the points of a spectrum near its peaks, found from the data.
+*ranges_mask(): the points of a spectrum within given frequency ranges.
+*FitResult: the outcome of a fit.
+*Cancelled: raised by a fit stopped by its progress callback.
+
+The measured intensities are in arbitrary units, so every model spectrum is
+matched to the data with its own least-squares scale and offset (solved in
+closed form); only the model's own parameters are iterated. Parameters
+listed in log_params (e.g. rate constants, which matter over decades) are
+iterated as their logarithms.
+
+Large spectra are fitted coarse-to-fine: most iterations are done on the
+data averaged over bins of consecutive points, against the model averaged
+over the same bins (by Gauss-Legendre quadrature, a few model points per
+bin), and only the last few on every point.
+
+A fit can be restricted to regions of interest (a mask of the points kept,
+e.g. from peak_mask() or ranges_mask()), leaving out featureless baseline;
+the model is then only calculated at the kept points. Points can also be
+weighted (e.g. by 1 / noise variance).
+
+This module only needs numpy and the model's batch function, so it can run
+in worker processes without importing the web app.
+"""
+import copy
+import importlib
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+import numpy as np
+
+# The coarsest level of a multiresolution fit has at least this many bins
+MIN_BINS = 512
+# Each level has this many times the points of the one before
+LEVEL_STEP = 4
+# Model points per bin (Gauss-Legendre nodes)
+BIN_NODES = 4
+# peak_mask() keeps points this many noise sigmas above the baseline
+PEAK_THRESHOLD = 3
+# global_fit()'s confidence intervals (percent)
+CONFIDENCE = 95
+# Added to the niceness of global_fit()'s worker processes, so that they
+# yield to the processes serving requests
+WORKER_NICENESS = 10
+
+
+class Cancelled(Exception):
+    """A fit was stopped by its progress callback."""
+
+
+class FitProblem:
+    """The residuals of a model against measured data.
+
+    Has the following attributes:
+    * names: ([str...]) all of the model's parameter names, in order.
+    * values: (numpy.ndarray) the starting value of every parameter.
+    * free: ([str...]) the names of the parameters being fitted.
+    * x, y: (numpy.ndarray) the measured spectrum (the kept points only).
+    * weights: (numpy.ndarray) the weight of each point's squared residual.
+    * low, high: (numpy.ndarray) the frequency range each point stands for
+    (from the midpoints to its neighbours in the unmasked data, or a bin's
+    range).
+    * lower, upper: (numpy.ndarray) the bounds of the free parameters.
+    * nodes, node_weights: (numpy.ndarray or None) for binned data (see
+    .binned()), the (n, q) frequencies at which the model is calculated for
+    each bin, and the (q,) weights averaging them; None to calculate the
+    model at x.
+    * evaluations: (int) the number of model intensities calculated so far
+    (spectra x points), a measure of the work done.
+    """
+    def __init__(self, batch_model, names, values, free, x, y, bounds=None,
+                 log_params=(), weights=None, mask=None):
+        """
+        :param batch_model: a function batch_model(x, *columns) -> (m, n)
+        array (see dnmrplot.dnmrplot_2spin_batch).
+        :param names: ([str...]) the parameter names, in batch_model order.
+        :param values: ([float...]) the starting values, in the same order.
+        :param free: ([str...]) the parameters to fit.
+        :param x, y: (numpy.ndarray) the measured spectrum.
+        :param bounds: ({str: (float or None, float or None)}) optional
+        limits for free parameters.
+        :param log_params: (str...) free parameters iterated as logarithms
+        (they must be positive).
+        :param weights: (numpy.ndarray or None) a weight for each point
+        (default 1).
+        :param mask: (numpy.ndarray or None) a boolean array, True for the
+        points to fit (default all).
+        """
+        unknown = set(free) - set(names)
+        if unknown or not free:
+            raise ValueError('free parameters must be some of: {}'.format(
+                ', '.join(names)))
+        self.batch_model = batch_model
+        self.names = list(names)
+        self.values = np.array(values, dtype=float)
+        self.free = list(free)
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        weights = (np.ones(len(x)) if weights is None
+                   else np.asarray(weights, dtype=float))
+        if len(x) < 2 or y.shape != x.shape or weights.shape != x.shape:
+            raise ValueError('x, y and weights must be the same length, of '
+                             'two or more points')
+        edges = np.concatenate(([1.5 * x[0] - 0.5 * x[1]],
+                                (x[1:] + x[:-1]) / 2,
+                                [1.5 * x[-1] - 0.5 * x[-2]]))
+        low, high = edges[:-1], edges[1:]
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            if not mask.any():
+                raise ValueError('the mask leaves no points to fit')
+            x, y, weights = x[mask], y[mask], weights[mask]
+            low, high = low[mask], high[mask]
+        self.x, self.y, self.weights = x, y, weights
+        self.low, self.high = low, high
+        self._root_weights = np.sqrt(weights)
+        self._index = [self.names.index(name) for name in self.free]
+        self._log = np.array([name in log_params for name in self.free])
+        bounds = bounds or {}
+        self.lower = np.array([bounds.get(name, (None, None))[0]
+                               if bounds.get(name, (None, None))[0]
+                               is not None else -np.inf
+                               for name in self.free])
+        self.upper = np.array([bounds.get(name, (None, None))[1]
+                               if bounds.get(name, (None, None))[1]
+                               is not None else np.inf
+                               for name in self.free])
+        self.nodes = None
+        self.node_weights = None
+        self.evaluations = 0
+
+    def binned(self, factor, order=BIN_NODES):
+        """A copy of the problem with the data averaged over bins of
+        `factor` consecutive points, and the model averaged over the same
+        frequency ranges. Bins do not span the gaps left by a mask (so some
+        are shorter); a bin's points are averaged by weight, and its weight
+        is their total.
+
+        :param factor: (int) points per bin.
+        :param order: (int) model points per bin.
+        :return: (FitProblem) the binned problem; its evaluations are
+        counted separately.
+        """
+        n = len(self.x)
+        gaps = np.flatnonzero(self.low[1:] > self.high[:-1]) + 1
+        starts = np.union1d(np.arange(0, n, factor), gaps)
+        ends = np.append(starts[1:], n)
+        low, high = self.low[starts], self.high[ends - 1]
+        weights = np.add.reduceat(self.weights, starts)
+        y = np.add.reduceat(self.weights * self.y, starts)
+        y = np.divide(y, weights, out=np.zeros_like(y), where=weights > 0)
+
+        roots, node_weights = np.polynomial.legendre.leggauss(order)
+        problem = copy.copy(self)
+        problem.x = (low + high) / 2
+        problem.y, problem.weights = y, weights
+        problem._root_weights = np.sqrt(weights)
+        problem.low, problem.high = low, high
+        problem.nodes = (problem.x[:, None]
+                         + (high - low)[:, None] / 2 * roots)
+        problem.node_weights = node_weights / 2
+        problem.evaluations = 0
+        return problem
+
+    def to_internal(self, params):
+        """:return: (numpy.ndarray) free parameter values as iterated (logs
+        for log_params)."""
+        params = np.array(params, dtype=float)
+        params[..., self._log] = np.log(params[..., self._log])
+        return params
+
+    def to_external(self, internal):
+        """:return: (numpy.ndarray) iterated values as parameter values."""
+        params = np.array(internal, dtype=float)
+        params[..., self._log] = np.exp(params[..., self._log])
+        return np.clip(params, self.lower, self.upper)
+
+    def start(self):
+        """:return: (numpy.ndarray) the starting free parameters, iterated
+        form."""
+        return self.to_internal(np.clip(self.values[self._index],
+                                        self.lower, self.upper))
+
+    def full_values(self, internal):
+        """:return: (numpy.ndarray) every parameter's value, with the free
+        ones at the iterated values `internal`."""
+        values = self.values.copy()
+        values[self._index] = self.to_external(internal)
+        return values
+
+    def model(self, internal):
+        """Calculate the model spectra for many free-parameter sets.
+
+        :param internal: (numpy.ndarray) (m, free) iterated values.
+        :return: (numpy.ndarray) (m, n) intensities at x.
+        """
+        internal = np.atleast_2d(internal)
+        columns = [np.full(len(internal), value) for value in self.values]
+        external = self.to_external(internal)
+        for j, i in enumerate(self._index):
+            columns[i] = external[:, j]
+        if self.nodes is None:
+            self.evaluations += len(internal) * len(self.x)
+            return self.batch_model(self.x, *columns)
+        self.evaluations += len(internal) * self.nodes.size
+        values = self.batch_model(self.nodes.ravel(), *columns)
+        return values.reshape(len(internal), *self.nodes.shape) \
+            @ self.node_weights
+
+    def scale(self, model):
+        """The weighted least-squares scale and offset matching each model
+        spectrum to the data.
+
+        :param model: (numpy.ndarray) (m, n) model intensities.
+        :return: (numpy.ndarray, numpy.ndarray) (m,) scales and offsets.
+        """
+        w = self.weights
+        n = w.sum()
+        weighted = model * w
+        sum_m = weighted.sum(axis=1)
+        sum_mm = np.einsum('ij,ij->i', weighted, model)
+        sum_my = weighted @ self.y
+        sum_y = w @ self.y
+        determinant = n * sum_mm - sum_m ** 2
+        determinant = np.where(determinant == 0, 1.0, determinant)
+        scale = (n * sum_my - sum_m * sum_y) / determinant
+        offset = (sum_y - scale * sum_m) / n
+        return scale, offset
+
+    def residuals(self, internal):
+        """:param internal: (numpy.ndarray) (m, free) iterated values.
+        :return: (numpy.ndarray) (m, n) weighted residuals, (data - scaled
+        model) * sqrt(weight)."""
+        model = self.model(internal)
+        scale, offset = self.scale(model)
+        return (self.y - (scale[:, None] * model + offset[:, None])) \
+            * self._root_weights
+
+    def jacobian(self, internal, residuals, step=1e-6):
+        """The forward-difference Jacobian of the residuals, from one batch
+        evaluation of every perturbed parameter set.
+
+        :return: (numpy.ndarray) (n, free) d residuals / d internal.
+        """
+        h = step * np.maximum(np.abs(internal), 1.0)
+        perturbed = internal + np.diag(h)
+        return ((self.residuals(perturbed) - residuals) / h[:, None]).T
+
+
+class FitResult:
+    """The outcome of a fit.
+
+    Has the following attributes:
+    * values: ({str: float}) every parameter's fitted (or fixed) value.
+    * errors: ({str: float}) standard errors of the free parameters, from
+    the curvature at the minimum (nan if undetermined).
+    * cost: (float) the sum of squared residuals.
+    * iterations: (int)
+    * evaluations: (int) model intensities calculated (spectra x points).
+    * converged: (bool)
+    * levels: ([(int, int)...]) for a multiresolution fit, the points and
+    iterations of each level.
+    * starts: ([(float, float)...]) for a global fit, the starting value of
+    the scanned parameter and the cost reached from it, for each start.
+    * intervals: ({str: {str: float}} or None) for a global fit, the
+    bootstrap 'std', and the 'low' and 'high' ends of the CONFIDENCE %
+    interval, of each free parameter.
+    """
+    def __init__(self, values, errors, cost, iterations, evaluations,
+                 converged, levels=(), starts=(), intervals=None):
+        self.values = values
+        self.errors = errors
+        self.cost = cost
+        self.iterations = iterations
+        self.evaluations = evaluations
+        self.converged = converged
+        self.levels = list(levels)
+        self.starts = list(starts)
+        self.intervals = intervals
+
+    def to_dict(self):
+        return {'values': self.values, 'errors': self.errors,
+                'cost': self.cost, 'iterations': self.iterations,
+                'evaluations': self.evaluations,
+                'converged': self.converged, 'levels': self.levels,
+                'starts': self.starts, 'intervals': self.intervals}
+
+
+def levenberg_marquardt(problem, start=None, max_iterations=100, tol=1e-8,
+                        callback=None):
+    """Minimize the sum of squared residuals of a FitProblem.
+
+    :param problem: (FitProblem)
+    :param start: (numpy.ndarray) iterated starting values (default
+    problem.start()).
+    :param max_iterations: (int)
+    :param tol: (float) stop when an iteration improves the cost by less
+    than this fraction.
+    :param callback: optional function callback(iteration, cost, values)
+    called after each iteration, values being {name: float}; if it returns
+    False the fit stops with Cancelled.
+    :return: (FitResult) converged only if the last step improved the cost
+    by less than tol, not if no step improved it or the iterations ran out.
+    :raises Cancelled: if callback returned False.
+    """
+    p = problem.start() if start is None else np.array(start, dtype=float)
+    r = problem.residuals(p)[0]
+    cost = float(r @ r)
+    damping = 1e-3
+    converged = False
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        jacobian = problem.jacobian(p, r)
+        gradient = jacobian.T @ r
+        curvature = jacobian.T @ jacobian
+        diagonal = np.diag(curvature).copy()
+        diagonal[diagonal == 0] = 1.0
+        improved = False
+        while damping < 1e12:
+            try:
+                step = np.linalg.solve(curvature + damping * np.diag(diagonal),
+                                       -gradient)
+            except np.linalg.LinAlgError:
+                damping *= 10
+                continue
+            trial = problem.to_internal(problem.to_external(p + step))
+            r_trial = problem.residuals(trial)[0]
+            cost_trial = float(r_trial @ r_trial)
+            if cost_trial < cost:
+                improvement = (cost - cost_trial) / max(cost, 1e-300)
+                p, r, cost = trial, r_trial, cost_trial
+                damping = max(damping / 10, 1e-12)
+                improved = True
+                break
+            damping *= 10
+        if callback is not None and callback(
+                iteration, cost, values_dict(problem, p)) is False:
+            raise Cancelled()
+        if not improved:
+            # no step lowers the cost: stalled, not converged
+            break
+        if improvement < tol:
+            converged = True
+            break
+    # the errors need the Jacobian at p, after the last accepted step
+    return FitResult(values_dict(problem, p),
+                     error_dict(problem, p, r, None), cost, iteration,
+                     problem.evaluations, converged)
+
+
+def resolution_levels(points, min_bins=MIN_BINS, step=LEVEL_STEP,
+                      order=BIN_NODES):
+    """The binning factors of a multiresolution fit, coarsest first.
+
+    Levels are `step` times finer than the one before, the coarsest having
+    at least min_bins bins. Factors of `order` or less (where a bin's model
+    points would be no fewer than its data points) are left out, and the
+    last level is always 1 (full resolution).
+
+    :param points: (int) the number of data points.
+    :return: ([int...])
+    """
+    factors = [1]
+    while points // (factors[-1] * step) >= min_bins:
+        factors.append(factors[-1] * step)
+    return [factor for factor in reversed(factors) if factor > order] + [1]
+
+
+def multiresolution_fit(problem, levels=None, max_iterations=100, tol=1e-8,
+                        coarse_tol=1e-4, callback=None, start=None):
+    """Fit a problem coarse-to-fine: each level starts from the fit of the
+    one before, and the last is the full-resolution problem, so its result
+    (and error estimates) are those of the data itself.
+
+    :param problem: (FitProblem)
+    :param levels: ([int...]) binning factors, coarsest first (default
+    resolution_levels()).
+    :param max_iterations: (int) for each level.
+    :param tol: (float) for the full-resolution level.
+    :param coarse_tol: (float) for the binned levels, which only need to get
+    close.
+    :param callback: optional function callback(iteration, cost, values,
+    points), as for levenberg_marquardt() plus the level's number of
+    points; iterations are counted across levels.
+    :param start: (numpy.ndarray) iterated starting values (default
+    problem.start()).
+    :return: (FitResult) with the evaluations of every level, and .levels.
+    :raises Cancelled: if callback returned False.
+    """
+    if levels is None:
+        levels = resolution_levels(len(problem.x))
+    if start is None:
+        start = problem.start()
+    done = []
+    evaluations = iterations = 0
+    for factor in levels:
+        level = problem.binned(factor) if factor > 1 else problem
+
+        def level_callback(iteration, cost, values, offset=iterations,
+                           points=len(level.x)):
+            return callback is None or callback(offset + iteration, cost,
+                                                values, points)
+
+        before = level.evaluations
+        result = levenberg_marquardt(
+            level, start, max_iterations,
+            tol if factor == 1 else coarse_tol, level_callback)
+        evaluations += level.evaluations - before
+        iterations += result.iterations
+        done.append((len(level.x), result.iterations))
+        start = problem.to_internal([result.values[name]
+                                     for name in problem.free])
+    return FitResult(result.values, result.errors, result.cost, iterations,
+                     evaluations, result.converged, done)
+
+
+# global_fit() worker state: the FitProblem, built once per process by
+# _init_worker()
+_WORKER = {}
+
+
+def _init_worker(batch_model, args, kwargs):
+    """Build a global_fit() worker's FitProblem (runs once per worker
+    process, so the data is sent to each worker once, not with every
+    task), and lower the worker's priority by WORKER_NICENESS."""
+    if hasattr(os, 'nice'):
+        os.nice(WORKER_NICENESS)
+    if isinstance(batch_model, str):
+        module_name, attribute = batch_model.split(':')
+        batch_model = getattr(importlib.import_module(module_name),
+                              attribute)
+    _WORKER['problem'] = FitProblem(batch_model, *args, **kwargs)
+
+
+def _fit_from(internal):
+    """Fit the worker's problem from a starting point (a global_fit()
+    task).
+
+    :return: (float, numpy.ndarray, int, [(int, int)...], bool) the cost,
+    the iterated values, the evaluations, the levels and convergence of the
+    fit.
+    """
+    problem = _WORKER['problem']
+    result = multiresolution_fit(problem, start=internal)
+    fitted = problem.to_internal([result.values[name]
+                                  for name in problem.free])
+    return (result.cost, fitted, result.evaluations, result.levels,
+            result.converged)
+
+
+def _fit_resample(internal, seed):
+    """Refit the worker's problem to the best fit plus its residuals
+    resampled with replacement (a global_fit() bootstrap task).
+
+    :param internal: (numpy.ndarray) the best fit's iterated values.
+    :param seed: (numpy.random.SeedSequence)
+    :return: (numpy.ndarray, int) the refitted free parameters and the
+    evaluations.
+    """
+    problem = _WORKER['problem']
+    key = internal.tobytes()
+    if _WORKER.get('fitted', (None,))[0] != key:
+        residuals = problem.residuals(internal)[0]
+        root_weights = problem._root_weights
+        safe = np.where(root_weights > 0, root_weights, 1.0)
+        _WORKER['fitted'] = (key, problem.y - residuals / safe, residuals,
+                             safe)
+    _, fitted, residuals, safe = _WORKER['fitted']
+    rng = np.random.default_rng(seed)
+    resampled = copy.copy(problem)
+    # weighted residuals are exchangeable; each is unweighted for the point
+    # it is added to
+    resampled.y = fitted + residuals[rng.integers(0, len(fitted),
+                                                  len(fitted))] / safe
+    resampled.evaluations = 0
+    result = multiresolution_fit(resampled, start=internal)
+    return (np.array([result.values[name] for name in problem.free]),
+            result.evaluations)
+
+
+def global_fit(batch_model, names, values, free, x, y, scan, scan_range,
+               starts=16, resamples=200, workers=None, seed=0,
+               mp_context='spawn', progress=None, **problem_kwargs):
+    """Fit a model from many starting points, and estimate the
+    uncertainty of the best fit by bootstrapping its residuals.
+
+    First one multiresolution fit is made from each of `starts` log-spaced
+    values of the `scan` parameter (the other free parameters starting at
+    their given values), and the fit with the lowest cost is kept. Then
+    `resamples` data sets are made by adding the best fit's residuals,
+    drawn with replacement, to its fitted spectrum, and each is refitted
+    from the best fit. The spread of those refits gives the confidence
+    intervals.
+
+    The fits run in parallel on a process pool. Each worker builds the
+    FitProblem once, from data sent when it starts; tasks only carry
+    starting values and random seeds.
+
+    :param batch_model: the batch function, or its 'module:attribute'
+    string (either must be importable by the workers).
+    :param names, values, free, x, y: as for FitProblem.
+    :param scan: (str) a free parameter, e.g. the rate constant.
+    :param scan_range: ((float, float)) the lowest and highest (positive)
+    starting values of scan.
+    :param starts: (int)
+    :param resamples: (int) bootstrap resamples (0 for none).
+    :param workers: (int or None) processes (default os.cpu_count()).
+    :param seed: (int) for the resampling.
+    :param mp_context: (str) the multiprocessing start method; the default,
+    'spawn', is safe in threaded processes such as the web server.
+    :param progress: optional function progress(done, total, cost, values)
+    called as each fit finishes, with the best cost and values ({name:
+    float}) so far; if it returns False, the remaining fits are cancelled
+    and Cancelled is raised.
+    :param problem_kwargs: bounds, log_params, weights, mask: as for
+    FitProblem.
+    :return: (FitResult) the best fit, with .starts and .intervals; its
+    evaluations are those of every fit.
+    :raises Cancelled: if progress returned False.
+    """
+    if isinstance(batch_model, str):
+        module_name, attribute = batch_model.split(':')
+        model_function = getattr(importlib.import_module(module_name),
+                                 attribute)
+    else:
+        model_function = batch_model
+    problem = FitProblem(model_function, names, values, free, x, y,
+                         **problem_kwargs)
+    if scan not in problem.free:
+        raise ValueError('the scanned parameter must be one of the free '
+                         'parameters')
+    low, high = scan_range
+    scan_values = np.logspace(math.log10(low), math.log10(high), starts)
+    external = np.tile(problem.values[problem._index], (starts, 1))
+    external[:, problem.free.index(scan)] = scan_values
+    start_points = problem.to_internal(
+        np.clip(external, problem.lower, problem.upper))
+
+    total = starts + resamples
+    state = {'done': 0, 'cost': np.inf, 'internal': None}
+
+    def report():
+        if progress is None or state['internal'] is None:
+            return
+        if progress(state['done'], total, state['cost'],
+                    values_dict(problem, state['internal'])) is False:
+            raise Cancelled()
+
+    def finished(cost=None, internal=None):
+        state['done'] += 1
+        if cost is not None and cost < state['cost']:
+            state['cost'], state['internal'] = cost, internal
+        report()
+
+    executor = ProcessPoolExecutor(
+        workers or os.cpu_count(), mp_context=get_context(mp_context),
+        initializer=_init_worker,
+        initargs=(batch_model, (names, values, free, x, y), problem_kwargs))
+    try:
+        futures = {executor.submit(_fit_from, point): value
+                   for point, value in zip(start_points, scan_values)}
+        fits = []
+        evaluations = 0
+        for future in as_completed(futures):
+            cost, internal, used, levels, converged = future.result()
+            evaluations += used
+            cost = cost if np.isfinite(cost) else np.inf
+            fits.append((futures[future], cost, internal, levels, converged))
+            finished(cost, internal)
+        fits.sort(key=lambda fit: fit[0])
+        best = min(fits, key=lambda fit: fit[1])
+
+        # the job may have been cancelled since the last fit finished
+        report()
+        seeds = np.random.SeedSequence(seed).spawn(resamples)
+        futures = [executor.submit(_fit_resample, best[2], child)
+                   for child in seeds]
+        samples = []
+        for future in as_completed(futures):
+            refit, used = future.result()
+            evaluations += used
+            samples.append(refit)
+            finished()
+    except BaseException:
+        # return without waiting for the fits still running (their
+        # workers exit when they finish), and drop those not started
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+
+    # the best fit's curvature errors, calculated here from one more
+    # evaluation at the minimum
+    internal = best[2]
+    residuals = problem.residuals(internal)[0]
+    errors = error_dict(problem, internal, residuals, None)
+    intervals = None
+    if samples:
+        samples = np.array(samples)
+        tail = (100 - CONFIDENCE) / 2
+        lows, highs = np.percentile(samples, [tail, 100 - tail], axis=0)
+        stds = samples.std(axis=0, ddof=1) if len(samples) > 1 \
+            else np.full(len(problem.free), np.nan)
+        intervals = {name: {'std': float(std), 'low': float(lo),
+                            'high': float(hi)}
+                     for name, std, lo, hi in zip(problem.free, stds, lows,
+                                                  highs)}
+    return FitResult(values_dict(problem, internal), errors, best[1],
+                     sum(iterations for _, iterations in best[3]),
+                     evaluations + problem.evaluations, best[4], best[3],
+                     [(float(value), float(cost))
+                      for value, cost, _, _, _ in fits], intervals)
+
+
+def noise_sigma(y):
+    """Estimate the noise level of a spectrum from the differences between
+    neighbouring points (robust to peaks, which are smooth).
+
+    :param y: (numpy.ndarray)
+    :return: (float) the standard deviation of the noise.
+    """
+    steps = np.diff(y)
+    mad = np.median(np.abs(steps - np.median(steps)))
+    # the difference of two noise values has sqrt(2) times their sigma
+    return float(1.4826 * mad / np.sqrt(2))
+
+
+def peak_mask(x, y, threshold=PEAK_THRESHOLD, margin=None):
+    """Find the regions of a spectrum around its peaks: the runs of points
+    more than `threshold` noise sigmas above the baseline (the median), each
+    widened by `margin` on both sides to keep the peaks' tails. The
+    spectrum is smoothed over about 1/2000 of its points first, so that
+    noise does not break up the runs (the threshold is still relative to
+    the noise of single points).
+
+    :param x, y: (numpy.ndarray) the spectrum, sorted by x.
+    :param threshold: (float)
+    :param margin: (float or None) in x units; default half the width of
+    each run.
+    :return: (numpy.ndarray) True for the points in a region; every point
+    if none are above the threshold.
+    """
+    window = max(1, len(y) // 2000)
+    smooth = np.convolve(y, np.ones(window) / window, mode='same')
+    above = smooth - np.median(smooth) > threshold * noise_sigma(y)
+    if not above.any():
+        return np.ones(len(x), dtype=bool)
+    # the first and last index of each run of points above the threshold
+    starts = np.flatnonzero(above & ~np.append(False, above[:-1]))
+    ends = np.flatnonzero(above & ~np.append(above[1:], False))
+    low, high = x[starts], x[ends]
+    widen = (high - low) / 2 if margin is None else margin
+    return ranges_mask(x, zip(low - widen, high + widen))
+
+
+def ranges_mask(x, ranges):
+    """
+    :param x: (numpy.ndarray) the frequencies of a spectrum.
+    :param ranges: ((float, float)...) frequency ranges, in either order.
+    :return: (numpy.ndarray) True for the points within any of the ranges.
+    """
+    mask = np.zeros(len(x), dtype=bool)
+    for low, high in ranges:
+        low, high = min(low, high), max(low, high)
+        mask |= (x >= low) & (x <= high)
+    return mask
+
+
+def values_dict(problem, internal):
+    """:return: ({str: float}) every parameter's value."""
+    return dict(zip(problem.names,
+                    (float(v) for v in problem.full_values(internal))))
+
+
+def error_dict(problem, internal, residuals, jacobian):
+    """:return: ({str: float}) the standard errors of the free parameters,
+    from the Jacobian at the minimum."""
+    if jacobian is None:
+        jacobian = problem.jacobian(internal, residuals)
+    # two more degrees of freedom are used by the scale and offset
+    dof = max(len(residuals) - len(internal) - 2, 1)
+    variance = float(residuals @ residuals) / dof
+    try:
+        covariance = np.linalg.inv(jacobian.T @ jacobian) * variance
+        sigma = np.sqrt(np.abs(np.diag(covariance)))
+    except np.linalg.LinAlgError:
+        sigma = np.full(len(internal), np.nan)
+    values = problem.to_external(internal)
+    # a log parameter's error is (approximately) value * error of its log
+    sigma = np.where(problem._log, values * sigma, sigma)
+    return dict(zip(problem.free, (float(s) for s in sigma)))
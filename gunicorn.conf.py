@@ -0,0 +1,30 @@
+"""gunicorn settings for serving pyDNMR-Web.
+
+gunicorn -c gunicorn.conf.py wsgi:application
+
+The worker and thread counts are read from the environment:
+* PYDNMR_BIND: address to listen on (default 0.0.0.0:8050)
+* PYDNMR_WORKERS: number of worker processes (default 2 * CPUs + 1)
+* PYDNMR_THREADS: number of threads per worker (default 4)
+* PYDNMR_MICROBATCH_MS: if set, batch concurrent requests within each
+  worker over this many milliseconds (see webapp.py)
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('PYDNMR_BIND', '0.0.0.0:8050')
+workers = int(os.environ.get('PYDNMR_WORKERS',
+                             2 * multiprocessing.cpu_count() + 1))
+threads = int(os.environ.get('PYDNMR_THREADS', 4))
+worker_class = 'gthread'
+# Build the app once in the master; workers inherit it on fork.
+preload_app = True
+
+
+def post_fork(server, worker):
+    """Initialize each worker's model state once, after fork."""
+    import wsgi
+    from webapp import warm_up
+
+    warm_up(wsgi.app)
+    server.log.info('Worker %s warmed up', worker.pid)
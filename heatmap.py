@@ -0,0 +1,209 @@
+"""Parameter-space heatmaps: how a model's spectrum changes over two
+parameters at once.
+
+Provides the following:
+*sweep_values(): the values of one parameter sweep.
+*parameter_cube(): the spectra over a grid of two swept parameters, as a
+(slider steps, row steps, points) array, calculated a chunk of rows at a
+time with the model's batch function.
+*quantize(): a cube as uint8 levels, for a compact binary payload.
+*DashHeatmap: the "parameter map" section of a model's page, showing one
+slice of the cube (intensity by frequency and one parameter) with a slider
+for the other parameter.
+
+The sweeps a model offers are declared in its registry entry, as
+'sweeps': {entry name: (min, max, 'log' or 'linear')}.
+"""
+import math
+
+import numpy as np
+import dash_core_components as dcc
+import dash_html_components as html
+from dash.dependencies import Input, Output
+from dash.exceptions import PreventUpdate
+
+# Values per sweep, and points per spectrum, of a cube
+STEPS = 40
+POINTS = 400
+# Approximate number of values calculated at a time
+CHUNK_VALUES = 2 ** 18
+
+
+def sweep_values(sweep, steps=STEPS):
+    """:param sweep: ((float, float, str)) min, max and 'log' or 'linear'.
+    :return: (numpy.ndarray) the swept values."""
+    low, high, scale = sweep
+    if scale == 'log':
+        return np.logspace(math.log10(low), math.log10(high), steps)
+    return np.linspace(low, high, steps)
+
+
+def parameter_cube(model, values, row_param, slider_param, steps=STEPS,
+                   points=POINTS, chunk_values=CHUNK_VALUES):
+    """Calculate the spectra over every combination of two swept
+    parameters, on one frequency grid covering all of them.
+
+    :param model: (BaseDashModel) a model with a batch_model, batch_grid and
+    sweeps.
+    :param values: ([float...]) the parameters in entry_names order; the
+    values of the two swept parameters are ignored.
+    :param row_param, slider_param: (str) the swept entry names.
+    :return: (numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray)
+    the row values (steps,), the slider values (steps,), the frequency grid
+    (points,) and the float32 cube (steps, steps, points) of intensities,
+    indexed [slider, row, frequency].
+    """
+    names = model.entry_names
+    rows = sweep_values(model.sweeps[row_param], steps)
+    slider = sweep_values(model.sweeps[slider_param], steps)
+    slider_grid, row_grid = np.meshgrid(slider, rows, indexing='ij')
+    columns = [np.full(slider_grid.size, float(value)) for value in values]
+    columns[names.index(row_param)] = row_grid.ravel()
+    columns[names.index(slider_param)] = slider_grid.ravel()
+
+    # the range covering every parameter set's own grid
+    limits = model.batch_grid(*columns, points=2)
+    x = np.linspace(limits[:, 0].min(), limits[:, -1].max(), points)
+
+    cube = np.empty((slider_grid.size, points), dtype=np.float32)
+    chunk = max(1, chunk_values // points)
+    for start in range(0, slider_grid.size, chunk):
+        cube[start:start + chunk] = model.batch_model(
+            x, *[column[start:start + chunk] for column in columns])
+    return rows, slider, x, cube.reshape(steps, steps, points)
+
+
+def quantize(cube):
+    """Scale a cube to 256 levels.
+
+    :return: (numpy.ndarray, float, float) the uint8 levels, and the
+    intensities of levels 0 and 255.
+    """
+    low, high = float(cube.min()), float(cube.max())
+    scale = 255 / (high - low) if high > low else 0.0
+    levels = np.rint((cube - low) * scale).astype(np.uint8)
+    return levels, low, high
+
+
+class DashHeatmap:
+    """The parameter map section of a model's page.
+
+    Has the following attributes:
+    * model: (BaseDashModel) the model mapped.
+    * layout: (html.Div) the section: a "show" checkbox, and the map's
+    controls and graph, hidden until it is checked; the cube is only
+    calculated while it is checked.
+    """
+    def __init__(self, model):
+        self.model = model
+        prefix = '{}-map'.format(model.id)
+        self.ids = {part: '{}-{}'.format(prefix, part)
+                    for part in ('show', 'body', 'rows', 'slider-param',
+                                 'slider', 'graph')}
+        self.id = prefix
+        options = [{'label': name, 'value': name} for name in model.sweeps]
+        sweeps = list(model.sweeps)
+
+        controls = [
+            html.Div([
+                html.Label('rows'),
+                dcc.Dropdown(id=self.ids['rows'], options=options,
+                             value=sweeps[0], clearable=False)],
+                style={'display': 'inline-block', 'width': '45%'}),
+            html.Div([
+                html.Label('slider'),
+                dcc.Dropdown(id=self.ids['slider-param'], options=options,
+                             value=sweeps[1], clearable=False)],
+                style={'display': 'inline-block', 'width': '45%'}),
+            dcc.Graph(id=self.ids['graph']),
+            dcc.Slider(id=self.ids['slider'], min=0, max=STEPS - 1, step=1,
+                       value=STEPS // 2)
+        ]
+        # a Checklist rather than html.Details, whose 'open' property is not
+        # reported back by the browser
+        self.layout = html.Div(id=prefix, children=[
+            dcc.Checklist(
+                id=self.ids['show'],
+                options=[{'label': 'show parameter map', 'value': 'on'}],
+                value=[]),
+            html.Div(controls, id=self.ids['body'],
+                     style={'display': 'none'})
+        ])
+
+    def register_callbacks(self, app):
+        """Add the callbacks that show the map, label the slider and draw
+        the map.
+
+        :param app: (dash.Dash)
+        """
+        model = self.model
+
+        @app.callback(Output(self.ids['body'], 'style'),
+                      [Input(self.ids['show'], 'value')])
+        def show_map(show):
+            return {} if show else {'display': 'none'}
+
+        @app.callback(Output(self.ids['slider'], 'marks'),
+                      [Input(self.ids['slider-param'], 'value')])
+        def label_slider(slider_param):
+            values = sweep_values(model.sweeps[slider_param])
+            return {i: '{:.3g}'.format(values[i])
+                    for i in range(0, STEPS, STEPS // 8)}
+
+        inputs = [Input(self.ids['show'], 'value'),
+                  Input(self.ids['rows'], 'value'),
+                  Input(self.ids['slider-param'], 'value'),
+                  Input(self.ids['slider'], 'value')]
+        inputs += [Input('{}-{}'.format(model.id, entry), 'value')
+                   for entry in model.entry_names]
+
+        @app.callback(Output(self.ids['graph'], 'figure'), inputs)
+        def update_map(show, row_param, slider_param, index,
+                       *string_values):
+            """:return: (dict) the heatmap of the selected slice."""
+            if not show or row_param == slider_param:
+                raise PreventUpdate
+            values = [float(value) for value in string_values]
+            return self.figure(values, row_param, slider_param, int(index))
+
+    def figure(self, values, row_param, slider_param, index):
+        """The heatmap of one slice of the cube: intensity by frequency and
+        row_param, at the index-th value of slider_param.
+
+        :return: (dict) the kwargs for the Graph's figure.
+        """
+        # the levels (0-255) are sent instead of the intensities, so that
+        # the JSON stays small; the colour bar is labelled in intensities.
+        # They are cached with the cube, so moving the slider only slices.
+        rows, slider, x, levels, low, high = self.model.quantized_cube(
+            values, row_param, slider_param)
+        ticks = np.linspace(0, 255, 6)
+        return {
+            'data': [{
+                'type': 'heatmap',
+                'x': x,
+                'y': rows,
+                'z': levels[index],
+                'zmin': 0,
+                'zmax': 255,
+                'colorscale': 'Viridis',
+                'colorbar': {
+                    'tickvals': ticks,
+                    'ticktext': ['{:.3g}'.format(low + tick / 255 *
+                                                 (high - low))
+                                 for tick in ticks]},
+                'hoverinfo': 'x+y'
+            }],
+            'layout': {
+                'title': '{} = {:.3g}'.format(slider_param, slider[index]),
+                'xaxis': {'title': 'frequency', 'autorange': 'reversed'},
+                'yaxis': {'title': row_param,
+                          'type': model_axis_type(self.model, row_param)},
+                'margin': {'l': 60, 'b': 40, 't': 40, 'r': 10}}
+        }
+
+
+def model_axis_type(model, param):
+    """:return: (str) the Plotly axis type ('log' or 'linear') for a swept
+    parameter."""
+    return 'log' if model.sweeps[param][2] == 'log' else 'linear'
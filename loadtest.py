@@ -0,0 +1,349 @@
+"""Load test: simulated users typing into the app's models.
+
+Starts the app on a local port in a separate process (or uses --url to test
+a server that is already running), then runs --users concurrent simulated
+users against the Dash callback endpoint for --duration seconds. Each user:
+
+* loads the page (URL routing callback, then the model layout and first
+  graph, or the first graph of every model if the layouts are all mounted
+  with the page);
+* edits one parameter at a time, sending a graph update for each keystroke
+  of the new value (e.g. 2, 24, 247, 247.3), with a short pause between
+  keystrokes and a longer one between edits;
+* now and then switches to the other model through the URL routing
+  callback (display_page), as if following a link.
+
+The callbacks are found through /_dash-dependencies and the model parameters
+through /api/models, so no app code is imported here. Reports the
+throughput, the p50/p95/p99 latency of each kind of callback, errors, and
+the growth of the server's resident memory (read from /proc, on Linux; use
+--server-pid with --url).
+
+Usage: python loadtest.py [--users N] [--duration S] [--think F]
+       [--switch-prob P] [--url URL [--server-pid PID]] [--seed N]
+"""
+import argparse
+import http.client
+import json
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+# Run by the server process: serve create_app() on 127.0.0.1:<argv[1]>.
+SERVER_SCRIPT = """
+import sys
+from werkzeug.serving import run_simple
+from webapp import create_app
+
+app = create_app()
+run_simple('127.0.0.1', int(sys.argv[1]), app.server, threaded=True)
+"""
+
+
+class Client:
+    """An HTTP/1.1 connection to the app, for one simulated user."""
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname,
+                                                     parts.port or 80,
+                                                     timeout=60)
+        self.prefix = parts.path.rstrip('/')
+
+    def request(self, method, path, body=None):
+        """:return: (int, bytes) the status and body of the response."""
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.connection.request(method, self.prefix + path, body,
+                                    headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            raise
+
+    def get_json(self, path):
+        status, data = self.request('GET', path)
+        if status != 200:
+            raise RuntimeError('GET {}: HTTP {}'.format(path, status))
+        return json.loads(data)
+
+
+def callback_payload(dependency, values):
+    """The body the Dash renderer posts to /_dash-update-component when the
+    first Input of a callback changes.
+
+    :param dependency: one entry of /_dash-dependencies.
+    :param values: the values of the callback's first Inputs, in order (the
+    rest are None).
+    """
+    values = list(values) + [None] * (len(dependency['inputs']) - len(values))
+    inputs = [dict(id=i['id'], property=i['property'], value=value)
+              for i, value in zip(dependency['inputs'], values)]
+    output = dependency['output']
+    payload = {'output': output, 'inputs': inputs, 'state': []}
+    if isinstance(output, str):
+        # Dash >= 0.40 names the output 'id.property'
+        output_id, output_property = output.rsplit('.', 1)
+        payload['outputs'] = {'id': output_id, 'property': output_property}
+        payload['changedPropIds'] = ['{}.{}'.format(inputs[0]['id'],
+                                                    inputs[0]['property'])]
+    return payload
+
+
+def find_callbacks(dependencies, models):
+    """Identify the app's callbacks.
+
+    :param dependencies: the /_dash-dependencies list.
+    :param models: the /api/models dict.
+    :return: (dependency or None, dependency or None, {str: dependency})
+    the URL routing callback (url.pathname -> model-select.value), the model
+    layout callback (-> page-content.children, if any), and each model's graph
+    callback by model name.
+    """
+    routing = layout = None
+    graphs = {}
+    for dependency in dependencies:
+        ids = [i['id'] for i in dependency['inputs']]
+        output = dependency['output']
+        output_id = (output.rsplit('.', 1)[0] if isinstance(output, str)
+                     else output['id'])
+        if ids == ['url']:
+            routing = dependency
+        elif output_id == 'page-content':
+            layout = dependency
+        for name, model in models.items():
+            entries = model['parameters']
+            prefix = ids[0][:-len(entries[0]) - 1] if ids else ''
+            # any further Inputs (e.g. the Graph's relayoutData) are sent as
+            # None
+            if ids[:len(entries)] == ['{}-{}'.format(prefix, entry)
+                                      for entry in entries]:
+                graphs[name] = dependency
+    return routing, layout, graphs
+
+
+def keystrokes(old, entry, rng):
+    """The successive values of a number Input while a user types a new
+    value over `old`.
+
+    :return: ([float...]) one value per keystroke that changes the number.
+    """
+    if 'max' in entry and 'min' in entry:
+        target = rng.uniform(entry['min'], entry['max'])
+    else:
+        target = old * rng.uniform(0.5, 2) if old else rng.uniform(1, 100)
+    text = '{:.1f}'.format(target)
+    values = []
+    for i in range(1, len(text) + 1):
+        value = float(text[:i].rstrip('.'))
+        value = max(value, entry.get('min', value))
+        value = min(value, entry.get('max', value))
+        if not values or value != values[-1]:
+            values.append(value)
+    return values
+
+
+class User(threading.Thread):
+    """One simulated user; records (kind, seconds, ok) for each request."""
+    def __init__(self, url, models, callbacks, args, seed):
+        super().__init__(daemon=True)
+        self.client = Client(url)
+        self.models = models
+        self.routing, self.layout, self.graphs = callbacks
+        self.args = args
+        self.rng = random.Random(seed)
+        self.records = []
+
+    def call(self, kind, dependency, values):
+        start = time.perf_counter()
+        try:
+            status, _ = self.client.request(
+                'POST', '/_dash-update-component',
+                callback_payload(dependency, values))
+            ok = status == 200
+        except (OSError, http.client.HTTPException):
+            ok = False
+        self.records.append((kind, time.perf_counter() - start, ok))
+
+    def pause(self, low, high):
+        time.sleep(self.rng.uniform(low, high) * self.args.think)
+
+    def defaults(self, name):
+        """:return: ([float...]) a model's initial Input values."""
+        return [self.models[name]['entries'][entry]['value']
+                for entry in self.models[name]['parameters']]
+
+    def open_model(self, name):
+        """Follow a link to a model's page; :return: its Input values."""
+        if self.routing is not None:
+            self.call('display_page', self.routing, ['/' + name])
+        values = self.defaults(name)
+        if self.layout is not None:
+            # the new layout's Inputs fire the graph callback
+            self.call('display_model', self.layout, [name])
+            self.call('graph ' + name, self.graphs[name], values)
+        return values
+
+    def run(self):
+        names = sorted(self.graphs)
+        deadline = time.monotonic() + self.args.duration
+        name = self.rng.choice(names)
+        state = {name: self.open_model(name)}
+        if self.layout is None:
+            # every model's layout is mounted with the page, and fires its
+            # graph callback once
+            for other in names:
+                state[other] = self.defaults(other)
+                self.call('graph ' + other, self.graphs[other], state[other])
+        while time.monotonic() < deadline:
+            if len(names) > 1 and self.rng.random() < self.args.switch_prob:
+                name = self.rng.choice([n for n in names if n != name])
+                opened = self.open_model(name)
+                if self.layout is not None or name not in state:
+                    state[name] = opened
+                self.pause(1, 3)
+                continue
+            model = self.models[name]
+            values = state[name]
+            i = self.rng.randrange(len(values))
+            entry = model['entries'][model['parameters'][i]]
+            for value in keystrokes(values[i], entry, self.rng):
+                values[i] = value
+                self.call('graph ' + name, self.graphs[name], values)
+                self.pause(0.08, 0.25)
+                if time.monotonic() >= deadline:
+                    break
+            self.pause(1, 4)
+
+
+def rss_bytes(pid):
+    """:return: (int or None) the resident memory of process pid (Linux)."""
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server():
+    """Start the app in a child process; :return: (Popen, str) the process
+    and its URL, once it answers requests."""
+    port = free_port()
+    process = subprocess.Popen([sys.executable, '-c', SERVER_SCRIPT,
+                                str(port)], stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:{}'.format(port)
+    for _ in range(300):
+        if process.poll() is not None:
+            raise RuntimeError('the server exited with code {}'.format(
+                process.returncode))
+        try:
+            Client(url).get_json('/api/models')
+            return process, url
+        except (OSError, http.client.HTTPException, RuntimeError):
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('the server did not start')
+
+
+def percentile(sorted_values, q):
+    """:return: the q-th percentile (0-100) of sorted_values (nearest
+    rank)."""
+    index = max(0, int(round(q / 100 * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def report(records, elapsed, memory):
+    """Print a summary of the request records and memory samples."""
+    by_kind = defaultdict(list)
+    for kind, seconds, ok in records:
+        by_kind[kind].append((seconds, ok))
+    by_kind['all'] = [(seconds, ok) for _, seconds, ok in records]
+    print('{} requests in {:.1f} s: {:.1f} requests/s'.format(
+        len(records), elapsed, len(records) / elapsed))
+    print('{:<28}{:>8}{:>8}{:>10}{:>10}{:>10}'.format(
+        'callback', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for kind in sorted(by_kind, key=lambda k: (k == 'all', k)):
+        times = sorted(seconds for seconds, _ in by_kind[kind])
+        errors = sum(not ok for _, ok in by_kind[kind])
+        print('{:<28}{:>8}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+            kind, len(times), errors, *(1000 * percentile(times, q)
+                                        for q in (50, 95, 99))))
+    samples = [rss for rss in memory if rss is not None]
+    if samples:
+        mib = 1024 * 1024
+        print('server RSS: start {:.1f} MiB, peak {:.1f} MiB, end {:.1f} MiB'
+              ' (growth {:+.1f} MiB)'.format(
+                  samples[0] / mib, max(samples) / mib, samples[-1] / mib,
+                  (samples[-1] - samples[0]) / mib))
+    else:
+        print('server RSS: not available')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds')
+    parser.add_argument('--think', type=float, default=1.0,
+                        help='scale for the pauses between keystrokes and '
+                             'edits (0: no pauses)')
+    parser.add_argument('--switch-prob', type=float, default=0.1,
+                        help='chance of switching models instead of editing')
+    parser.add_argument('--url', help='test this server instead of starting '
+                                      'one')
+    parser.add_argument('--server-pid', type=int,
+                        help='process to measure the memory of, with --url')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    process = None
+    if args.url:
+        url, pid = args.url, args.server_pid
+    else:
+        process, url = start_server()
+        pid = process.pid
+    try:
+        client = Client(url)
+        models = client.get_json('/api/models')
+        callbacks = find_callbacks(client.get_json('/_dash-dependencies'),
+                                   models)
+        if not callbacks[2]:
+            parser.exit(1, 'error: no model graph callbacks found\n')
+
+        memory = [rss_bytes(pid) if pid else None]
+        users = [User(url, models, callbacks, args, args.seed + i)
+                 for i in range(args.users)]
+        start = time.perf_counter()
+        for user in users:
+            user.start()
+        while any(user.is_alive() for user in users):
+            time.sleep(0.25)
+            memory.append(rss_bytes(pid) if pid else None)
+        elapsed = time.perf_counter() - start
+        report([record for user in users for record in user.records],
+               elapsed, memory)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Request instrumentation, exported in the Prometheus text format.
+
+Provides the following:
+*Metrics: a thread-safe collection of latency histograms and counters,
+labelled by model (and stage), that renders itself as Prometheus text.
+*METRICS: the Metrics instance used by the app.
+*create_metrics_blueprint(): a Flask Blueprint serving METRICS at /metrics.
+
+Stages timed for each model:
+* parse: converting the callback's input strings (or API parameters) to
+  floats.
+* model: calculating the spectrum (cache misses only).
+* animation: calculating the frames of an exchange-rate sweep.
+* downsample: reducing a large spectrum to the Graph's width.
+* zoom: recalculating the zoomed-in window of the Graph (if zoomed in).
+* fit: a background fit to a measured spectrum (see fitjobs.py).
+* figure: building the Graph figure from the spectrum.
+* serialize: everything else in the request, mostly JSON serialization of
+  the response.
+
+Each server process keeps its own metrics; with several workers, each
+worker's /metrics covers only the requests it served.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, g, has_request_context
+
+# Upper bounds (seconds) of the latency histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """Counts of observations per bucket, plus their sum and count."""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Latency histograms by (model, stage), and counters by model."""
+
+    counter_help = {
+        'errors': 'Requests that raised an exception.',
+        'cache_hits': 'Spectra served from the cache.',
+        'cache_misses': 'Spectra calculated.',
+    }
+
+    def __init__(self, prefix='pydnmr'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = defaultdict(int)
+
+    def observe(self, model, stage, seconds):
+        """Record the time taken by one stage of one request."""
+        with self._lock:
+            histogram = self._histograms.get((model, stage))
+            if histogram is None:
+                histogram = self._histograms[(model, stage)] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, model, amount=1):
+        """Add to one of the counters named in counter_help."""
+        with self._lock:
+            self._counters[(name, model)] += amount
+
+    @contextmanager
+    def time(self, model, stage):
+        """Context manager that observes the time taken by its block. The
+        time is also added to flask.g.timed_seconds (if in a request), so
+        that the rest of the request can be attributed to 'serialize'."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(model, stage, elapsed)
+            if has_request_context():
+                g.timed_seconds = g.get('timed_seconds', 0.0) + elapsed
+                g.timed_model = model
+
+    def render(self):
+        """:return: (str) the metrics in the Prometheus text format."""
+        name = self.prefix + '_stage_seconds'
+        lines = ['# HELP {} Time spent in each stage of a request.'
+                 .format(name),
+                 '# TYPE {} histogram'.format(name)]
+        with self._lock:
+            for (model, stage), histogram in sorted(self._histograms.items()):
+                labels = 'model="{}",stage="{}"'.format(model, stage)
+                cumulative = 0
+                bounds = [repr(b) for b in histogram.buckets] + ['+Inf']
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        name, labels, bound, cumulative))
+                lines.append('{}_sum{{{}}} {}'.format(
+                    name, labels, repr(histogram.sum)))
+                lines.append('{}_count{{{}}} {}'.format(
+                    name, labels, histogram.count))
+            for counter, help_text in self.counter_help.items():
+                name = '{}_{}_total'.format(self.prefix, counter)
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} counter'.format(name))
+                for (counter_, model), value in sorted(self._counters.items()):
+                    if counter_ == counter:
+                        lines.append('{}{{model="{}"}} {}'.format(
+                            name, model, value))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+def create_metrics_blueprint(metrics=METRICS):
+    """Create a Blueprint that serves metrics at /metrics, and attributes the
+    untimed part of each instrumented request to the 'serialize' stage.
+
+    :return: (flask.Blueprint)
+    """
+    blueprint = Blueprint('metrics', __name__)
+
+    @blueprint.before_app_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @blueprint.after_app_request
+    def time_rest_of_request(response):
+        model = g.get('timed_model')
+        if model is not None and 'request_start' in g:
+            total = time.perf_counter() - g.request_start
+            metrics.observe(model, 'serialize',
+                            max(total - g.timed_seconds, 0.0))
+        return response
+
+    @blueprint.route('/metrics')
+    def export():
+        """:return: the metrics, as Prometheus text."""
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    return blueprint
@@ -0,0 +1,109 @@
+"""Micro-batching of concurrent single-spectrum requests.
+
+Provides the following class:
+*MicroBatcher: a drop-in replacement for a model function that collects the
+calls made by concurrent threads within a short window and evaluates them
+with one call of the model's vectorized batch function.
+"""
+import threading
+
+import numpy as np
+
+
+class _Request:
+    """One caller's parameters, and its result once the batch is done."""
+    def __init__(self, values):
+        self.values = values
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Batch:
+    """The requests collected during one window."""
+    def __init__(self):
+        self.requests = []
+        self.full = threading.Event()
+
+
+class MicroBatcher:
+    """Evaluates concurrent calls for one model together.
+
+    The first caller to arrive when no batch is open starts one, and waits up
+    to `window` seconds (less if max_batch calls arrive) for other callers to
+    join it. It then evaluates every call in the batch with one call of
+    batch_model, on one grid per call, and hands each caller its own (x, y).
+    A call therefore takes at most `window` seconds longer than the batched
+    evaluation itself. No extra threads are used.
+
+    Has the following attributes:
+    * window: (float) the longest time, in seconds, a batch stays open.
+    * max_batch: (int) the number of calls that closes a batch early.
+    * batches, calls: (int) counts of batches evaluated and calls served.
+    """
+    def __init__(self, batch_model, batch_grid, window=0.005, max_batch=64):
+        """
+        :param batch_model: a function batch_model(x, *columns) -> (m, n)
+        array, where x is (m, n) (see dnmrplot.dnmrplot_2spin_batch).
+        :param batch_grid: a function batch_grid(*columns) -> (m, n) array of
+        the grid for each call (see dnmrplot.dnmrplot_grids).
+        :param window: (float) see class docstring.
+        :param max_batch: (int) see class docstring.
+        """
+        self.batch_model = batch_model
+        self.batch_grid = batch_grid
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def __call__(self, *values):
+        """Same signature and return value as the model function.
+
+        :param values: (float,) the model parameters.
+        :return: (numpy.ndarray, numpy.ndarray) x and y for these values.
+        """
+        request = _Request(values)
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.requests.append(request)
+            if len(batch.requests) >= self.max_batch:
+                # closed: later callers start a new batch
+                self._batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            self._evaluate(batch.requests)
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _evaluate(self, requests):
+        """Evaluate a closed batch, and release its callers."""
+        try:
+            columns = [np.array(column, dtype=float)
+                       for column in zip(*(r.values for r in requests))]
+            x = self.batch_grid(*columns)
+            y = self.batch_model(x, *columns)
+            for i, request in enumerate(requests):
+                request.result = x[i], y[i]
+        except Exception as e:
+            for request in requests:
+                request.error = e
+        finally:
+            with self._lock:
+                self.batches += 1
+                self.calls += len(requests)
+            for request in requests:
+                request.done.set()
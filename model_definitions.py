@@ -1,17 +1,65 @@
-"""Provides keyword arguments for the creation of BaseDashModel objects.
+"""Provides keyword arguments for the creation of BaseDashModel objects, and
+the registry of models available to the app.
 
 Current models (all keyword arguments end with _kwargs):
 * dnmr_two_spin: DNMR simulation for two uncoupled spins
 * dnmr_AB: DNMR simulation for two coupled spins (AB quartet at the
 slow-exchange limit)
+
+To add a model, call register_model() with its BaseDashModel kwargs, either
+here or in a separate package that declares an entry point in the
+'pydnmr_web.models' group (see load_plugins). The 'model' kwarg is a
+'module:attribute' string, so that the module doing the calculations is
+only imported when the model is first used.
 """
+from collections import OrderedDict
+
+PLUGIN_GROUP = 'pydnmr_web.models'
+
+# {name: kwargs}, in the order the models are shown in the app
+MODELS = OrderedDict()
+
+
+def register_model(kwargs):
+    """Add a model to the registry.
+
+    :param kwargs: ({str: object}) the kwargs for the model's BaseDashModel.
+    :return: the kwargs, unchanged.
+    """
+    MODELS[kwargs['name']] = kwargs
+    return kwargs
+
+
+def load_plugins():
+    """Register the models declared by installed packages under the
+    'pydnmr_web.models' entry point group. Each entry point must refer to a
+    kwargs dict like the ones in this module.
+
+    :return: ([str]) the names of the models registered.
+    """
+    # importlib.metadata costs more to import than the rest of this module
+    from importlib import metadata
+
+    names = []
+    for entry_point in metadata.entry_points(group=PLUGIN_GROUP):
+        kwargs = register_model(entry_point.load())
+        names.append(kwargs['name'])
+    return names
 
-from dnmrplot import dnmrplot_2spin, dnmrplot_AB
 
-dnmr_two_singlets_kwargs = {
+dnmr_two_singlets_kwargs = register_model({
     'name': 'dnmr-two-singlets',
     'id_': 'dnmr-2s',
-    'model': dnmrplot_2spin,
+    'model': 'dnmrplot:DnmrPlot2Spin',
+    'batch_model': 'dnmrplot:dnmrplot_2spin_batch',
+    'batch_grid': 'dnmrplot:dnmrplot_grids',
+    'lineshape': 'dnmrplot:lineshape_2spin',
+    # exchange-rate sweep played by the 'animate' checkbox
+    'animation': {'parameter': 'ka', 'min': 0.1, 'max': 10000, 'frames': 100},
+    # parameters that can be swept in the parameter map: (min, max, scale)
+    'sweeps': {'ka': (0.1, 10000, 'log'),
+               'pa': (1, 99, 'linear'),
+               'wa': (0.1, 10, 'log')},
     # list order reflects left-->right order of widgets in top toolbar
     'entry_names': ['va', 'vb', 'ka', 'wa', 'wb', 'pa'],
     # each Input widget has the following custom kwargs:
@@ -32,12 +80,19 @@ dnmr_two_singlets_kwargs = {
             'min': 0,
             'max': 100}
     }
-}
+})
 
-dnmr_AB_kwargs = {
+dnmr_AB_kwargs = register_model({
     'name': 'dnmr-AB',
     'id_': 'dnmr-AB',
-    'model': dnmrplot_AB,
+    'model': 'dnmrplot:dnmrplot_AB',
+    'batch_model': 'dnmrplot:dnmrplot_AB_batch',
+    'batch_grid': 'dnmrplot:dnmrplot_grids',
+    'lineshape': 'dnmrplot:lineshape_AB',
+    'animation': {'parameter': 'k', 'min': 0.1, 'max': 10000, 'frames': 100},
+    'sweeps': {'k': (0.1, 10000, 'log'),
+               'J': (0, 30, 'linear'),
+               'w': (0.1, 10, 'log')},
     # list order reflects left-->right order of widgets in top toolbar
     'entry_names': ['va', 'vb', 'J', 'k', 'w'],
     # each Input widget has the following custom kwargs:
@@ -52,4 +107,4 @@ dnmr_AB_kwargs = {
             'value': 0.5,
             'min': 0.01}
     }
-}
+})
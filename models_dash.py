@@ -4,11 +4,20 @@ Provides the following class:
 *BaseDashModel: creates the layout for a model, and has a method for updating
 the plot associated with the model.
  """
+import importlib
+import math
+
+import numpy as np
 import dash_core_components as dcc
 import dash_html_components as html
-import plotly.graph_objs as go
 from dash.dependencies import Input, Output
 
+import heatmap
+from cache import LRUCache
+from experimental import OVERLAY_JS, merge_figure
+from metrics import METRICS
+from microbatch import MicroBatcher
+
 
 class BaseDashModel:
     """Provides calls to the Model for simulation calculations, and the Dash
@@ -18,8 +27,28 @@ class BaseDashModel:
     * name: (str) a descriptive name for the model.
     * id: (str) an identifier; also used as a prefix for creating the unique
     component names required for callbacks.
-    * model: (function) a reference to the function used to calculate the
-    lineshape.
+    * model: (callable) a reference to the function (or callable object) used
+    to calculate the lineshape. May be given as a 'module:attribute' string,
+    which is imported on first use (a class is instantiated).
+    * batch_model: (callable or None) optionally, a vectorized version of
+    model, with the signature batch_model(x, *arrays) -> 2-D array (see
+    dnmrplot.dnmrplot_2spin_batch). May also be a 'module:attribute' string.
+    * batch_grid: (callable or None) optionally, a function returning the
+    grid model would use for each of a batch of parameter sets (see
+    dnmrplot.dnmrplot_grids). May also be a 'module:attribute' string.
+    * lineshape: (callable or None) optionally, a function returning the
+    compiled lineshape (a function of frequency) for a set of input values,
+    used to re-evaluate a zoomed-in window of the graph at full resolution
+    (see dnmrplot.lineshape_2spin). May also be a 'module:attribute' string.
+    * animation: ({str: object} or None) optionally, an exchange-rate
+    sweep that can be played in the Graph: {'parameter': the entry name of
+    the rate, 'min': float, 'max': float, 'frames': int}. The frames are
+    log-spaced and calculated with one batch_model call.
+    * sweeps: ({str: (float, float, str)} or None) optionally, the entries
+    that can be swept in a parameter map (see heatmap.py), with their (min,
+    max, 'log' or 'linear') ranges.
+    * microbatcher: (MicroBatcher or None) if set (see
+    .enable_microbatching()), used by .spectrum() instead of model.
     * entry_names: ([str...]) the names for the Input widgets, listed in left
     to right order.
     * entry_dict: ({str: {**kwargs}}) dict that matches entry name to kwargs
@@ -29,14 +58,50 @@ class BaseDashModel:
     * output: (Output) the Output object to be used in Dash callbacks,
     providing the destination for the .update_graph() figure.
     * inputs: ([Input...]) the list of Input objects to be used in Dash
-    callbacks.
+    callbacks: the entries, then the Graph's relayoutData (zoom events) if
+    the model has a lineshape, then the animation checkbox if it has an
+    animation.
+    * points: (int or None) the number of points .spectrum() calculates
+    (passed to model, batch_grid as points=); None for the model's default.
+    Spectra with more points than the Graph can show are downsampled for
+    display (see display_width), but are available at full resolution
+    through .spectrum() and the HTTP API.
+    * cache: (LRUCache) the spectra most recently calculated by .spectrum(),
+    shared by the Dash callbacks and the HTTP API.
     """
-    def __init__(self, name, id_, model, entry_names, entry_dict):
+    cache_size = 256
+    # number of points calculated across a zoomed-in window
+    zoom_points = 800
+    # the Graph's approximate width in pixels: spectra are sent to the
+    # browser with at most two points (min and max) per pixel
+    display_width = 1000
+    # number of points per animation frame
+    animation_points = 800
+
+    def __init__(self, name, id_, model, entry_names, entry_dict,
+                 batch_model=None, batch_grid=None, lineshape=None,
+                 animation=None, sweeps=None, points=None):
         self.name = name
         self.id = id_
-        self.model = model
+        self.points = points
+        self._model = model
+        self._batch_model = batch_model
+        self._batch_grid = batch_grid
+        self._lineshape = lineshape
+        # compiled lineshapes, so that zooming in on a spectrum redoes no
+        # parameter-dependent work
+        self.lineshapes = LRUCache(32)
+        self.animation = animation
+        # animation frames, by the parameters other than the rate
+        self.animations = LRUCache(8)
+        self.sweeps = sweeps
+        # parameter map cubes and their quantized levels, by their swept
+        # and fixed parameters
+        self.cubes = LRUCache(4)
+        self.microbatcher = None
         self.entry_names = entry_names
         self.entry_dict = entry_dict
+        self.cache = LRUCache(self.cache_size)
 
         self._make_toolbar()
 
@@ -46,13 +111,317 @@ class BaseDashModel:
             html.Div(id='{}-top-toolbar'.format(self.id),
                      children=self.toolbar),
 
+            # exchange-rate animation toggle (hidden if there is none)
+            dcc.Checklist(
+                id='{}-animate'.format(self.id),
+                options=[{'label': 'animate {}'.format(
+                    animation['parameter'] if animation else ''),
+                    'value': 'on'}],
+                value=[],
+                style={} if self.can_animate else {'display': 'none'}),
+
             # The plot
-            dcc.Graph(id='{}-graph'.format(self.id))
+            dcc.Graph(id='{}-graph'.format(self.id)),
+
+            # the simulated figure, when a measured spectrum is overlaid on
+            # it in the browser (see .register_callback())
+            dcc.Store(id='{}-figure'.format(self.id))
         ])
 
         self.output = Output('{}-graph'.format(self.id), 'figure')
         self.inputs = [Input('{}-{}'.format(self.id, entry), 'value')
                        for entry in self.entry_names]
+        if self.can_zoom:
+            self.inputs.append(
+                Input('{}-graph'.format(self.id), 'relayoutData'))
+        if self.can_animate:
+            self.inputs.append(Input('{}-animate'.format(self.id), 'value'))
+
+    @staticmethod
+    def _resolve(reference):
+        """Import a 'module:attribute' reference, instantiating it if it is a
+        class. Anything else is returned unchanged."""
+        if not isinstance(reference, str):
+            return reference
+        module_name, attribute = reference.split(':')
+        obj = getattr(importlib.import_module(module_name), attribute)
+        if isinstance(obj, type):
+            obj = obj()
+        return obj
+
+    @property
+    def model(self):
+        """The lineshape function, imported on first access if it was given
+        as a 'module:attribute' string."""
+        self._model = self._resolve(self._model)
+        return self._model
+
+    @property
+    def batch_model(self):
+        """The vectorized lineshape function (or None), imported on first
+        access if it was given as a 'module:attribute' string."""
+        self._batch_model = self._resolve(self._batch_model)
+        return self._batch_model
+
+    @property
+    def batch_grid(self):
+        """The batch grid function (or None), imported on first access if it
+        was given as a 'module:attribute' string."""
+        self._batch_grid = self._resolve(self._batch_grid)
+        return self._batch_grid
+
+    @property
+    def can_batch(self):
+        """True if the model has a batch_model and a batch_grid (without
+        importing them)."""
+        return self._batch_model is not None and self._batch_grid is not None
+
+    @property
+    def lineshape(self):
+        """The lineshape factory (or None), imported on first access if it
+        was given as a 'module:attribute' string."""
+        self._lineshape = self._resolve(self._lineshape)
+        return self._lineshape
+
+    @property
+    def can_zoom(self):
+        """True if a zoomed-in window can be re-evaluated (the model has a
+        lineshape)."""
+        return self._lineshape is not None
+
+    @property
+    def can_animate(self):
+        """True if the model has an animation, a batch_model and a
+        batch_grid (without importing them)."""
+        return self.animation is not None and self.can_batch
+
+    @property
+    def can_map(self):
+        """True if the model has at least two sweeps and a batch_model
+        (without importing it)."""
+        return (self.sweeps is not None and len(self.sweeps) >= 2
+                and self.can_batch)
+
+    def enable_microbatching(self, window, max_batch=64):
+        """Evaluate concurrent .spectrum() calls together (see
+        microbatch.MicroBatcher). Requires batch_model and batch_grid.
+
+        :param window: (float) the most time, in seconds, a call waits for
+        others to join its batch.
+        :param max_batch: (int) the largest batch.
+        """
+        if not self.can_batch:
+            raise ValueError('{} has no batch_model/batch_grid'.format(
+                self.name))
+        self.microbatcher = MicroBatcher(
+            lambda x, *columns: self.batch_model(x, *columns),
+            lambda *columns: self.batch_grid(*columns, **self._points_kwarg),
+            window, max_batch)
+
+    @property
+    def _points_kwarg(self):
+        """{'points': points}, or {} to use the model's default."""
+        return {} if self.points is None else {'points': self.points}
+
+    def validate(self, params):
+        """Check a set of parameters against the model's entries.
+
+        Missing parameters take their default (Input 'value'); each value
+        must be a finite number within the entry's 'min'/'max', if any.
+
+        :param params: ({str: float or str}) values by entry name.
+        :return: ([float...]) the values, in entry_names order.
+        :raises ValueError: for unknown names, non-numbers or values out of
+        range.
+        """
+        unknown = set(params) - set(self.entry_names)
+        if unknown:
+            raise ValueError('Unknown parameter(s) for {}: {}'.format(
+                self.name, ', '.join(sorted(unknown))))
+        values = []
+        for name in self.entry_names:
+            kwargs = self.entry_dict[name]
+            try:
+                value = float(params.get(name, kwargs['value']))
+            except (TypeError, ValueError):
+                raise ValueError('{} must be a number'.format(name))
+            if not math.isfinite(value):
+                raise ValueError('{} must be finite'.format(name))
+            if 'min' in kwargs and value < kwargs['min']:
+                raise ValueError('{} must be >= {}'.format(name,
+                                                            kwargs['min']))
+            if 'max' in kwargs and value > kwargs['max']:
+                raise ValueError('{} must be <= {}'.format(name,
+                                                            kwargs['max']))
+            values.append(value)
+        return values
+
+    def spectrum(self, *input_values):
+        """Calculate the spectrum for the given values, or fetch it from the
+        cache.
+
+        :param input_values: (float,) in entry_names order.
+        :return: (numpy.ndarray, numpy.ndarray) read-only x and y arrays.
+        """
+        computed = []
+
+        def compute():
+            computed.append(True)
+            with METRICS.time(self.name, 'model'):
+                if self.microbatcher is not None:
+                    x, y = self.microbatcher(*input_values)
+                else:
+                    x, y = self.model(*input_values, **self._points_kwarg)
+            x.flags.writeable = False
+            y.flags.writeable = False
+            return x, y
+
+        result = self.cache.get_or_compute(tuple(input_values), compute)
+        METRICS.increment('cache_misses' if computed else 'cache_hits',
+                          self.name)
+        return result
+
+    def zoom(self, input_values, x_min, x_max):
+        """Calculate the spectrum across a frequency window at zoom_points
+        resolution, reusing the compiled lineshape for input_values.
+
+        :param input_values: ([float...]) in entry_names order.
+        :param x_min, x_max: (float) the window.
+        :return: (numpy.ndarray, numpy.ndarray) x and y across the window.
+        """
+        lineshape = self.lineshapes.get_or_compute(
+            tuple(input_values), lambda: self.lineshape(*input_values))
+        x = np.linspace(x_min, x_max, self.zoom_points)
+        return x, lineshape(x)
+
+    def animation_frames(self, input_values):
+        """Calculate the spectra of the animation sweep, with the other
+        parameters at input_values, in one batch_model call. Cached, so
+        changing only the rate reuses the frames.
+
+        :param input_values: ([float...]) in entry_names order.
+        :return: (numpy.ndarray, numpy.ndarray, numpy.ndarray) the rates
+        (frames,), the shared x grid (animation_points,) and the spectra
+        (frames, animation_points).
+        """
+        i = self.entry_names.index(self.animation['parameter'])
+        key = tuple(input_values[:i]) + tuple(input_values[i + 1:])
+
+        def compute():
+            frames = self.animation['frames']
+            rates = np.logspace(math.log10(self.animation['min']),
+                                math.log10(self.animation['max']), frames)
+            columns = [np.full(frames, float(value))
+                       for value in input_values]
+            columns[i] = rates
+            x = self.batch_grid(*[column[:1] for column in columns],
+                                points=self.animation_points)[0]
+            with METRICS.time(self.name, 'animation'):
+                y = self.batch_model(x, *columns)
+            return rates, x, y
+
+        return self.animations.get_or_compute(key, compute)
+
+    def parameter_cube(self, input_values, row_param, slider_param):
+        """The spectra over a grid of two swept parameters (see
+        heatmap.parameter_cube), cached by the swept parameters and the
+        values of the others.
+
+        :param input_values: ([float...]) in entry_names order.
+        :param row_param, slider_param: (str) two different keys of sweeps.
+        :return: (row values, slider values, x, cube) numpy arrays.
+        """
+        return self._cube(input_values, row_param, slider_param)[:4]
+
+    def quantized_cube(self, input_values, row_param, slider_param):
+        """The cube of .parameter_cube() as uint8 levels (see
+        heatmap.quantize), cached with it.
+
+        :return: (row values, slider values, x, levels, low, high): the
+        levels are a (slider, row, frequency) uint8 array, and low and high
+        the intensities of levels 0 and 255.
+        """
+        rows, slider, x, _, quantized = self._cube(input_values, row_param,
+                                                   slider_param)
+        return (rows, slider, x) + quantized
+
+    def _cube(self, input_values, row_param, slider_param):
+        key = (row_param, slider_param) + tuple(
+            value for name, value in zip(self.entry_names, input_values)
+            if name not in (row_param, slider_param))
+
+        def compute():
+            rows, slider, x, cube = heatmap.parameter_cube(
+                self, input_values, row_param, slider_param)
+            return rows, slider, x, cube, heatmap.quantize(cube)
+
+        return self.cubes.get_or_compute(key, compute)
+
+    @staticmethod
+    def zoom_range(relayout_data):
+        """The x range a Graph was zoomed to, from its relayoutData.
+
+        :param relayout_data: (dict or None)
+        :return: (float, float) or None if the x axis is not zoomed in.
+        """
+        if not relayout_data:
+            return None
+        if 'xaxis.range' in relayout_data:
+            limits = relayout_data['xaxis.range']
+        else:
+            limits = (relayout_data.get('xaxis.range[0]'),
+                      relayout_data.get('xaxis.range[1]'))
+        try:
+            x0, x1 = (float(limit) for limit in limits)
+        except (TypeError, ValueError):
+            return None
+        return min(x0, x1), max(x0, x1)
+
+    def register_callback(self, app, overlay=None):
+        """Add the callback that updates the model's Graph when one of its
+        Inputs changes.
+
+        :param app: (dash.Dash)
+        :param overlay: (str or None) the id of a dcc.Store holding a
+        measured spectrum to overlay (see experimental.UploadPanel). If
+        given, the simulated figure goes to a Store, and is merged with the
+        measured spectrum in the browser, so the measured data is not sent
+        again with each new simulation.
+        """
+        output = self.output
+        if overlay is not None:
+            output = Output('{}-figure'.format(self.id), 'data')
+            merge_output = self.output
+            merge_inputs = [Input('{}-figure'.format(self.id), 'data'),
+                            Input(overlay, 'data')]
+            if hasattr(app, 'clientside_callback'):
+                app.clientside_callback(OVERLAY_JS, merge_output,
+                                        merge_inputs)
+            else:
+                app.callback(merge_output, merge_inputs)(merge_figure)
+
+        @app.callback(output, self.inputs)
+        def update_model_graph(*string_values):
+            """Update the figure for the model's Graph.
+
+            :param string_values: (str...) followed by the relayoutData if
+            the model can zoom, and the animation checkbox value if it can
+            animate.
+            :return: {**kwargs} for the Graph figure
+            """
+            n = len(self.entry_names)
+            string_values, extras = string_values[:n], list(string_values[n:])
+            x_range = self.zoom_range(extras.pop(0)) if self.can_zoom else None
+            animate = bool(extras.pop(0)) if self.can_animate else False
+            try:
+                with METRICS.time(self.name, 'parse'):
+                    values = [float(i) for i in string_values]
+                if animate:
+                    return self.animation_figure(*values)
+                return self.update_graph(*values, x_range=x_range)
+            except Exception:
+                METRICS.increment('errors', self.name)
+                raise
 
     def _make_toolbar(self):
         """Create the list of (html.Label, dcc.Input) objects that comprise
@@ -71,34 +440,105 @@ class BaseDashModel:
                 style={'display': 'inline-block', 'textAlign': 'center'})
             for key in self.entry_names]
 
-    def update_graph(self, *input_values):
+    def update_graph(self, *input_values, x_range=None):
         """Update the figure of the Graph.
 
         :param input_values: (float,)
+        :param x_range: ((float, float) or None) the zoomed-in x range, if
+        any. Within it, the spectrum is recalculated at zoom_points
+        resolution (if the model can zoom), and spliced into the full
+        spectrum.
         :return: (dict) the kwargs for the Graph's figure.
         """
-        x, y = self.model(*input_values)
+        x, y = self.spectrum(*input_values)
+        if len(x) > 2 * self.display_width:
+            # imported here so that the model module still loads on first use
+            from dnmrplot import downsample_minmax
+            with METRICS.time(self.name, 'downsample'):
+                x, y = downsample_minmax(x, y, self.display_width)
+        if x_range is not None and self.can_zoom and (
+                x_range[1] - x_range[0] < abs(x[-1] - x[0])):
+            with METRICS.time(self.name, 'zoom'):
+                x_zoom, y_zoom = self.zoom(input_values, *x_range)
+                before = x < x_range[0]
+                after = x > x_range[1]
+                x = np.concatenate([x[before], x_zoom, x[after]])
+                y = np.concatenate([y[before], y_zoom, y[after]])
+        with METRICS.time(self.name, 'figure'):
+            return self._figure(x, y)
 
+    def animation_figure(self, *input_values):
+        """The Graph figure for the animation sweep: the spectra are sent
+        once, as Plotly frames sharing one x grid, and played in the
+        browser with the Play button or the slider.
+
+        :param input_values: (float,)
+        :return: (dict) the kwargs for the Graph's figure.
+        """
+        rates, x, y = self.animation_frames(input_values)
+        with METRICS.time(self.name, 'figure'):
+            # 4 significant figures (of the largest intensity) are plenty
+            # on screen, and shorten the JSON
+            decimals = 3 - int(math.floor(math.log10(np.abs(y).max() or 1)))
+            y = np.round(y, decimals)
+            names = ['{:.3g}'.format(rate) for rate in rates]
+            figure = self._figure(x, y[0])
+            figure['frames'] = [{'name': name, 'data': [{'y': row}]}
+                                for name, row in zip(names, y)]
+            layout = figure['layout']
+            margin = 0.05 * (y.max() - y.min())
+            layout['yaxis']['range'] = [y.min() - margin, y.max() + margin]
+            play = {'frame': {'duration': 50, 'redraw': False},
+                    'transition': {'duration': 0}, 'fromcurrent': True}
+            layout['updatemenus'] = [{
+                'type': 'buttons', 'showactive': False,
+                'x': 0, 'y': 0, 'xanchor': 'right', 'yanchor': 'top',
+                'buttons': [
+                    {'label': 'Play', 'method': 'animate',
+                     'args': [None, play]},
+                    {'label': 'Pause', 'method': 'animate',
+                     'args': [[None], {'mode': 'immediate',
+                                       'frame': {'duration': 0}}]}]}]
+            layout['sliders'] = [{
+                'currentvalue': {'prefix': '{} = '.format(
+                    self.animation['parameter'])},
+                'steps': [{'label': name, 'method': 'animate',
+                           'args': [[name], {'mode': 'immediate',
+                                             'frame': {'duration': 0,
+                                                       'redraw': False},
+                                             'transition': {'duration': 0}}]}
+                          for name in names]}]
+            layout['margin']['b'] = 120
+            return figure
+
+    def _figure(self, x, y):
+        """:return: (dict) the Graph figure for the spectrum x, y."""
+        # The figure is built from plain dicts rather than plotly.graph_objs:
+        # the JSON sent to the browser is the same, without the import cost
+        # and per-call validation of the graph_objs classes.
         return {
             # IMPORTANT: despite what some online examples show, apparently
             # 'data' must be a list, even if only one element. Otherwise, if []
             # omitted, it won't plot.
-            'data': [go.Scatter(
-                x=x,
-                y=y,
-                mode='lines',
-                opacity=0.7,
-                line={'color': 'blue',
-                      'width': 1},
-                name=self.name
-            )],
-            'layout': go.Layout(
-                xaxis={'title': 'frequency',
-                       'autorange': 'reversed'},
-                yaxis={'title': 'intensity'},
-                margin={'l': 40, 'b': 40, 't': 10, 'r': 10},
-                legend={'x': 0, 'y': 1},
-                hovermode='closest')
+            'data': [{
+                'type': 'scatter',
+                'x': x,
+                'y': y,
+                'mode': 'lines',
+                'opacity': 0.7,
+                'line': {'color': 'blue',
+                         'width': 1},
+                'name': self.name
+            }],
+            'layout': {
+                'xaxis': {'title': 'frequency',
+                          'autorange': 'reversed'},
+                'yaxis': {'title': 'intensity'},
+                'margin': {'l': 40, 'b': 40, 't': 10, 'r': 10},
+                'legend': {'x': 0, 'y': 1},
+                'hovermode': 'closest',
+                # keep the user's zoom when the figure is replaced
+                'uirevision': self.id}
         }
 
 
@@ -117,16 +557,6 @@ if __name__ == '__main__':
     # active_model = dnmr_two_singlets  # choose one of two models above
 
     app.layout = html.Div(dnmr_two_singlets.layout)
-
-
-    @app.callback(dnmr_two_singlets.output, dnmr_two_singlets.inputs)
-    def update_dnmr_two_singlets(*string_values):
-        """Update the figure for the dnmr_two_singlets Graph.
-
-        :param string_values: (str...)
-        :return: {**kwargs} for the Graph figure
-        """
-        values = (float(i) for i in string_values)
-        return dnmr_two_singlets.update_graph(*values)
+    dnmr_two_singlets.register_callback(app)
 
     app.run_server()
@@ -0,0 +1,212 @@
+"""On-demand profiling of live requests.
+
+Profiling is off unless configured with environment variables:
+* PYDNMR_PROFILE=1: profile every request.
+* PYDNMR_PROFILE_TOKEN=<secret>: profile the requests that send the header
+  "X-Pydnmr-Profile: <secret>". The same header is required to list and
+  download profiles, which are refused (403) if no token is set.
+* PYDNMR_PROFILE_KEEP=<n>: the number of profiles kept (default 20).
+
+When it is off, nothing is installed, and requests run exactly as without
+this module.
+
+When it is on, each model's update_graph() (the Dash callback) and spectrum()
+(the HTTP API) calls are run under cProfile. The most recent profiles are
+kept in memory, and can be listed and downloaded at:
+* GET /admin/profiles: JSON list of {"id", "time", "model", "function",
+  "values", "seconds"}, oldest first.
+* GET /admin/profiles/<id>: the profile in the binary format written by
+  pstats.Stats.dump_stats() (open it with pstats.Stats(filename), snakeviz
+  etc.); with ?format=text, the top functions by cumulative time as text.
+
+Only one call is profiled at a time in each process; calls made while
+another is being profiled run unprofiled. Each gunicorn worker keeps its own
+profiles.
+"""
+import cProfile
+import hmac
+import io
+import itertools
+import marshal
+import os
+import pstats
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+from flask import (Blueprint, Response, abort, has_request_context, jsonify,
+                   request)
+
+HEADER = 'X-Pydnmr-Profile'
+
+
+class ProfileRecord:
+    """One profiled call.
+
+    Has the following attributes:
+    * id: (int) unique within the process.
+    * time: (float) when the call started (seconds since the epoch).
+    * model: (str) the model name.
+    * function: (str) the profiled method ('update_graph' or 'spectrum').
+    * values: ([float...]) the call's arguments.
+    * seconds: (float) the wall-clock duration of the call.
+    * stats: (dict) the profile data (cProfile.Profile.stats).
+    """
+    def __init__(self, id_, start, model, function, values, seconds, stats):
+        self.id = id_
+        self.time = start
+        self.model = model
+        self.function = function
+        self.values = values
+        self.seconds = seconds
+        self.stats = stats
+
+    def to_dict(self):
+        """:return: ({str: object}) the record without its stats."""
+        return {'id': self.id, 'time': self.time, 'model': self.model,
+                'function': self.function, 'values': self.values,
+                'seconds': self.seconds}
+
+    def dump(self):
+        """:return: (bytes) the stats, in pstats.Stats.dump_stats() format."""
+        return marshal.dumps(self.stats)
+
+    def text(self, limit=40):
+        """:return: (str) the top `limit` functions by cumulative time."""
+        stream = io.StringIO()
+        stats = pstats.Stats(stream=stream)
+        # Stats loads the same dict that dump_stats() writes
+        stats.stats = self.stats
+        stats.get_top_level_stats()
+        stats.sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+
+class Profiler:
+    """Profiles model calls and keeps the most recent profiles.
+
+    Has the following attributes:
+    * always: (bool) profile every call.
+    * token: (str or None) if set, calls made during a request carrying
+    this value in the HEADER header are profiled.
+    * profiles: (collections.deque) the most recent ProfileRecords.
+    """
+    def __init__(self, always=False, token=None, keep=20):
+        self.always = always
+        self.token = token
+        self.profiles = deque(maxlen=keep)
+        self._ids = itertools.count(1)
+        # held while a call is being profiled
+        self._active = threading.Lock()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        """Create a Profiler from the PYDNMR_PROFILE* variables (see module
+        docstring).
+
+        :return: (Profiler or None) None if profiling is not enabled.
+        """
+        always = environ.get('PYDNMR_PROFILE', '') not in ('', '0')
+        token = environ.get('PYDNMR_PROFILE_TOKEN') or None
+        if not (always or token):
+            return None
+        return cls(always, token, int(environ.get('PYDNMR_PROFILE_KEEP', 20)))
+
+    def authorized(self):
+        """:return: (bool) True if the current request carries the token."""
+        if self.token is None or not has_request_context():
+            return False
+        return hmac.compare_digest(request.headers.get(HEADER, ''),
+                                   self.token)
+
+    def wrap(self, model_name, method):
+        """Wrap a model method so that its calls are profiled when
+        requested.
+
+        :param model_name: (str) recorded with each profile.
+        :param method: the bound method to wrap.
+        :return: the wrapped method.
+        """
+        @wraps(method)
+        def profiled(*values, **kwargs):
+            if not (self.always or self.authorized()):
+                return method(*values, **kwargs)
+            if not self._active.acquire(blocking=False):
+                # another call (maybe the caller of this one) is profiled
+                return method(*values, **kwargs)
+            try:
+                profile = cProfile.Profile()
+                start = time.time()
+                t0 = time.perf_counter()
+                try:
+                    return profile.runcall(method, *values, **kwargs)
+                finally:
+                    seconds = time.perf_counter() - t0
+                    profile.create_stats()
+                    self._add(model_name, method.__name__, values, start,
+                              seconds, profile.stats)
+            finally:
+                self._active.release()
+
+        return profiled
+
+    def install(self, model):
+        """Profile a BaseDashModel's update_graph() and spectrum() calls.
+
+        :param model: (BaseDashModel)
+        """
+        model.update_graph = self.wrap(model.name, model.update_graph)
+        model.spectrum = self.wrap(model.name, model.spectrum)
+
+    def _add(self, model_name, function, values, start, seconds, stats):
+        with self._lock:
+            self.profiles.append(ProfileRecord(
+                next(self._ids), start, model_name, function,
+                [float(value) for value in values], seconds, stats))
+
+    def get(self, id_):
+        """:return: (ProfileRecord or None) the kept profile with this id."""
+        with self._lock:
+            for record in self.profiles:
+                if record.id == id_:
+                    return record
+        return None
+
+    def create_blueprint(self):
+        """Create the Blueprint serving the kept profiles (see module
+        docstring).
+
+        :return: (flask.Blueprint)
+        """
+        blueprint = Blueprint('profiling', __name__,
+                              url_prefix='/admin/profiles')
+
+        @blueprint.before_request
+        def check_token():
+            # without a token, there is no way to tell who is asking
+            if not self.authorized():
+                abort(403)
+
+        @blueprint.route('')
+        def list_profiles():
+            """:return: JSON list of the kept profiles."""
+            with self._lock:
+                records = [record.to_dict() for record in self.profiles]
+            return jsonify(records)
+
+        @blueprint.route('/<int:id_>')
+        def download(id_):
+            """:return: one profile, as pstats data or text."""
+            record = self.get(id_)
+            if record is None:
+                abort(404)
+            if request.args.get('format') == 'text':
+                return Response(record.text(), mimetype='text/plain')
+            return Response(
+                record.dump(), mimetype='application/octet-stream',
+                headers={'Content-Disposition':
+                         'attachment; filename=pydnmr-{}.prof'.format(id_)})
+
+        return blueprint
@@ -0,0 +1,220 @@
+"""Application factory for the pyDNMR-Web Dash app.
+
+create_app() builds a configured Dash app, with the HTTP API of api.py and
+the /metrics endpoint of metrics.py mounted on its Flask server; the WSGI
+application for a production server is its .server attribute (see
+wsgi.py). warm_up() initializes the per-process state of an app (imports the
+model modules and evaluates each model once), and is called after fork in
+each worker (see gunicorn.conf.py).
+
+Set the environment variable PYDNMR_MICROBATCH_MS to a number of
+milliseconds to have concurrent spectrum requests for the same model
+collected over that window and evaluated together (see microbatch.py).
+
+Set PYDNMR_POINTS to calculate every spectrum with that many points (the
+Graph is sent a downsampled copy; the HTTP API returns all of them).
+
+Set PYDNMR_FIT_JOBS to the number of background fits each process may run
+at once, and PYDNMR_FIT_DIR to the directory, shared by the processes, that
+holds their progress (see fitjobs.py).
+
+Set PYDNMR_PROFILE or PYDNMR_PROFILE_TOKEN to profile requests on demand
+(see profiling.py).
+"""
+import json
+import os
+
+import dash
+import dash_core_components as dcc
+import dash_html_components as html
+from dash.dependencies import Input, Output
+
+from api import create_api
+from metrics import create_metrics_blueprint
+from model_definitions import MODELS, load_plugins
+from experimental import UploadPanel
+from fitjobs import FitPanel, JobRunner
+from heatmap import DashHeatmap
+from models_dash import BaseDashModel
+from profiling import Profiler
+
+
+def create_app(microbatch_window=None, profiler=None, points=None,
+               fit_runner=None):
+    """Create the Dash app, with a BaseDashModel for each registered model.
+
+    :param microbatch_window: (float or None) if given, the micro-batching
+    window in seconds for models that support it; defaults to
+    PYDNMR_MICROBATCH_MS / 1000 if that is set.
+    :param profiler: (profiling.Profiler or None) if given, profiles model
+    calls; defaults to Profiler.from_environ() (None unless profiling is
+    configured).
+    :param points: (int or None) the number of points per spectrum, for
+    every model; defaults to PYDNMR_POINTS if that is set, or else each
+    model's default.
+    :param fit_runner: (fitjobs.JobRunner or None) runs the background
+    fits; defaults to JobRunner.from_environ().
+    :return: (dash.Dash) the app. Its models are available as
+    app.model_dict ({name: BaseDashModel}), its profiler (or None) as
+    app.profiler, and its fit runner as app.fit_runner.
+    """
+    app = dash.Dash()
+    # Demos on the plot.ly Dash site use secret-sauce css:
+    app.css.append_css(
+        {'external_url': 'https://codepen.io/chriddyp/pen/bWLwgP.css'})
+
+    load_plugins()
+    if points is None and os.environ.get('PYDNMR_POINTS'):
+        points = int(os.environ['PYDNMR_POINTS'])
+    models = [BaseDashModel(**kwargs) if points is None
+              else BaseDashModel(**dict(kwargs, points=points))
+              for kwargs in MODELS.values()]
+    model_dict = {model.name: model for model in models}
+    default_model = models[0].name
+    app.model_dict = model_dict
+
+    if microbatch_window is None and os.environ.get('PYDNMR_MICROBATCH_MS'):
+        microbatch_window = float(os.environ['PYDNMR_MICROBATCH_MS']) / 1000
+    if microbatch_window:
+        for model in models:
+            if model.can_batch:
+                model.enable_microbatching(microbatch_window)
+
+    # parameter maps, for the models that support them
+    heatmaps = {model.name: DashHeatmap(model) for model in models
+                if model.can_map}
+
+    if profiler is None:
+        profiler = Profiler.from_environ()
+    app.profiler = profiler
+    if profiler is not None:
+        for model in models:
+            profiler.install(model)
+
+    upload = UploadPanel()
+    # fits to the uploaded spectrum, run in background threads
+    if fit_runner is None:
+        fit_runner = JobRunner.from_environ()
+    app.fit_runner = fit_runner
+    fits = {model.name: FitPanel(model, fit_runner) for model in models
+            if model.can_batch}
+
+    app.layout = html.Div([
+        # navbar
+        dcc.Location(id='url', refresh=False),
+
+        # Model toggle
+        dcc.RadioItems(
+            id='model-select',
+            options=[{'label': model.name, 'value': model.name} for model in
+                     models],
+            value=default_model
+        ),
+
+        # Measured spectrum, overlaid on every model's graph
+        upload.layout,
+
+        # Model-specific content: every model's layout is mounted once, and
+        # only the selected one is shown. Switching models needs no server
+        # round trip, and each graph keeps its last figure.
+        html.Div(id='page-content', children=[
+            html.Div([model.layout] +
+                     [panels[model.name].layout
+                      for panels in (fits, heatmaps) if model.name in panels],
+                     id=page_id(model),
+                     style=page_style(model.name, default_model))
+            for model in models])
+    ])
+
+    # Update the index
+    @app.callback(Output('model-select', 'value'),
+                  [Input('url', 'pathname')])
+    def display_page(pathname):
+        """Update the current model name when the url changes.
+
+        :return: (str) the name of the selected model
+        """
+        model_key = (pathname or '').strip('/')
+        if model_key in model_dict:
+            return model_key
+        else:
+            return default_model
+        # You could also return a 404 "URL not found" page here
+
+    for model in models:
+        register_toggle(app, model)
+    for heatmap in heatmaps.values():
+        heatmap.register_callbacks(app)
+    upload.register_callbacks(app)
+    for fit in fits.values():
+        fit.register_callbacks(app)
+
+    for model in models:
+        model.register_callback(app, overlay=upload.store_id)
+
+    # JSON/binary spectrum API for scripts and other services
+    app.server.register_blueprint(create_api(model_dict))
+    # Prometheus metrics at /metrics
+    app.server.register_blueprint(create_metrics_blueprint())
+    if profiler is not None:
+        # profiles for download at /admin/profiles
+        app.server.register_blueprint(profiler.create_blueprint())
+
+    return app
+
+
+def page_id(model):
+    """:return: (str) the id of the Div holding a model's layout."""
+    return '{}-page'.format(model.id)
+
+
+def page_style(model_name, selected):
+    """:return: (dict) the style of a model's Div when `selected` is the
+    selected model name."""
+    return {} if model_name == selected else {'display': 'none'}
+
+
+# Shows a model's Div when it is selected, and hides it otherwise. The
+# resize event lets Plotly fit a graph that was drawn while hidden.
+TOGGLE_JS = """
+function(selected) {{
+    setTimeout(function() {{
+        window.dispatchEvent(new Event('resize'));
+    }}, 0);
+    return selected === {name} ? {{}} : {{display: 'none'}};
+}}
+"""
+
+
+def register_toggle(app, model):
+    """Add the callback that shows or hides a model's layout when the
+    selected model changes. It runs in the browser where Dash supports
+    clientside callbacks, and on the server (returning only the style)
+    otherwise.
+
+    :param app: (dash.Dash)
+    :param model: (BaseDashModel)
+    """
+    output = Output(page_id(model), 'style')
+    inputs = [Input('model-select', 'value')]
+    if hasattr(app, 'clientside_callback'):
+        app.clientside_callback(
+            TOGGLE_JS.format(name=json.dumps(model.name)), output, inputs)
+        return
+
+    @app.callback(output, inputs)
+    def toggle_model(model_key):
+        return page_style(model.name, model_key)
+
+
+def warm_up(app):
+    """Initialize the per-process state of the app's models: import their
+    calculation modules and compute each model's spectrum once, at its
+    default values.
+
+    :param app: (dash.Dash) an app made by create_app().
+    """
+    for model in app.model_dict.values():
+        values = [model.entry_dict[name]['value']
+                  for name in model.entry_names]
+        model.update_graph(*values)
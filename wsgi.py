@@ -0,0 +1,10 @@
+"""WSGI entry point for production servers.
+
+gunicorn -c gunicorn.conf.py wsgi:application
+"""
+from webapp import create_app
+
+app = create_app()
+# Never serve the debugger/reloader to the outside world.
+app.server.debug = False
+application = app.server